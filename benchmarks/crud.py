@@ -0,0 +1,286 @@
+""" Benchmark the generated CRUD methods, through nameko entrypoints, on
+SQLite (file and in-memory) with the `memory://` transport, with and without
+events.
+
+Reports the throughput and p50/p99 latency of each scenario. Results can be
+saved (``--output``) and compared against a previously saved baseline
+(``--baseline``), flagging scenarios whose throughput dropped by more than
+``--tolerance``.
+
+Usage::
+
+    python benchmarks/crud.py --output baseline.json
+    # ... make changes ...
+    python benchmarks/crud.py --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import eventlet
+from nameko.constants import AMQP_URI_CONFIG_KEY
+from nameko.containers import ServiceContainer
+from nameko.events import EventDispatcher
+from nameko.testing.services import entrypoint_hook
+from nameko.testing.utils import get_extension
+from nameko_sqlalchemy import DB_URIS_KEY, DatabaseSession
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import StaticPool
+
+from nameko_autocrud import AutoCrud, AutoCrudWithEvents
+
+Base = declarative_base(name='benchmarkbase')
+
+PAGE_SIZE = 20
+LIST_SIZES = (10, 100, 1000)
+
+
+class Member(Base):
+    __tablename__ = 'member'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(50))
+    email = sa.Column(sa.String(100))
+    score = sa.Column(sa.Integer)
+    active = sa.Column(sa.Boolean)
+
+
+def make_service_cls(with_events):
+    method_names = dict(
+        get_method_name='get_member',
+        list_method_name='list_members',
+        page_method_name='page_members',
+        count_method_name='count_members',
+        create_method_name='create_member',
+        update_method_name='update_member',
+        delete_method_name='delete_member',
+    )
+
+    class BenchmarkService(object):
+        name = 'benchmark'
+
+        session = DatabaseSession(Base)
+
+        if with_events:
+            dispatcher = EventDispatcher()
+            member_crud = AutoCrudWithEvents(
+                session, dispatcher, 'member',
+                model_cls=Member,
+                create_event_name='member_created',
+                update_event_name='member_updated',
+                delete_event_name='member_deleted',
+                **method_names
+            )
+        else:
+            member_crud = AutoCrud(
+                session, model_cls=Member, **method_names)
+
+    return BenchmarkService
+
+
+def make_member(id_, name=None):
+    return {
+        'id': id_, 'name': name or 'member {}'.format(id_),
+        'email': 'member{}@example.com'.format(id_), 'score': id_ % 100,
+        'active': id_ % 2 == 0,
+    }
+
+
+def start_container(db_uri, with_events):
+    config = {
+        AMQP_URI_CONFIG_KEY: 'memory://',
+        DB_URIS_KEY: {'benchmark:benchmarkbase': db_uri},
+    }
+    container = ServiceContainer(make_service_cls(with_events), config)
+
+    if db_uri == 'sqlite://':
+        # share a single in-memory database between all sessions
+        provider = get_extension(container, DatabaseSession)
+        provider.engine_options = {
+            'poolclass': StaticPool,
+            'connect_args': {'check_same_thread': False},
+        }
+
+    container.start()
+    return container
+
+
+def populate(container, num_rows):
+    engine = get_extension(container, DatabaseSession).engine
+    Base.metadata.create_all(engine)
+    engine.execute(
+        Member.__table__.insert(),
+        [make_member(id_) for id_ in range(1, num_rows + 1)]
+    )
+
+
+def percentile(sorted_values, percent):
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
+
+
+def measure(container, method_name, calls, warmup=0):
+    """ Call the entrypoint `method_name` with each `(args, kwargs)` of
+        `calls`, returning the throughput and latency percentiles.
+    """
+    latencies = []
+    with entrypoint_hook(container, method_name) as method:
+        for args, kwargs in calls[:warmup]:
+            method(*args, **kwargs)
+
+        start = time.time()
+        for args, kwargs in calls[warmup:]:
+            call_start = time.time()
+            method(*args, **kwargs)
+            latencies.append(time.time() - call_start)
+        elapsed = time.time() - start
+
+    latencies.sort()
+    return {
+        'ops_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def get_scenarios(num_rows, iterations):
+    """ Yield `(name, method_name, calls, warmup)` in the order to run. """
+    warmup = min(10, iterations)
+    ids = [(i % num_rows) + 1 for i in range(iterations + warmup)]
+
+    def read_calls(*args, **kwargs):
+        return [(args, kwargs)] * (iterations + warmup)
+
+    yield 'get', 'get_member', [((id_,), {}) for id_ in ids], warmup
+    for size in LIST_SIZES:
+        yield (
+            'list_{}'.format(size), 'list_members',
+            read_calls(limit=size), warmup
+        )
+    yield (
+        'page_shallow', 'page_members',
+        read_calls(page_size=PAGE_SIZE, page_num=1), warmup
+    )
+    yield (
+        'page_deep', 'page_members',
+        read_calls(page_size=PAGE_SIZE, page_num=num_rows // PAGE_SIZE),
+        warmup
+    )
+    yield 'count', 'count_members', read_calls(), warmup
+
+    new_ids = range(num_rows + 1, num_rows + iterations + 1)
+    yield (
+        'create', 'create_member',
+        [((make_member(id_),), {}) for id_ in new_ids], 0
+    )
+    yield (
+        'update', 'update_member',
+        [
+            ((id_, {'name': 'renamed {}'.format(i)}), {})
+            for i, id_ in enumerate(ids[:iterations])
+        ],
+        0
+    )
+    yield 'delete', 'delete_member', [((id_,), {}) for id_ in new_ids], 0
+
+
+def run(db, with_events, num_rows, iterations, tmpdir):
+    if db == 'file':
+        db_uri = 'sqlite:///{}'.format(
+            os.path.join(tmpdir, 'benchmark_{:d}.db'.format(with_events)))
+    else:
+        db_uri = 'sqlite://'
+
+    container = start_container(db_uri, with_events)
+    try:
+        populate(container, num_rows)
+        for name, method_name, calls, warmup in get_scenarios(
+            num_rows, iterations
+        ):
+            yield name, measure(container, method_name, calls, warmup)
+    finally:
+        container.stop()
+
+
+def compare(result, baseline, tolerance):
+    """ Return the change in throughput from `baseline`, and whether it is
+        a regression.
+    """
+    change = result['ops_per_sec'] / baseline['ops_per_sec'] - 1
+    return change, change < -tolerance
+
+
+def main():
+    # as `nameko run` does
+    eventlet.monkey_patch()
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        '--db', choices=['file', 'memory', 'both'], default='both')
+    parser.add_argument(
+        '--events', choices=['yes', 'no', 'both'], default='both')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--output', help='save the results to this file')
+    parser.add_argument('--baseline', help='compare to results in this file')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1,
+        help='flag throughput drops greater than this fraction')
+    args = parser.parse_args()
+
+    dbs = ['file', 'memory'] if args.db == 'both' else [args.db]
+    events = {'yes': [True], 'no': [False], 'both': [False, True]}[
+        args.events]
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    regressions = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('{:<36} {:>10} {:>9} {:>9} {:>9}'.format(
+            'scenario', 'ops/sec', 'p50 ms', 'p99 ms', 'baseline'))
+        for db in dbs:
+            for with_events in events:
+                variant = 'events' if with_events else 'plain'
+                for name, result in run(
+                    db, with_events, args.rows, args.iterations, tmpdir
+                ):
+                    key = '{}/{}/{}'.format(db, variant, name)
+                    results[key] = result
+
+                    comparison = ''
+                    if key in baseline:
+                        change, regressed = compare(
+                            result, baseline[key], args.tolerance)
+                        comparison = '{:+.0%}{}'.format(
+                            change, ' SLOWER' if regressed else '')
+                        if regressed:
+                            regressions.append(key)
+
+                    print('{:<36} {:>10.0f} {:>9.2f} {:>9.2f} {:>9}'.format(
+                        key, result['ops_per_sec'], result['p50_ms'],
+                        result['p99_ms'], comparison))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+
+    if regressions:
+        print('{} scenario(s) slower than the baseline: {}'.format(
+            len(regressions), ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+""" Drive a service with several AutoCrud providers with concurrent calls.
+
+Starts a service container whose `member` and `team` models each have
+AutoCrud methods, then runs `--clients` concurrent clients for `--duration`
+seconds, each calling a method picked from `--mix` on a random model.
+Calls spawn workers for the methods' entrypoints directly, waiting for the
+container's worker pool as the RPC consumer does; the AMQP transport and
+RPC serialization are not exercised, so aren't included in the latencies.
+
+Reports throughput, latency percentiles by method, worker pool saturation
+and the time spent waiting for database connections.
+
+Usage::
+
+    python benchmarks/load.py --clients 50 --workers 10 --db-pool-size 5 \\
+        --mix get=50,list=20,page=10,count=5,create=10,update=5
+
+``--db-uri`` can point at a local database instead of a temporary SQLite
+file (the tables are created and dropped).
+"""
+import argparse
+from collections import defaultdict
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import eventlet
+from eventlet.event import Event
+from nameko.constants import AMQP_URI_CONFIG_KEY, MAX_WORKERS_CONFIG_KEY
+from nameko.containers import ServiceContainer
+from nameko.extensions import Entrypoint
+from nameko.testing.utils import get_extension
+from nameko_sqlalchemy import DB_URIS_KEY, DatabaseSession
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
+
+from nameko_autocrud import AutoCrud
+
+Base = declarative_base(name='loadbase')
+
+MODELS = ('member', 'team')
+METHODS = ('get', 'list', 'page', 'count', 'create', 'update')
+PAGE_SIZE = 20
+
+
+class Member(Base):
+    __tablename__ = 'member'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(50))
+    email = sa.Column(sa.String(100))
+    score = sa.Column(sa.Integer)
+
+
+class Team(Base):
+    __tablename__ = 'team'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(50))
+    size = sa.Column(sa.Integer)
+
+
+def method_names(model_name):
+    return dict(
+        get_method_name='get_{}'.format(model_name),
+        list_method_name='list_{}s'.format(model_name),
+        page_method_name='page_{}s'.format(model_name),
+        count_method_name='count_{}s'.format(model_name),
+        create_method_name='create_{}'.format(model_name),
+        update_method_name='update_{}'.format(model_name),
+    )
+
+
+class LoadService(object):
+    name = 'load'
+
+    session = DatabaseSession(Base)
+
+    member_crud = AutoCrud(
+        session, model_cls=Member, **method_names('member'))
+    team_crud = AutoCrud(
+        session, model_cls=Team, **method_names('team'))
+
+
+# seconds spent waiting for database connections
+connection_waits = []
+
+
+class TimedQueuePool(QueuePool):
+    """ Records the time spent checking out each connection. """
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            connection_waits.append(time.time() - start)
+
+
+def make_record(model_name, id_):
+    if model_name == 'member':
+        return {
+            'id': id_, 'name': 'member {}'.format(id_),
+            'email': 'member{}@example.com'.format(id_), 'score': id_ % 100,
+        }
+    return {'id': id_, 'name': 'team {}'.format(id_), 'size': id_ % 10}
+
+
+class Calls(object):
+    """ Builds the arguments of calls to the generated methods. """
+
+    def __init__(self, num_rows):
+        self.num_rows = num_rows
+        self.new_ids = itertools.count(num_rows + 1)
+
+    def get(self, model_name):
+        return 'get_{}'.format(model_name), (self.random_id(),)
+
+    def list(self, model_name):
+        return 'list_{}s'.format(model_name), (None, None, None, PAGE_SIZE)
+
+    def page(self, model_name):
+        page_num = random.randint(1, max(1, self.num_rows // PAGE_SIZE))
+        return 'page_{}s'.format(model_name), (PAGE_SIZE, page_num)
+
+    def count(self, model_name):
+        return 'count_{}s'.format(model_name), ()
+
+    def create(self, model_name):
+        record = make_record(model_name, next(self.new_ids))
+        return 'create_{}'.format(model_name), (record,)
+
+    def update(self, model_name):
+        return 'update_{}'.format(model_name), (
+            self.random_id(), {'name': 'renamed {}'.format(time.time())})
+
+    def random_id(self):
+        return random.randint(1, self.num_rows)
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        method, weight = item.split('=')
+        if method not in METHODS:
+            raise ValueError('Unknown method in mix: {}'.format(method))
+        weights[method] = int(weight)
+    return weights
+
+
+def call(container, method_name, args):
+    """ Run a worker for `method_name`, waiting for a free worker if the
+        pool is full (as the RPC consumer does), and return its `exc_info`.
+    """
+    entrypoint = get_extension(
+        container, Entrypoint, method_name=method_name)
+    done = Event()
+
+    def handle_result(worker_ctx, result, exc_info):
+        done.send(exc_info)
+        return result, exc_info
+
+    container.spawn_worker(entrypoint, args, {}, handle_result=handle_result)
+    return done.wait()
+
+
+def run_client(container, calls, weights, deadline, latencies, errors):
+    methods = list(weights)
+    method_weights = [weights[method] for method in methods]
+    while time.time() < deadline:
+        method = random.choices(methods, method_weights)[0]
+        method_name, args = getattr(calls, method)(random.choice(MODELS))
+
+        start = time.time()
+        exc_info = call(container, method_name, args)
+        latencies[method].append(time.time() - start)
+        if exc_info is not None:
+            errors[method] += 1
+
+
+def sample_worker_pool(container, interval, samples, stopped):
+    while not stopped.ready():
+        samples.append(container.max_workers - container._worker_pool.free())
+        eventlet.sleep(interval)
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
+
+
+def report(elapsed, latencies, errors, samples, max_workers):
+    all_latencies = sorted(itertools.chain(*latencies.values()))
+    print('{} calls in {:.1f}s: {:.0f} calls/sec, {} errors'.format(
+        len(all_latencies), elapsed, len(all_latencies) / elapsed,
+        sum(errors.values())))
+
+    print('\n{:<8} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'method', 'calls', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for method in sorted(latencies) + ['all']:
+        values = (
+            all_latencies if method == 'all' else sorted(latencies[method]))
+        method_errors = (
+            sum(errors.values()) if method == 'all' else errors[method])
+        print('{:<8} {:>8} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            method, len(values), method_errors,
+            percentile(values, 50) * 1000, percentile(values, 90) * 1000,
+            percentile(values, 99) * 1000, percentile(values, 100) * 1000))
+
+    if samples:
+        saturated = sum(1 for busy in samples if busy >= max_workers)
+        print(
+            '\nworker pool: {:.1f} of {} workers busy on average, '
+            'saturated {:.0%} of the time'.format(
+                sum(samples) / float(len(samples)), max_workers,
+                saturated / float(len(samples))))
+
+    waits = sorted(connection_waits)
+    if waits:
+        print(
+            'db pool: {} checkouts, waits mean {:.2f} ms, p99 {:.2f} ms, '
+            'max {:.2f} ms, total {:.2f}s'.format(
+                len(waits), sum(waits) / len(waits) * 1000,
+                percentile(waits, 99) * 1000, waits[-1] * 1000, sum(waits)))
+
+
+def main():
+    # as `nameko run` does
+    eventlet.monkey_patch()
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--db-pool-size', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument(
+        '--mix', default='get=50,list=20,page=10,count=5,create=10,update=5')
+    parser.add_argument('--db-uri', help='defaults to a temporary SQLite db')
+    parser.add_argument('--sample-interval', type=float, default=0.01)
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+
+    tmpdir = tempfile.mkdtemp()
+    db_uri = args.db_uri or 'sqlite:///{}'.format(
+        os.path.join(tmpdir, 'load.db'))
+
+    engine = sa.create_engine(db_uri)
+    Base.metadata.create_all(engine)
+    for model_cls, model_name in [(Member, 'member'), (Team, 'team')]:
+        engine.execute(model_cls.__table__.insert(), [
+            make_record(model_name, id_) for id_ in range(1, args.rows + 1)
+        ])
+
+    config = {
+        # required by the rpc entrypoints, though calls don't use it
+        AMQP_URI_CONFIG_KEY: 'memory://',
+        DB_URIS_KEY: {'load:loadbase': db_uri},
+        MAX_WORKERS_CONFIG_KEY: args.workers,
+    }
+    container = ServiceContainer(LoadService, config)
+    get_extension(container, DatabaseSession).engine_options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': args.db_pool_size,
+        'max_overflow': 0,
+    }
+    container.start()
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    samples = []
+    stopped = Event()
+    try:
+        sampler = eventlet.spawn(
+            sample_worker_pool, container, args.sample_interval, samples,
+            stopped)
+
+        calls = Calls(args.rows)
+        start = time.time()
+        deadline = start + args.duration
+        clients = [
+            eventlet.spawn(
+                run_client, container, calls, weights, deadline, latencies,
+                errors)
+            for _ in range(args.clients)
+        ]
+        for client in clients:
+            client.wait()
+        elapsed = time.time() - start
+
+        stopped.send()
+        sampler.wait()
+    finally:
+        container.stop()
+        Base.metadata.drop_all(engine)
+        shutil.rmtree(tmpdir)
+
+    report(elapsed, latencies, errors, samples, container.max_workers)
+
+
+if __name__ == '__main__':
+    main()
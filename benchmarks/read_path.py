@@ -0,0 +1,94 @@
+""" Compare `list` throughput of the ORM instance and column-row read paths.
+
+Usage::
+
+    python benchmarks/read_path.py --rows 10000 --repeat 5
+"""
+import argparse
+from datetime import datetime
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from nameko_autocrud.managers import CrudManager
+from nameko_autocrud.serializers import (
+    default_to_serializable, get_default_from_serializable
+)
+from nameko_autocrud.storage import DBStorage
+
+Base = declarative_base()
+
+
+class Member(Base):
+    __tablename__ = 'member'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(50))
+    email = sa.Column(sa.String(100))
+    score = sa.Column(sa.Integer)
+    balance = sa.Column(sa.Float)
+    active = sa.Column(sa.Boolean)
+    joined = sa.Column(sa.DateTime)
+
+
+def orm_to_serializable(obj):
+    # not `default_to_serializable` itself, so the instance path is used
+    return default_to_serializable(obj)
+
+
+def populate(session, num_rows):
+    session.execute(Member.__table__.insert(), [
+        {
+            'id': i, 'name': 'member {}'.format(i),
+            'email': 'member{}@example.com'.format(i), 'score': i % 100,
+            'balance': i * 1.5, 'active': i % 2 == 0,
+            'joined': datetime(2018, 1, 1),
+        }
+        for i in range(1, num_rows + 1)
+    ])
+    session.commit()
+
+
+def measure(session, to_serializable, repeat):
+    best = None
+    for _ in range(repeat):
+        manager = CrudManager(
+            None, None,
+            db_storage=DBStorage(Member, session=session),
+            to_serializable=to_serializable,
+            from_serializable=get_default_from_serializable(Member),
+        )
+        start = time.time()
+        results = manager.list()
+        elapsed = time.time() - start
+        session.expunge_all()
+        best = elapsed if best is None else min(best, elapsed)
+    return len(results), best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--db-uri', default='sqlite://')
+    args = parser.parse_args()
+
+    engine = sa.create_engine(args.db_uri)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    populate(session, args.rows)
+
+    for label, to_serializable in [
+        ('orm instances', orm_to_serializable),
+        ('column rows', default_to_serializable),
+    ]:
+        num_rows, elapsed = measure(session, to_serializable, args.repeat)
+        print('{:<15} {:>10.0f} rows/sec ({} rows in {:.3f}s)'.format(
+            label, num_rows / elapsed, num_rows, elapsed))
+
+    Base.metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    main()
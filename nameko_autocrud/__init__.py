@@ -1,15 +1,41 @@
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from inspect import getcallargs
 import logging
 
+from nameko.exceptions import serialize
 from nameko.rpc import rpc as nameko_rpc
 from nameko.extensions import DependencyProvider
+from nameko.timer import timer
 
+from .batching import GetBatcher
+from .coalescing import SingleFlight, get_call_key
+from .indexes import RowCountCache
+from .indexes import QueryUsage, UnindexedFilter  # noqa
+from .instrumentation import NULL_TRACE, Instrumentation
+from .instrumentation import (  # noqa
+    CallbackInstrumentation, HistogramInstrumentation
+)
+from .limits import ConcurrencyLimiter, TooManyRequests
+from .profiling import SlowCallProfiler  # noqa
 from .managers import CrudManager, CrudManagerWithEvents
+from .outbox import make_outbox_model  # noqa
+from .outbox import relay_events
 from .serializers import default_to_serializable, get_default_from_serializable
-from .storage import DBStorage
+from .serializers import from_columnar  # noqa
+from .sharding import ShardedDBStorage
+from .sharding import UnsupportedOperation  # noqa
+from .statements import statement_counter
+from .storage import DBStorage, get_large_column_names
 from .storage import NotFound  # noqa
+from .storage import QueryTimeout
 
 logger = logging.getLogger(__name__)
 
+# read-only methods whose identical concurrent calls may share a result
+COALESCED_METHODS = ('get', 'list', 'page', 'count')
+
 
 def get_dependency_accessor(accessor):
 
@@ -36,11 +62,33 @@ class AutoCrud(DependencyProvider):
         page_method_name=None, count_method_name=None,
         create_method_name=None, update_method_name=None,
         delete_method_name=None,
+        upsert_method_name=None, bulk_upsert_method_name=None,
+        changes_since_method_name=None, sync_method_name=None,
         get_rpc=None, list_rpc=None,
         page_rpc=None, count_rpc=None,
         create_rpc=None, update_rpc=None,
         delete_rpc=None,
+        upsert_rpc=None, bulk_upsert_rpc=None,
+        changes_since_rpc=None, sync_rpc=None,
+        get_concurrency=None, list_concurrency=None,
+        page_concurrency=None, count_concurrency=None,
+        create_concurrency=None, update_concurrency=None,
+        delete_concurrency=None,
+        upsert_concurrency=None, bulk_upsert_concurrency=None,
+        changes_since_concurrency=None, sync_concurrency=None,
+        list_timeout=None, page_timeout=None, count_timeout=None,
+        max_limit=None, default_limit=None,
         rpc=nameko_rpc,
+        read_session_provider=None,
+        unit_of_work=False,
+        coalesce_reads=False,
+        get_batch_window=None, get_batch_size=100,
+        instrumentation=None,
+        count_statements=False, statement_budget=None,
+        slow_call_profiler=None,
+        query_usage=None, reject_unindexed_filters=False,
+        unindexed_filter_min_rows=None, unindexed_filter_count_ttl=300,
+        deferred_columns=None,
         **crud_manager_kwargs
     ):
         required = [
@@ -54,10 +102,71 @@ class AutoCrud(DependencyProvider):
             raise ValueError(
                 '`{}` param(s) are missing for {}'.format(
                     missing, type(self).__name__))
+        if changes_since_method_name and not crud_manager_kwargs.get(
+            'changes_column'
+        ):
+            raise ValueError(
+                '`changes_column` param is required for `changes_since`')
+
+        if unindexed_filter_min_rows is not None and (
+            unindexed_filter_min_rows < 0
+        ):
+            raise ValueError('Invalid unindexed_filter_min_rows ({})'.format(
+                unindexed_filter_min_rows))
+
+        if deferred_columns == 'auto':
+            deferred_columns = get_large_column_names(model_cls)
+        column_names = [col.name for col in model_cls.__table__.columns]
+        unknown = [
+            name for name in deferred_columns or ()
+            if name not in column_names
+        ]
+        if unknown:
+            raise ValueError('Unknown deferred_columns {} of {}'.format(
+                unknown, model_cls.__name__))
+        # columns left out of `list` & `page` results unless included
+        self.deferred_columns = tuple(deferred_columns or ())
 
         # store these providers as a map so they are not seen by nameko
         # as sub-dependencies
         self.session_accessor = get_dependency_accessor(session_provider)
+        self.read_session_accessor = (
+            get_dependency_accessor(read_session_provider)
+            if read_session_provider else None
+        )
+        self.unit_of_work = unit_of_work
+        self.max_limit = max_limit
+        self.default_limit = default_limit
+        # statement timeouts (in seconds) for read methods
+        self.statement_timeouts = {
+            fn_name: timeout for fn_name, timeout in [
+                ('list', list_timeout),
+                ('page', page_timeout),
+                ('count', count_timeout),
+            ] if timeout
+        }
+        # counters shared by all workers, e.g. the sessions used for reads
+        self.stats = Counter()
+        self.single_flight = (
+            SingleFlight(self.stats) if coalesce_reads else None)
+        self.get_batcher = (
+            GetBatcher(get_batch_window, get_batch_size, self.stats)
+            if get_batch_window else None
+        )
+        # times the stages of each call, disabled by default
+        self.instrumentation = instrumentation or Instrumentation()
+        # records slow calls, see `SlowCallProfiler`
+        self.slow_call_profiler = slow_call_profiler
+        # records the fields filtered & sorted on, see `QueryUsage`
+        self.query_usage = query_usage
+        self.reject_unindexed_filters = reject_unindexed_filters
+        # table size from which unindexed filters are rejected, and the
+        # cache of the table size shared by all workers
+        self.unindexed_filter_min_rows = unindexed_filter_min_rows
+        self.row_count_cache = (
+            RowCountCache(unindexed_filter_count_ttl)
+            if unindexed_filter_min_rows is not None else None
+        )
         self.model_cls = model_cls
         self.manager_cls = manager_cls
         self.db_storage_cls = db_storage_cls
@@ -72,6 +181,42 @@ class AutoCrud(DependencyProvider):
             'create': (create_method_name, create_rpc),
             'update': (update_method_name, update_rpc),
             'delete': (delete_method_name, delete_rpc),
+            'upsert': (upsert_method_name, upsert_rpc),
+            'bulk_upsert': (bulk_upsert_method_name, bulk_upsert_rpc),
+            'changes_since': (changes_since_method_name, changes_since_rpc),
+            'sync': (sync_method_name, sync_rpc),
+        }
+
+        # the maximum number of SQL statements expected of a call, for all
+        # methods or by method name
+        if statement_budget is None:
+            self.statement_budgets = {}
+        elif isinstance(statement_budget, dict):
+            self.statement_budgets = statement_budget
+        else:
+            self.statement_budgets = dict.fromkeys(
+                self.method_config, statement_budget)
+        self.count_statements = count_statements or bool(
+            self.statement_budgets)
+
+        concurrency_config = {
+            'get': get_concurrency,
+            'list': list_concurrency,
+            'page': page_concurrency,
+            'count': count_concurrency,
+            'create': create_concurrency,
+            'update': update_concurrency,
+            'delete': delete_concurrency,
+            'upsert': upsert_concurrency,
+            'bulk_upsert': bulk_upsert_concurrency,
+            'changes_since': changes_since_concurrency,
+            'sync': sync_concurrency,
+        }
+        self.concurrency_limiters = {
+            fn_name: ConcurrencyLimiter.from_config(
+                method_name or fn_name, concurrency_config[fn_name])
+            for fn_name, (method_name, _) in self.method_config.items()
+            if concurrency_config[fn_name]
         }
 
         self.from_serializable = (
@@ -90,17 +235,7 @@ class AutoCrud(DependencyProvider):
         def make_manager_fn(fn_name):
             def _fn(self, *args, **kwargs):
                 """ This is the RPC method that will run on the service """
-                # instantiate a manager instance
-                manager = bound.manager_cls(
-                    bound,  # the provider
-                    self,  # the service instance
-                    db_storage=getattr(self, attr_name),
-                    from_serializable=bound.from_serializable,
-                    to_serializable=bound.to_serializable,
-                    **bound.crud_manager_kwargs
-                )
-                # delegate to the manager method with the same name.
-                return getattr(manager, fn_name)(*args, **kwargs)
+                return bound.call_manager(self, fn_name, args, kwargs)
             return _fn
 
         for mngr_fn_name, (rpc_name, method_rpc) in self.method_config.items():
@@ -109,10 +244,167 @@ class AutoCrud(DependencyProvider):
                 setattr(service_cls, rpc_name, manager_fn)
                 # apply rpc decorator
                 rpc = method_rpc or self.rpc
+                # timeouts & rejected calls are results of the call, not
+                # service errors
+                expected_exceptions = []
+                if mngr_fn_name in self.statement_timeouts:
+                    expected_exceptions.append(QueryTimeout)
+                if mngr_fn_name in self.concurrency_limiters:
+                    expected_exceptions.append(TooManyRequests)
+                if (
+                    method_rpc is None and rpc is nameko_rpc and
+                    expected_exceptions
+                ):
+                    rpc = nameko_rpc(
+                        expected_exceptions=tuple(expected_exceptions))
                 rpc(manager_fn)
 
         return bound
 
+    def make_manager(self, service):
+        """ Instantiate a manager for a call on the service instance. """
+        return self.manager_cls(
+            self,  # the provider
+            service,  # the service instance
+            db_storage=getattr(service, self.attr_name),
+            from_serializable=self.from_serializable,
+            to_serializable=self.to_serializable,
+            **self.crud_manager_kwargs
+        )
+
+    def call_manager(self, service, fn_name, args, kwargs):
+        """ Call the manager method `fn_name` for a generated service method.
+        """
+        limiter = self.concurrency_limiters.get(fn_name)
+        if limiter is None:
+            return self._call_manager(service, fn_name, args, kwargs)
+
+        try:
+            with limiter.limit():
+                return self._call_manager(service, fn_name, args, kwargs)
+        except TooManyRequests:
+            self.stats['rejected.{}'.format(fn_name)] += 1
+            raise
+
+    def _call_manager(self, service, fn_name, args, kwargs):
+        db_storage = getattr(service, self.attr_name)
+
+        timeout = self.statement_timeouts.get(fn_name)
+        if timeout:
+            db_storage.statement_timeout = timeout
+            try:
+                return self._call_storage(
+                    service, db_storage, fn_name, args, kwargs)
+            finally:
+                db_storage.statement_timeout = None
+        return self._call_storage(service, db_storage, fn_name, args, kwargs)
+
+    def _call_storage(self, service, db_storage, fn_name, args, kwargs):
+
+        def call():
+            trace = self.instrumentation.start_call(
+                fn_name, self.model_cls.__name__)
+            with trace.stage('manager'):
+                manager = self.make_manager(service)
+            manager.trace = db_storage.trace = trace
+            try:
+                with self.counting_statements(fn_name), self.profiling(
+                    fn_name, db_storage
+                ):
+                    # delegate to the manager method with the same name.
+                    return getattr(manager, fn_name)(*args, **kwargs)
+            finally:
+                db_storage.trace = NULL_TRACE
+
+        if self.get_batcher is not None and fn_name == 'get':
+            pk = self.get_batch_pk(db_storage, args, kwargs)
+            if pk is not None:
+                call = self.make_batched_get(service, pk, call)
+
+        key = self.get_coalesce_key(fn_name, db_storage, args, kwargs)
+        if key is not None:
+            return self.single_flight.call(key, call)
+        return call()
+
+    @contextmanager
+    def counting_statements(self, fn_name):
+        """ Count the SQL statements executed by a call (if enabled) in the
+            `stats`, and warn about calls exceeding their budget.
+        """
+        if not self.count_statements:
+            yield
+            return
+
+        with statement_counter.counting() as statements:
+            try:
+                yield
+            finally:
+                self.record_statements(fn_name, statements)
+
+    @contextmanager
+    def profiling(self, fn_name, db_storage):
+        """ Record the call if it is slow (and a profiler is set). """
+        if self.slow_call_profiler is None:
+            yield
+            return
+
+        with self.slow_call_profiler.profiling(
+            fn_name, self.model_cls.__name__, db_storage.session
+        ):
+            yield
+
+    def record_statements(self, fn_name, statements):
+        self.stats['statements.{}'.format(fn_name)] += statements.count
+        self.stats['statement_time.{}'.format(fn_name)] += statements.duration
+
+        budget = self.statement_budgets.get(fn_name)
+        if budget is not None and statements.count > budget:
+            self.stats['over_statement_budget.{}'.format(fn_name)] += 1
+            logger.warning(
+                '%s %s executed %s SQL statements (budget %s):\n%s',
+                self.model_cls.__name__, fn_name, statements.count, budget,
+                '\n'.join(stmt.statement for stmt in statements.statements)
+            )
+
+    def get_batch_pk(self, db_storage, args, kwargs):
+        """ Return the primary key of a `get` call that may be batched with
+            other concurrent calls, or None.
+        """
+        if db_storage.has_written:
+            return None
+        try:
+            call_args = getcallargs(
+                self.manager_cls.get, None, *args, **kwargs)
+        except TypeError:
+            return None
+        if call_args.get('use_primary'):
+            return None
+        return call_args['pk']
+
+    def make_batched_get(self, service, pk, call):
+
+        def load_many(pks):
+            return self.make_manager(service).get_many(pks)
+
+        def batched_get():
+            return self.get_batcher.load(pk, load_many, call)
+
+        return batched_get
+
+    def get_coalesce_key(self, fn_name, db_storage, args, kwargs):
+        """ Return the key to coalesce identical concurrent reads on, or None
+            if this call must not be coalesced.
+        """
+        if (
+            self.single_flight is None or
+            fn_name not in COALESCED_METHODS or
+            db_storage.has_written or
+            kwargs.get('use_primary')
+        ):
+            return None
+        return get_call_key(
+            fn_name, getattr(self.manager_cls, fn_name), args, kwargs)
+
     def get_dependency(self, worker_ctx):
         # returns a storage instance without session
         # session is bound to it at worker_setup
@@ -125,6 +417,56 @@ class AutoCrud(DependencyProvider):
         # add required session to the storage
         db_storage = getattr(service, self.attr_name)
         db_storage.session = session
+        db_storage.stats = self.stats
+        db_storage.unit_of_work = self.unit_of_work
+        db_storage.max_limit = self.max_limit
+        db_storage.default_limit = self.default_limit
+        db_storage.query_usage = self.query_usage
+        db_storage.reject_unindexed_filters = self.reject_unindexed_filters
+        db_storage.unindexed_filter_min_rows = self.unindexed_filter_min_rows
+        db_storage.row_count_cache = self.row_count_cache
+        db_storage.deferred_columns = self.deferred_columns
+
+        if self.read_session_accessor:
+            db_storage.read_session = self.read_session_accessor(service)
+
+        if self.unit_of_work:
+            self.wrap_entrypoint(worker_ctx, db_storage)
+
+    def wrap_entrypoint(self, worker_ctx, db_storage):
+        """ Commit (or roll back) all changes made by the worker at once,
+            when its entrypoint method returns (or raises). This is before
+            the result is sent, so a failed commit is the result of the call.
+        """
+        service = worker_ctx.service
+        method_name = worker_ctx.entrypoint.method_name
+        method = getattr(service, method_name)
+
+        @wraps(method)
+        def method_in_unit_of_work(*args, **kwargs):
+            try:
+                result = method(*args, **kwargs)
+            except Exception:
+                db_storage.end_unit_of_work(success=False)
+                raise
+            db_storage.end_unit_of_work()
+            return result
+
+        # shadows the method on this worker's service instance only
+        setattr(service, method_name, method_in_unit_of_work)
+
+    def worker_result(self, worker_ctx, result=None, exc_info=None):
+        if self.unit_of_work:
+            # roll back changes left if the entrypoint method didn't end
+            # (e.g. the worker was killed). Raising here would kill the
+            # container.
+            db_storage = getattr(worker_ctx.service, self.attr_name)
+            try:
+                db_storage.end_unit_of_work(success=False)
+            except Exception:
+                logger.exception(
+                    'Failed to roll back the %s unit of work',
+                    self.model_cls.__name__)
 
 
 class AutoCrudWithEvents(AutoCrud):
@@ -137,7 +479,13 @@ class AutoCrudWithEvents(AutoCrud):
         create_event_name=None,
         update_event_name=None,
         delete_event_name=None,
+        update_event_payload='full',
+        full_update_event_name=None,
         manager_cls=CrudManagerWithEvents,
+        outbox_model=None,
+        outbox_relay_method_name=None,
+        outbox_relay_interval=1,
+        outbox_batch_size=100,
         **kwargs
     ):
         required = [
@@ -150,6 +498,10 @@ class AutoCrudWithEvents(AutoCrud):
                 '`{}` param(s) are missing for {}'.format(
                     missing, type(self).__name__))
 
+        if outbox_relay_method_name and not outbox_model:
+            raise ValueError(
+                '`outbox_model` is required for an outbox relay method')
+
         dispatcher_accessor = get_dependency_accessor(dispatcher_provider)
         super(AutoCrudWithEvents, self).__init__(
             session_provider,
@@ -159,5 +511,235 @@ class AutoCrudWithEvents(AutoCrud):
             create_event_name=create_event_name,
             update_event_name=update_event_name,
             delete_event_name=delete_event_name,
+            update_event_payload=update_event_payload,
+            full_update_event_name=full_update_event_name,
+            outbox_model=outbox_model,
             **kwargs
         )
+        self.dispatcher_accessor = dispatcher_accessor
+        self.outbox_model = outbox_model
+        self.outbox_relay_method_name = outbox_relay_method_name
+        self.outbox_relay_interval = outbox_relay_interval
+        self.outbox_batch_size = outbox_batch_size
+
+    def bind(self, container, attr_name):
+        """
+        Also add a timer method to the service that relays outbox events.
+        """
+        service_cls = container.service_cls
+
+        bound = super(AutoCrudWithEvents, self).bind(container, attr_name)
+
+        method_name = self.outbox_relay_method_name
+        if method_name and not getattr(service_cls, method_name, None):
+
+            def relay_outbox(self):
+                """ This is the timer method that will run on the service """
+                return bound.relay_outbox(self)
+
+            setattr(service_cls, method_name, relay_outbox)
+            timer(interval=self.outbox_relay_interval)(relay_outbox)
+
+        return bound
+
+    def relay_outbox(self, service):
+        """ Dispatch the pending events in the outbox. """
+        return relay_events(
+            self.session_accessor(service),
+            self.outbox_model,
+            self.dispatcher_accessor(service),
+            batch_size=self.outbox_batch_size,
+        )
+
+
+class ShardedAutoCrud(AutoCrud):
+    """ An `AutoCrud` of a model whose rows are split across several
+        databases, see `ShardedDBStorage`.
+
+        `shard_session_providers` are the session providers of the shards,
+        by shard name, and `shard_for(value)` returns the name of the shard
+        of a `shard_field` value (by default, the value itself).
+    """
+
+    # features using methods that `ShardedDBStorage` does not support, which
+    # raise `UnsupportedOperation`
+    UNSUPPORTED_PARAMS = (
+        'read_session_provider', 'changes_since_method_name',
+        'sync_method_name', 'outbox_model',
+    )
+
+    def __init__(
+        self,
+        shard_session_providers,
+        shard_field,
+        shard_for=None,
+        db_storage_cls=ShardedDBStorage,
+        **kwargs
+    ):
+        required = [
+            (shard_session_providers, 'shard_session_providers'),
+            (shard_field, 'shard_field'),
+        ]
+        missing = [name for param, name in required if not param]
+        if missing:
+            raise ValueError(
+                '`{}` param(s) are missing for {}'.format(
+                    missing, type(self).__name__))
+        unsupported = [
+            name for name in self.UNSUPPORTED_PARAMS if kwargs.get(name)]
+        if unsupported:
+            raise ValueError(
+                '`{}` param(s) are not supported by {}'.format(
+                    unsupported, type(self).__name__))
+
+        shards = list(shard_session_providers.items())
+        super(ShardedAutoCrud, self).__init__(
+            # used for the calls made outside of the storage's shards
+            shards[0][1],
+            db_storage_cls=db_storage_cls,
+            **kwargs
+        )
+        model_cls = kwargs['model_cls']
+        if shard_field not in model_cls.__table__.columns.keys():
+            raise ValueError('Unknown shard_field {} of {}'.format(
+                shard_field, model_cls.__name__))
+
+        # store accessors rather than providers, as for `session_provider`
+        self.shard_session_accessors = [
+            (shard, get_dependency_accessor(provider))
+            for shard, provider in shards
+        ]
+        self.shard_field = shard_field
+        self.shard_for = shard_for or (lambda value: value)
+
+    def worker_setup(self, worker_ctx):
+        super(ShardedAutoCrud, self).worker_setup(worker_ctx)
+
+        service = worker_ctx.service
+        db_storage = getattr(service, self.attr_name)
+        db_storage.sessions = {
+            shard: accessor(service)
+            for shard, accessor in self.shard_session_accessors
+        }
+        db_storage.shard_field = self.shard_field
+        db_storage.shard_for = self.shard_for
+
+
+@contextmanager
+def all_atomic(storages):
+    """ Nest the `atomic` blocks of all of `storages`. """
+    if not storages:
+        yield
+        return
+    with storages[0].atomic():
+        with all_atomic(storages[1:]):
+            yield
+
+
+class CrudBatch(DependencyProvider):
+    """ Adds a `method_name` rpc method to the service, running a list of
+        operations in a single worker. Each operation calls a method
+        generated by one of the service's `AutoCrud` providers, e.g.
+        `{'method': 'get_member', 'args': [1], 'kwargs': {}}`.
+    """
+
+    def __init__(
+        self, method_name='crud_batch', rpc=nameko_rpc, max_operations=None
+    ):
+        self.method_name = method_name
+        self.rpc = rpc
+        self.max_operations = max_operations
+
+    def bind(self, container, attr_name):
+        """
+        At bind time, modify the service class to add the batch rpc method.
+        """
+        if attr_name == self.method_name:
+            raise ValueError(
+                'CrudBatch attribute `{}` would hide its method'.format(
+                    attr_name))
+
+        service_cls = container.service_cls
+
+        bound = super(CrudBatch, self).bind(container, attr_name)
+
+        if not getattr(service_cls, self.method_name, None):
+
+            def crud_batch(self, operations, atomic=False):
+                """ This is the RPC method that will run on the service """
+                return bound.run(self, operations, atomic=atomic)
+
+            setattr(service_cls, self.method_name, crud_batch)
+            self.rpc(crud_batch)
+
+        return bound
+
+    def setup(self):
+        self.providers = [
+            provider for provider in self.container.dependencies
+            if isinstance(provider, AutoCrud)
+        ]
+        # the generated method names operations may call
+        self.method_names = {
+            method_name
+            for provider in self.providers
+            for method_name, _ in provider.method_config.values()
+            if method_name
+        }
+
+    def get_dependency(self, worker_ctx):
+
+        def run(operations, atomic=False):
+            return self.run(worker_ctx.service, operations, atomic=atomic)
+
+        return run
+
+    def get_call(self, operation):
+        """ Return the `(method_name, args, kwargs)` of an operation. """
+        if not isinstance(operation, dict):
+            raise ValueError('Invalid operation ({})'.format(operation))
+        method_name = operation.get('method')
+        if method_name not in self.method_names:
+            raise ValueError('Unknown {} method ({})'.format(
+                self.method_name, method_name))
+        return (
+            method_name,
+            operation.get('args') or [],
+            operation.get('kwargs') or {},
+        )
+
+    def run(self, service, operations, atomic=False):
+        """ Run `operations`, returning a result for each: `{'result': ...}`,
+            or `{'error': ...}` with the serialized exception if it failed.
+            With `atomic`, the operations' changes are committed together
+            and the first failure rolls them back and is raised.
+        """
+        if (
+            self.max_operations is not None and
+            len(operations) > self.max_operations
+        ):
+            raise ValueError(
+                'Too many operations ({}), the maximum is {}'.format(
+                    len(operations), self.max_operations))
+        calls = [self.get_call(operation) for operation in operations]
+
+        if atomic:
+            storages = [
+                getattr(service, provider.attr_name)
+                for provider in self.providers
+            ]
+            with all_atomic(storages):
+                return [
+                    {'result': getattr(service, method_name)(*args, **kwargs)}
+                    for method_name, args, kwargs in calls
+                ]
+
+        results = []
+        for method_name, args, kwargs in calls:
+            try:
+                result = getattr(service, method_name)(*args, **kwargs)
+            except Exception as exc:
+                results.append({'error': serialize(exc)})
+            else:
+                results.append({'result': result})
+        return results
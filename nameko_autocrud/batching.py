@@ -0,0 +1,80 @@
+import copy
+
+from eventlet.event import Event
+
+
+def get_pk_key(pk):
+    """ Normalise a primary key, as accepted by `DBStorage.get`, to a tuple
+    """
+    return tuple(pk) if isinstance(pk, (list, tuple)) else (pk,)
+
+
+class Batch(object):
+
+    def __init__(self):
+        self.full = Event()
+        self.results = {}  # pk key -> event
+
+
+class GetBatcher(object):
+    """ Collect concurrent `get` calls into batches, so that all primary keys
+        requested within `window` seconds (or until `max_size` keys are
+        requested) are loaded together in a single query.
+    """
+
+    def __init__(self, window, max_size, stats):
+        self.window = window
+        self.max_size = max_size
+        self.stats = stats
+        self.batch = None
+
+    def load(self, pk, load_many, load_one):
+        """ Return the result for `pk`.
+
+            `load_many` is called with a list of primary key tuples by the
+            first caller in each batch, and returns a dict of the results
+            found, keyed by primary key tuple. `load_one` is called by each
+            caller whose key isn't in those results, e.g. to raise NotFound.
+        """
+        key = get_pk_key(pk)
+
+        batch = self.batch
+        if batch is not None:
+            event = batch.results.get(key)
+            if event is None:
+                event = batch.results[key] = Event()
+                if len(batch.results) >= self.max_size:
+                    self.batch = None
+                    batch.full.send()
+            result = event.wait()
+            return load_one() if result is None else copy.deepcopy(result)
+
+        batch = self.batch = Batch()
+        batch.results[key] = Event()
+        try:
+            if self.max_size > 1:
+                batch.full.wait(self.window)
+            if self.batch is batch:
+                self.batch = None
+
+            self.stats['get_batches'] += 1
+            self.stats['get_batched_keys'] += len(batch.results)
+            results = load_many(list(batch.results))
+        except Exception as exc:
+            for waiting in batch.results.values():
+                waiting.send_exception(exc)
+            raise
+        except BaseException:
+            # e.g. killed, so the waiting callers load their own key
+            for waiting in batch.results.values():
+                waiting.send(None)
+            raise
+        finally:
+            if self.batch is batch:
+                self.batch = None
+
+        for waiting_key, waiting in batch.results.items():
+            waiting.send(results.get(waiting_key))
+
+        result = results.get(key)
+        return load_one() if result is None else result
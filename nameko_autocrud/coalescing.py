@@ -0,0 +1,71 @@
+import copy
+from inspect import getcallargs
+import json
+
+from eventlet.event import Event
+
+
+def get_call_key(fn_name, fn, args, kwargs):
+    """ Return a key identifying a call of the (unbound) method `fn` with
+        `args` and `kwargs`, normalised so that e.g. positional and keyword
+        arguments match. Returns None if the arguments don't match the
+        signature of `fn`.
+    """
+    try:
+        call_args = getcallargs(fn, None, *args, **kwargs)
+    except TypeError:
+        return None
+    call_args.pop('self')
+    return '{}:{}'.format(
+        fn_name, json.dumps(call_args, sort_keys=True, default=repr))
+
+
+# sent to the waiters of a call that ended without a result or exception,
+# e.g. because its greenthread was killed
+ABORTED = object()
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.event = Event()
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """ Coalesce identical concurrent calls so that only the first call is
+        executed. Subsequent calls with the same key wait for it to finish
+        and receive a copy of its result (or its exception).
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.in_flight = {}
+
+    def call(self, key, fn):
+        flight = self.in_flight.get(key)
+        if flight is not None:
+            flight.waiters += 1
+            self.stats['coalesced'] += 1
+            result = flight.event.wait()
+            if result is ABORTED:
+                # the first call didn't finish, so make the call again
+                return self.call(key, fn)
+            return copy.deepcopy(result)
+
+        flight = self.in_flight[key] = Flight()
+        try:
+            result = fn()
+        except Exception as exc:
+            flight.event.send_exception(exc)
+            raise
+        except BaseException:
+            flight.event.send(ABORTED)
+            raise
+        else:
+            flight.event.send(result)
+            # waiters copy the result when they resume, so don't hand the
+            # original to a caller that might modify it in the meantime
+            return copy.deepcopy(result) if flight.waiters else result
+        finally:
+            del self.in_flight[key]
@@ -0,0 +1,292 @@
+""" Filter & sort usage statistics, and advice on missing indexes.
+
+    Usage statistics are collected by passing a `QueryUsage` to `AutoCrud`
+    and can be saved with `QueryUsage.dump`. The advisor reports the fields
+    that are filtered or sorted on without an index::
+
+        python -m nameko_autocrud.indexes usage.json myapp.models:Member
+"""
+import argparse
+from collections import defaultdict
+from importlib import import_module
+import json
+import time
+
+from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint, func, text
+
+# boolean functions of sqlalchemy_filters filter specs
+BOOLEAN_FUNCTIONS = ('and', 'or', 'not')
+
+
+def get_filter_fields(filters, model_name=None):
+    """ Return the `(field, op)` tuples of a sqlalchemy_filters filter spec,
+        excluding those on models other than `model_name`.
+    """
+    if not filters:
+        return []
+    if isinstance(filters, (list, tuple)):
+        return [
+            field for spec in filters
+            for field in get_filter_fields(spec, model_name)
+        ]
+    if not isinstance(filters, dict):
+        # invalid, left for sqlalchemy_filters to report
+        return []
+    for key in BOOLEAN_FUNCTIONS:
+        if key in filters:
+            return get_filter_fields(filters[key], model_name)
+    if (
+        filters.get('model', model_name) != model_name or
+        'field' not in filters
+    ):
+        return []
+    return [(filters['field'], filters.get('op') or '==')]
+
+
+def get_sort_fields(order_by, model_name=None):
+    """ Return the `(field, direction)` tuples of a sqlalchemy_filters sort
+        spec, excluding those on models other than `model_name`.
+    """
+    if not order_by:
+        return []
+    if isinstance(order_by, dict):
+        order_by = [order_by]
+    return [
+        (spec['field'], spec.get('direction') or 'asc') for spec in order_by
+        if isinstance(spec, dict) and 'field' in spec and
+        spec.get('model', model_name) == model_name
+    ]
+
+
+def get_indexed_fields(model_cls):
+    """ Return the names of the columns that lead an index (including the
+        primary key and unique constraints) of the model's table.
+    """
+    table = model_cls.__table__
+    leading_columns = [
+        list(index.columns)[:1] for index in table.indexes
+    ] + [
+        # other constraints, e.g. foreign keys, aren't necessarily indexed
+        list(constraint.columns)[:1] for constraint in table.constraints
+        if isinstance(constraint, (PrimaryKeyConstraint, UniqueConstraint))
+    ]
+    return {col.name for columns in leading_columns for col in columns}
+
+
+class UnindexedFilter(ValueError):
+    pass
+
+
+def check_filters_indexed(model_cls, filters, min_rows=None, count_rows=None):
+    """ Raise `UnindexedFilter` if `filters` use a field without an index.
+
+        With `min_rows`, only tables of at least that many rows are checked,
+        as returned by `count_rows` (called only for unindexed filters).
+    """
+    indexed_fields = get_indexed_fields(model_cls)
+    unindexed = sorted({
+        field for field, _ in get_filter_fields(filters, model_cls.__name__)
+        if field not in indexed_fields
+    })
+    if unindexed and (min_rows is None or count_rows() >= min_rows):
+        raise UnindexedFilter(
+            'Filtering {} on unindexed field(s) {} is not allowed'.format(
+                model_cls.__name__, unindexed))
+
+
+# queries of the planner's estimate of a table's row count, by dialect
+ROW_COUNT_ESTIMATES = {
+    'postgresql': (
+        'SELECT reltuples FROM pg_class WHERE oid = to_regclass(:table)'
+    ),
+    'mysql': (
+        'SELECT table_rows FROM information_schema.tables '
+        'WHERE table_schema = DATABASE() AND table_name = :table'
+    ),
+}
+
+
+def estimate_row_count(session, model_cls):
+    """ Return the number of rows of the model's table, estimated from the
+        table statistics on PostgreSQL & MySQL, and counted otherwise.
+    """
+    table = model_cls.__table__
+    dialect = session.get_bind(mapper=model_cls).dialect.name
+    statement = ROW_COUNT_ESTIMATES.get(dialect)
+    if statement is None:
+        return session.query(func.count()).select_from(table).scalar()
+    estimate = session.execute(
+        text(statement), {'table': table.name}).scalar()
+    # unknown (-1) until the table is first analyzed on PostgreSQL 14+
+    return max(int(estimate or 0), 0)
+
+
+class RowCountCache(object):
+    """ The row count of a table, counted again at most every `ttl`
+        seconds.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._count = None
+        self._counted_at = None
+
+    def get(self, count_rows):
+        now = time.time()
+        if self._counted_at is None or now - self._counted_at >= self.ttl:
+            self._count = count_rows()
+            self._counted_at = now
+        return self._count
+
+
+class Usage(object):
+
+    def __init__(self, count=0, total_time=0, max_time=0):
+        self.count = count
+        self.total_time = total_time
+        self.max_time = max_time
+
+    def record(self, duration):
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+
+class QueryUsage(object):
+    """ Counts the fields & operators filtered on, and the fields sorted on,
+        by `list`, `page` & `count` calls, with the durations of the queries
+        using them.
+    """
+
+    def __init__(self):
+        # by `(model_name, field, op)`
+        self.filters = defaultdict(Usage)
+        # by `(model_name, field, direction)`
+        self.sorts = defaultdict(Usage)
+
+    def record(self, model_name, filters, order_by, duration):
+        for field, op in set(get_filter_fields(filters, model_name)):
+            self.filters[(model_name, field, op)].record(duration)
+        for field, direction in set(get_sort_fields(order_by, model_name)):
+            self.sorts[(model_name, field, direction)].record(duration)
+
+    def to_dict(self):
+        def usage_list(usages, key_names):
+            return [
+                dict(
+                    zip(key_names, key), count=usage.count,
+                    total_time=usage.total_time, max_time=usage.max_time
+                )
+                for key, usage in sorted(usages.items())
+            ]
+
+        return {
+            'filters': usage_list(self.filters, ('model', 'field', 'op')),
+            'sorts': usage_list(
+                self.sorts, ('model', 'field', 'direction')),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        usage = cls()
+        for item in data['filters']:
+            usage.filters[(item['model'], item['field'], item['op'])] = Usage(
+                item['count'], item['total_time'], item['max_time'])
+        for item in data['sorts']:
+            key = (item['model'], item['field'], item['direction'])
+            usage.sorts[key] = Usage(
+                item['count'], item['total_time'], item['max_time'])
+        return usage
+
+    def dump(self, path):
+        with open(path, 'w') as usage_file:
+            json.dump(self.to_dict(), usage_file, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as usage_file:
+            return cls.from_dict(json.load(usage_file))
+
+
+def advise(query_usage, model_classes):
+    """ Return recommended indexes for the fields of `model_classes` that
+        are filtered or sorted on without an index, most costly first.
+    """
+    usages = defaultdict(lambda: {
+        'filter_ops': set(), 'filter_count': 0, 'sort_count': 0,
+        'total_time': 0, 'max_time': 0,
+    })
+    for (model_name, field, op), usage in query_usage.filters.items():
+        field_usage = usages[(model_name, field)]
+        field_usage['filter_ops'].add(op)
+        field_usage['filter_count'] += usage.count
+        field_usage['total_time'] += usage.total_time
+        field_usage['max_time'] = max(field_usage['max_time'], usage.max_time)
+    for (model_name, field, _), usage in query_usage.sorts.items():
+        field_usage = usages[(model_name, field)]
+        field_usage['sort_count'] += usage.count
+        field_usage['total_time'] += usage.total_time
+        field_usage['max_time'] = max(field_usage['max_time'], usage.max_time)
+
+    recommendations = []
+    for model_cls in model_classes:
+        indexed_fields = get_indexed_fields(model_cls)
+        for (model_name, field), field_usage in usages.items():
+            if model_name == model_cls.__name__ and (
+                field not in indexed_fields
+            ):
+                recommendations.append(dict(
+                    field_usage,
+                    model=model_name,
+                    table=model_cls.__table__.name,
+                    field=field,
+                    filter_ops=sorted(field_usage['filter_ops']),
+                ))
+
+    return sorted(
+        recommendations,
+        key=lambda item: (-item['total_time'], item['model'], item['field'])
+    )
+
+
+def format_advice(recommendations):
+    if not recommendations:
+        return 'All filtered and sorted fields are indexed.'
+    lines = []
+    for item in recommendations:
+        uses = []
+        if item['filter_count']:
+            uses.append('filtered {} times ({})'.format(
+                item['filter_count'], ', '.join(item['filter_ops'])))
+        if item['sort_count']:
+            uses.append('sorted {} times'.format(item['sort_count']))
+        lines.append(
+            '{}.{}: {}, {:.3f}s total, {:.3f}s max; '
+            'consider an index on {}({})'.format(
+                item['model'], item['field'], ', '.join(uses),
+                item['total_time'], item['max_time'], item['table'],
+                item['field']))
+    return '\n'.join(lines)
+
+
+def import_model(path):
+    module_name, class_name = path.split(':')
+    return getattr(import_module(module_name), class_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Recommend indexes from saved filter & sort usage.')
+    parser.add_argument('usage', help='usage saved by `QueryUsage.dump`')
+    parser.add_argument(
+        'models', nargs='+', help='model classes, as `module:ClassName`')
+    args = parser.parse_args(argv)
+
+    recommendations = advise(
+        QueryUsage.load(args.usage),
+        [import_model(path) for path in args.models])
+    print(format_advice(recommendations))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
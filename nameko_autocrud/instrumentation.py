@@ -0,0 +1,177 @@
+""" Timing of the stages of CRUD calls.
+
+    Stages:
+    - 'manager': constructing the manager
+    - 'deserialize': `from_serializable`
+    - 'query': building queries
+    - 'execute': executing statements (including flushes & commits)
+    - 'serialize': `to_serializable`
+    - 'dispatch': dispatching events (or adding them to the outbox)
+
+    and the number of rows loaded by each call.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+import time
+
+# upper bounds of histogram buckets
+DURATION_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, float('inf'),
+)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, float('inf'))
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullTrace(object):
+    """ Records nothing, as cheaply as possible. """
+
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def rows(self, count):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class _Stage(object):
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.trace.instrumentation.record_duration(
+            self.trace.method_name, self.trace.model_name, self.name,
+            time.time() - self.start)
+
+
+class CallTrace(object):
+    """ Records the stages of a single call to `instrumentation`. """
+
+    def __init__(self, instrumentation, method_name, model_name):
+        self.instrumentation = instrumentation
+        self.method_name = method_name
+        self.model_name = model_name
+
+    def stage(self, name):
+        """ Return a context manager timing the stage `name`. """
+        return _Stage(self, name)
+
+    def rows(self, count):
+        self.instrumentation.record_rows(
+            self.method_name, self.model_name, count)
+
+
+class Instrumentation(object):
+    """ Base class of instrumentation, which is disabled and records
+        nothing.
+    """
+    enabled = False
+
+    def start_call(self, method_name, model_name):
+        """ Return the trace to record a call of `method_name` with. """
+        if not self.enabled:
+            return NULL_TRACE
+        return CallTrace(self, method_name, model_name)
+
+    def record_duration(self, method_name, model_name, stage, duration):
+        pass
+
+    def record_rows(self, method_name, model_name, count):
+        pass
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        """ Return the upper bound of the bucket containing the `percent`
+            percentile, or None if empty.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        cumulative_counts = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative_counts.append(total)
+        return self.buckets[bisect_left(cumulative_counts, rank)]
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip(self.buckets, self.counts)),
+        }
+
+
+class HistogramInstrumentation(Instrumentation):
+    """ Keeps in-process histograms of stage durations (in seconds) and row
+        counts, by `(method_name, model_name, stage)`. Row counts are under
+        the 'rows' stage.
+    """
+    enabled = True
+
+    def __init__(
+        self, duration_buckets=DURATION_BUCKETS, row_buckets=ROW_BUCKETS
+    ):
+        self.durations = defaultdict(lambda: Histogram(duration_buckets))
+        self.rows = defaultdict(lambda: Histogram(row_buckets))
+
+    def record_duration(self, method_name, model_name, stage, duration):
+        self.durations[(method_name, model_name, stage)].observe(duration)
+
+    def record_rows(self, method_name, model_name, count):
+        self.rows[(method_name, model_name, 'rows')].observe(count)
+
+    def snapshot(self):
+        """ Return the histograms as dicts. """
+        histograms = dict(self.durations)
+        histograms.update(self.rows)
+        return {key: hist.to_dict() for key, hist in histograms.items()}
+
+
+class CallbackInstrumentation(Instrumentation):
+    """ Adapter passing measurements to a collector's callbacks:
+        `on_duration(method_name, model_name, stage, duration)` and
+        `on_rows(method_name, model_name, count)`.
+    """
+    enabled = True
+
+    def __init__(self, on_duration, on_rows=None):
+        self.on_duration = on_duration
+        self.on_rows = on_rows
+
+    def record_duration(self, method_name, model_name, stage, duration):
+        self.on_duration(method_name, model_name, stage, duration)
+
+    def record_rows(self, method_name, model_name, count):
+        if self.on_rows is not None:
+            self.on_rows(method_name, model_name, count)
@@ -0,0 +1,49 @@
+from contextlib import contextmanager
+
+from eventlet.semaphore import Semaphore
+
+
+class TooManyRequests(Exception):
+    pass
+
+
+class ConcurrencyLimiter(object):
+    """ Limit the number of concurrent calls to `max_concurrent`, queueing at
+        most `max_queued` further calls. Calls beyond that are rejected
+        immediately with `TooManyRequests`.
+    """
+
+    def __init__(self, name, max_concurrent, max_queued=0):
+        if max_concurrent < 1 or max_queued < 0:
+            raise ValueError(
+                'Invalid concurrency limit for {} ({}, {})'.format(
+                    name, max_concurrent, max_queued))
+        self.name = name
+        self.max_queued = max_queued
+        self.semaphore = Semaphore(max_concurrent)
+        self.queued = 0
+
+    @classmethod
+    def from_config(cls, name, config):
+        """ Create a limiter from a `max_concurrent` int or a
+            `(max_concurrent, max_queued)` tuple.
+        """
+        if isinstance(config, (list, tuple)):
+            return cls(name, *config)
+        return cls(name, config)
+
+    @contextmanager
+    def limit(self):
+        if not self.semaphore.acquire(blocking=False):
+            if self.queued >= self.max_queued:
+                raise TooManyRequests(
+                    'Too many concurrent {} requests'.format(self.name))
+            self.queued += 1
+            try:
+                self.semaphore.acquire()
+            finally:
+                self.queued -= 1
+        try:
+            yield
+        finally:
+            self.semaphore.release()
@@ -1,8 +1,31 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 import logging
 import math
 
+from .instrumentation import NULL_TRACE
+from .outbox import make_outbox_event
+
+from .serializers import (
+    _get_serializable_value, default_to_serializable,
+    get_default_from_serializable, rows_to_columnar, rows_to_serializable,
+    to_columnar
+)
+from .storage import NotFound
+
 logger = logging.getLogger(__name__)
 
+# How `page` gets the total number of results:
+# - `None`: count, then list
+# - 'concurrent': count in a separate greenthread & session while listing
+# - 'window': select `count(*) OVER ()` with the results, if supported
+PAGE_STRATEGIES = (None, 'concurrent', 'window')
+
+# What update events carry:
+# - 'full': the entity after the update, the entity before & changed fields
+# - 'delta': the primary key & changed fields only, before & after
+UPDATE_EVENT_PAYLOADS = ('full', 'delta')
+
 
 class CrudManager(object):
 
@@ -10,22 +33,146 @@ class CrudManager(object):
         self, provider, service, db_storage=None,
         to_serializable=None,
         from_serializable=None,
+        page_strategy=None,
+        changes_column=None, changes_batch_size=100,
+        sync_batch_size=500,
     ):
+        if page_strategy not in PAGE_STRATEGIES:
+            raise ValueError(
+                'Invalid page_strategy ({})'.format(page_strategy))
+
         self.db_storage = db_storage
         self.to_serializable = to_serializable
         self.from_serializable = from_serializable
+        self.page_strategy = page_strategy
+        # monotonically increasing column (e.g. a version or `updated_at`)
+        # that `changes_since` iterates over
+        self.changes_column = changes_column
+        self.changes_batch_size = changes_batch_size
+        # number of rows loaded per query by `sync`
+        self.sync_batch_size = sync_batch_size
+        # serialized data of the objects in this call, by object id
+        self._serialized = {}
+        # records the stages of the call (see `instrumentation`)
+        self.trace = NULL_TRACE
+
+    def _serialize(self, obj):
+        """ Serialize `obj` with `to_serializable`, at most once between
+            writes.
+        """
+        key = id(obj)
+        if key not in self._serialized:
+            with self.trace.stage('serialize'):
+                data = self.to_serializable(obj)
+            # keep `obj` so that its id isn't reused
+            self._serialized[key] = (obj, data)
+        return self._serialized[key][1]
+
+    def _deserialize(self, data):
+        with self.trace.stage('deserialize'):
+            return self.from_serializable(data)
+
+    def _forget_serialized(self):
+        # objects may be changed by a write
+        self._serialized.clear()
+
+    def get(self, pk, use_primary=False):
+        obj = self.db_storage.get(pk, use_primary=use_primary)
+        with self.trace.stage('serialize'):
+            return self.to_serializable(obj)
+
+    def get_many(self, pks, use_primary=False):
+        """ Return a dict of the serialized instances found for `pks`, keyed
+            by primary key tuple.
+        """
+        objs = self.db_storage.get_many(pks, use_primary=use_primary)
+        with self.trace.stage('serialize'):
+            return {
+                key: self.to_serializable(obj) for key, obj in objs.items()
+            }
+
+    def list(
+        self, filters=None, order_by=None, offset=None, limit=None,
+        use_primary=False, format=None, include_columns=None
+    ):
+        return self._list(
+            filters=filters, order_by=order_by, offset=offset, limit=limit,
+            use_primary=use_primary, format=format,
+            include_columns=include_columns
+        )
+
+    def _list(
+        self, filters=None, order_by=None, offset=None, limit=None,
+        use_primary=False, format=None, with_total=False,
+        include_columns=None
+    ):
+        if format not in (None, 'columnar'):
+            raise ValueError('Invalid format ({})'.format(format))
+
+        list_kwargs = dict(
+            filters=filters, order_by=order_by, offset=offset, limit=limit,
+            use_primary=use_primary
+        )
+        if with_total:
+            list_kwargs['with_total'] = True
+        if include_columns:
+            list_kwargs['include_columns'] = include_columns
 
-    def get(self, pk):
-        obj = self.db_storage.get(pk)
-        return self.to_serializable(obj)
+        if self._can_list_rows():
+            results = self.db_storage.list_rows(**list_kwargs)
+            (columns, rows), total = (
+                results if with_total else (results, None))
+            with self.trace.stage('serialize'):
+                if format == 'columnar':
+                    results = rows_to_columnar(columns, rows)
+                else:
+                    results = rows_to_serializable(columns, rows)
+        else:
+            # deferred columns are left out, rather than loaded one by one
+            exclude = self.db_storage.get_excluded_columns(include_columns)
+            if exclude and self._has_custom_serialization():
+                # which may access any column, so all are loaded by the
+                # query rather than lazily, one instance at a time
+                list_kwargs['include_columns'] = (
+                    self.db_storage.deferred_columns)
+            results = self.db_storage.list(**list_kwargs)
+            results, total = results if with_total else (results, None)
+            with self.trace.stage('serialize'):
+                if format == 'columnar':
+                    results = to_columnar(
+                        results, self.to_serializable, exclude)
+                elif exclude and (
+                    self.to_serializable is default_to_serializable
+                ):
+                    results = [
+                        default_to_serializable(obj, exclude)
+                        for obj in results
+                    ]
+                else:
+                    results = [self.to_serializable(obj) for obj in results]
 
-    def list(self, filters=None, order_by=None, offset=None, limit=None):
-        results = self.db_storage.list(
-            filters=filters, order_by=order_by, offset=offset, limit=limit
+        if with_total:
+            return results, total
+        return results
+
+    def _has_custom_serialization(self):
+        return (
+            self.to_serializable is not default_to_serializable or
+            hasattr(self.db_storage.model_cls, 'to_dict')
+        )
+
+    def _can_list_rows(self):
+        # model instances are only needed for custom serialization or a
+        # customized storage query
+        return (
+            not self._has_custom_serialization() and
+            getattr(self.db_storage, 'supports_list_rows', False)
         )
-        return [self.to_serializable(result) for result in results]
 
-    def page(self, page_size, page_num, filters=None, order_by=None):
+    def page(
+        self, page_size, page_num, filters=None, order_by=None,
+        use_primary=False, format=None, include_columns=None
+    ):
         if page_size < 1:
             raise ValueError('Invalid page_size ({})'.format(page_size))
         if page_num < 1:
@@ -33,11 +180,40 @@ class CrudManager(object):
 
         offset = page_size * (page_num - 1)
         limit = page_size
-        total = self.count(filters=filters)
-        num_pages = math.ceil(total / page_size)
-        results = self.list(
-            filters=filters, order_by=order_by, offset=offset, limit=limit
+        list_kwargs = dict(
+            filters=filters, order_by=order_by, offset=offset, limit=limit,
+            use_primary=use_primary, format=format,
+            include_columns=include_columns
         )
+
+        total = None
+        count_thread = None
+        if (
+            self.page_strategy == 'window' and
+            self.db_storage.supports_window_count(use_primary=use_primary)
+        ):
+            results, total = self._list(with_total=True, **list_kwargs)
+        else:
+            if self.page_strategy == 'concurrent':
+                count_thread = self.db_storage.spawn_count(
+                    filters=filters, use_primary=use_primary)
+            if count_thread is None:
+                total = self.count(filters=filters, use_primary=use_primary)
+            try:
+                results = self._list(**list_kwargs)
+            except BaseException:
+                # don't leave the count running after the call
+                if count_thread is not None:
+                    count_thread.kill()
+                raise
+
+        if count_thread is not None:
+            total = count_thread.wait()
+        elif total is None:
+            # no results on this page to carry the total
+            total = self.count(filters=filters, use_primary=use_primary)
+
+        num_pages = int(math.ceil(total / float(page_size)))
         return {
             'results': results,
             'num_pages': num_pages,
@@ -45,28 +221,126 @@ class CrudManager(object):
             'page_num': page_num,
         }
 
-    def count(self, filters=None):
-        return self.db_storage.count(filters=filters)
+    def count(self, filters=None, use_primary=False):
+        return self.db_storage.count(filters=filters, use_primary=use_primary)
 
-    def update(self, pk, data):
-        data = self.from_serializable(data)
+    def changes_since(self, cursor=None, limit=None, use_primary=False):
+        """ Return a batch of the instances changed after `cursor` (from the
+            start if None), in `changes_column` order, with the cursor of the
+            next batch and whether there are more changes.
+        """
+        if limit is None:
+            limit = self.changes_batch_size
+        if not 0 < limit <= self.changes_batch_size:
+            raise ValueError('Invalid limit ({}), the maximum is {}'.format(
+                limit, self.changes_batch_size))
+
+        objs = self.db_storage.changes_since(
+            self.changes_column,
+            cursor=None if cursor is None else self._parse_cursor(cursor),
+            # one more, to tell if there are more changes
+            limit=limit + 1,
+            use_primary=use_primary,
+        )
+        more = len(objs) > limit
+        objs = objs[:limit]
+
+        with self.trace.stage('serialize'):
+            results = [self.to_serializable(obj) for obj in objs]
+        return {
+            'results': results,
+            'cursor': self._get_cursor(objs[-1]) if objs else cursor,
+            'more': more,
+        }
+
+    def _get_cursor_names(self):
+        return [self.changes_column] + self.db_storage.pk_names
+
+    def _get_cursor(self, obj):
+        return [
+            _get_serializable_value(getattr(obj, name))
+            for name in self._get_cursor_names()
+        ]
+
+    def _parse_cursor(self, cursor):
+        names = self._get_cursor_names()
+        if not isinstance(cursor, (list, tuple)) or len(cursor) != len(names):
+            raise ValueError('Invalid cursor ({})'.format(cursor))
+        from_serializable = get_default_from_serializable(
+            self.db_storage.model_cls)
+        values = from_serializable(dict(zip(names, cursor)))
+        return tuple(values[name] for name in names)
+
+    def _update_object(self, pk, data):
+        data = self._deserialize(data)
         updated_obj = self.db_storage.update(pk, data)
-        updated_data = self.to_serializable(updated_obj)
-        return updated_data
+        self._forget_serialized()
+        return updated_obj
+
+    def update(self, pk, data):
+        updated_obj = self._update_object(pk, data)
+        return self._serialize(updated_obj)
 
     def _create_object(self, data):
-        data = self.from_serializable(data)
-        return self.db_storage.create(data)
+        data = self._deserialize(data)
+        created_obj = self.db_storage.create(data)
+        self._forget_serialized()
+        return created_obj
 
     def create(self, data):
         created_obj = self._create_object(data)
-        return self.to_serializable(created_obj)
+        return self._serialize(created_obj)
 
-    def delete(self, pk):
-        deleted_data = self.get(pk)
+    def _delete_object(self, pk):
         self.db_storage.delete(pk)
+        self._forget_serialized()
+
+    def delete(self, pk):
+        deleted_data = self.get(pk, use_primary=True)
+        self._delete_object(pk)
         return deleted_data
 
+    def _upsert_objects(self, data_list):
+        upserted_objs = self.db_storage.bulk_upsert(data_list)
+        self._forget_serialized()
+        return upserted_objs
+
+    def upsert(self, data):
+        data = self._deserialize(data)
+        upserted_obj = self.db_storage.upsert(data)
+        self._forget_serialized()
+        return self._serialize(upserted_obj)
+
+    def bulk_upsert(self, data_list):
+        data_list = [self._deserialize(data) for data in data_list]
+        upserted_objs = self._upsert_objects(data_list)
+        return [self._serialize(obj) for obj in upserted_objs]
+
+    def _apply_sync(self, plan):
+        created_objs = self.db_storage.apply_sync(plan)
+        self._forget_serialized()
+        return created_objs
+
+    def sync(self, data_list, delete_missing=False, filters=None):
+        """ Make the stored instances match `data_list`, creating, updating
+            (only the changed fields) and, with `delete_missing`, deleting
+            the instances matching `filters` that are not in `data_list`,
+            in a single transaction. Returns the number of instances of each
+            action.
+        """
+        data_list = [self._deserialize(data) for data in data_list]
+        with self.db_storage.atomic():
+            plan = self.db_storage.plan_sync(
+                data_list, delete_missing=delete_missing, filters=filters,
+                batch_size=self.sync_batch_size)
+            self._apply_sync(plan)
+        return {
+            'created': len(plan.creates),
+            'updated': len(plan.updates),
+            'deleted': len(plan.deletes),
+            'unchanged': plan.unchanged,
+        }
+
 
 class CrudManagerWithEvents(CrudManager):
 
@@ -74,11 +348,17 @@ class CrudManagerWithEvents(CrudManager):
         self, provider, service,
         event_entity_name=None, dispatcher_accessor=None,
         create_event_name=None, update_event_name=None, delete_event_name=None,
-        to_event_serializable=None, **kwargs
+        to_event_serializable=None, outbox_model=None,
+        update_event_payload='full', full_update_event_name=None, **kwargs
     ):
         super(CrudManagerWithEvents, self).__init__(
             provider, service, **kwargs)
 
+        if update_event_payload not in UPDATE_EVENT_PAYLOADS:
+            raise ValueError(
+                'Invalid update_event_payload ({})'.format(
+                    update_event_payload))
+
         self.event_entity_name = event_entity_name
         self.dispatcher = dispatcher_accessor(service)
         self.to_event_serializable = (
@@ -87,44 +367,173 @@ class CrudManagerWithEvents(CrudManager):
         self.create_event_name = create_event_name
         self.update_event_name = update_event_name
         self.delete_event_name = delete_event_name
+        self.update_event_payload = update_event_payload
+        # in 'delta' mode, full update events can still be dispatched with
+        # this name for subscribers that need the whole entity
+        self.full_update_event_name = full_update_event_name
+        # optional model of the outbox table events are written to
+        self.outbox_model = outbox_model
+
+    def _event_serialize(self, obj):
+        if self.to_event_serializable is self.to_serializable:
+            # share the response data, copied so changes made to an event
+            # payload don't affect it
+            return dict(self._serialize(obj))
+        with self.trace.stage('serialize'):
+            return self.to_event_serializable(obj)
+
+    @contextmanager
+    def _writing(self):
+        # with an outbox, changes & their events are committed together
+        if self.outbox_model is None:
+            yield
+        else:
+            with self.db_storage.atomic():
+                yield
 
     def _dispatch_event(self, event_name, object_data, payload=None):
         if event_name:
             payload = payload or {}
             payload.update({self.event_entity_name: object_data})
-            self.dispatcher(event_name, payload)
-            logger.info('dispatched event: %s', event_name)
 
-    def update(self, pk, data):
-        before_obj = self.db_storage.get(pk)
-        before_data = self.to_event_serializable(before_obj)
+            if self.outbox_model is not None:
+                # published later by the outbox relay
+                with self.trace.stage('dispatch'):
+                    self.db_storage.add(make_outbox_event(
+                        self.outbox_model, event_name, payload))
+                return
 
-        updated_data = super(CrudManagerWithEvents, self).update(pk, data)
+            def dispatch():
+                with self.trace.stage('dispatch'):
+                    self.dispatcher(event_name, payload)
+                logger.info('dispatched event: %s', event_name)
 
-        after_obj = self.db_storage.get(pk)
-        after_data = self.to_event_serializable(after_obj)
+            # events must not be dispatched for uncommitted changes
+            self.db_storage.on_commit(dispatch)
 
+    def _dispatch_update_event(self, before_data, after_data):
         if before_data != after_data:
             changed = [
                 field for field in sorted(set(before_data).union(after_data))
                 if before_data.get(field) != after_data.get(field)
             ]
-            payload = {'changed': changed, 'before': before_data}
+            full_payload = {'changed': changed, 'before': before_data}
+            if self.update_event_payload == 'full':
+                self._dispatch_event(
+                    self.update_event_name, after_data, payload=full_payload)
+                return
+
+            # only the primary key & changed fields
+            delta_fields = [
+                name for name in self.db_storage.pk_names
+                if name in after_data
+            ] + changed
+            delta_payload = {
+                'changed': changed,
+                'before': {field: before_data.get(field) for field in changed}
+            }
             self._dispatch_event(
-                self.update_event_name, after_data, payload=payload
+                self.update_event_name,
+                {field: after_data.get(field) for field in delta_fields},
+                payload=delta_payload
             )
+            self._dispatch_event(
+                self.full_update_event_name, after_data, payload=full_payload)
+
+    def _dispatch_upsert_event(self, before_data, after_obj):
+        after_data = self._event_serialize(after_obj)
+        if before_data is None:
+            self._dispatch_event(self.create_event_name, after_data)
+        else:
+            self._dispatch_update_event(before_data, after_data)
+
+    def _get_event_data_or_none(self, data):
+        # the `before` state of an upsert, or None if the row doesn't exist
+        try:
+            before_obj = self.db_storage.get(
+                self.db_storage.pk_from_data(data), use_primary=True)
+        except NotFound:
+            return None
+        return self._event_serialize(before_obj)
+
+    def update(self, pk, data):
+        with self._writing():
+            before_obj = self.db_storage.get(pk, use_primary=True)
+            before_data = self._event_serialize(before_obj)
+
+            # the updated instance reflects the change, no need to get it
+            updated_obj = self._update_object(pk, data)
+            after_data = self._event_serialize(updated_obj)
+
+            self._dispatch_update_event(before_data, after_data)
 
-        return updated_data
+        return self._serialize(updated_obj)
 
     def create(self, data):
-        created_obj = super(CrudManagerWithEvents, self)._create_object(data)
-        event_data = self.to_event_serializable(created_obj)
-        self._dispatch_event(self.create_event_name, event_data)
-        return self.to_serializable(created_obj)
+        with self._writing():
+            created_obj = self._create_object(data)
+            event_data = self._event_serialize(created_obj)
+            self._dispatch_event(self.create_event_name, event_data)
+        return self._serialize(created_obj)
 
     def delete(self, pk):
-        before_obj = self.db_storage.get(pk)
-        before_event = self.to_event_serializable(before_obj)
-        deleted_data = super(CrudManagerWithEvents, self).delete(pk)
-        self._dispatch_event(self.delete_event_name, before_event)
+        with self._writing():
+            before_obj = self.db_storage.get(pk, use_primary=True)
+            deleted_data = self._serialize(before_obj)
+            before_event = self._event_serialize(before_obj)
+            self._delete_object(pk)
+            self._dispatch_event(self.delete_event_name, before_event)
         return deleted_data
+
+    def upsert(self, data):
+        data = self._deserialize(data)
+        with self._writing():
+            before_data = self._get_event_data_or_none(data)
+            upserted_obj = self.db_storage.upsert(data)
+            self._forget_serialized()
+            self._dispatch_upsert_event(before_data, upserted_obj)
+        return self._serialize(upserted_obj)
+
+    def bulk_upsert(self, data_list):
+        data_list = [self._deserialize(data) for data in data_list]
+        with self._writing():
+            # a single event per row, even if several records upsert it
+            keys = [
+                self.db_storage.pk_key_from_data(data) for data in data_list
+            ]
+            unique_keys = list(OrderedDict.fromkeys(keys))
+            # the `before` state of the rows that exist, in a single query
+            before_objs = self.db_storage.get_many(
+                unique_keys, use_primary=True)
+            before_data = {
+                key: self._event_serialize(obj)
+                for key, obj in before_objs.items()
+            }
+
+            upserted_objs = self._upsert_objects(data_list)
+            upserted_by_key = dict(zip(keys, upserted_objs))
+            for key in unique_keys:
+                self._dispatch_upsert_event(
+                    before_data.get(key), upserted_by_key[key])
+        return [self._serialize(obj) for obj in upserted_objs]
+
+    def _apply_sync(self, plan):
+        # only real changes produce events
+        before_data_list = [
+            self._event_serialize(obj) for obj, _ in plan.updates
+        ]
+        deleted_data_list = [
+            self._event_serialize(obj) for obj in plan.deletes
+        ]
+
+        created_objs = super(CrudManagerWithEvents, self)._apply_sync(plan)
+
+        for obj in created_objs:
+            self._dispatch_event(
+                self.create_event_name, self._event_serialize(obj))
+        for before_data, (obj, _) in zip(before_data_list, plan.updates):
+            self._dispatch_update_event(
+                before_data, self._event_serialize(obj))
+        for deleted_data in deleted_data_list:
+            self._dispatch_event(self.delete_event_name, deleted_data)
+        return created_objs
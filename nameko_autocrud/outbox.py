@@ -0,0 +1,66 @@
+""" Transactional outbox: events are written to a table in the same
+    transaction as the changes they describe, and published by a relay.
+"""
+from datetime import datetime
+import json
+import logging
+
+from sqlalchemy import Column, DateTime, Integer, String, Text
+
+logger = logging.getLogger(__name__)
+
+
+def make_outbox_model(base, tablename='autocrud_outbox'):
+    """ Return an outbox model class declared on the declarative `base`. """
+
+    class OutboxEvent(base):
+        __tablename__ = tablename
+
+        id = Column(Integer, primary_key=True)
+        event_type = Column(String(255), nullable=False)
+        payload = Column(Text, nullable=False)
+        created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+        sent_at = Column(DateTime, nullable=True, index=True)
+
+    return OutboxEvent
+
+
+def make_outbox_event(outbox_model, event_type, payload):
+    """ Return a new (pending) outbox row for an event. """
+    return outbox_model(event_type=event_type, payload=json.dumps(payload))
+
+
+def relay_events(session, outbox_model, dispatch, batch_size=100):
+    """ Dispatch pending outbox events in the order they were written, in
+        batches of `batch_size`, marking each as sent. Returns the number of
+        events dispatched.
+
+        Each batch is committed once dispatched, including when a dispatch
+        fails part way through, so events are delivered at least once.
+        Pending rows are locked (skipping rows locked by another relay) where
+        the database supports it.
+    """
+    dispatched = 0
+    while True:
+        events = (
+            session.query(outbox_model)
+            .filter(outbox_model.sent_at.is_(None))
+            .order_by(outbox_model.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        try:
+            for event in events:
+                dispatch(event.event_type, json.loads(event.payload))
+                event.sent_at = datetime.utcnow()
+                dispatched += 1
+        finally:
+            session.commit()
+
+        if len(events) < batch_size:
+            break
+
+    if dispatched:
+        logger.info('relayed %s outbox event(s)', dispatched)
+    return dispatched
@@ -0,0 +1,179 @@
+""" Capture of profiles of slow calls. """
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import json
+import logging
+import os
+import pstats
+import time
+import uuid
+
+try:
+    # pstats writes `str`, i.e. bytes on Python 2
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from .statements import statement_counter
+
+logger = logging.getLogger(__name__)
+
+# methods whose SELECT statements may be explained
+EXPLAINED_METHODS = ('list', 'page', 'count')
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+# number of functions included in the profile summary
+PROFILE_SUMMARY_LINES = 40
+
+
+class SlowCallProfiler(object):
+    """ Records calls taking longer than `threshold` seconds to a file in
+        `directory`, keeping the most recent `max_files`.
+
+        Each record has the SQL statements executed by the call (with their
+        durations), a cProfile summary (also saved as a `.prof` file) and,
+        with `explain`, the query plans of `list`, `page` & `count`
+        statements.
+
+        cProfile profiles all greenthreads of the process, so only one call
+        is profiled at a time; slow calls made while another is profiled are
+        recorded without a profile. Set `profile` to False to never profile.
+    """
+
+    def __init__(
+        self, directory, threshold, max_files=100, explain=False,
+        profile=True
+    ):
+        if max_files < 1:
+            raise ValueError('Invalid max_files ({})'.format(max_files))
+        self.directory = directory
+        self.threshold = threshold
+        self.max_files = max_files
+        self.explain = explain
+        self.profile = profile
+        self._profiling = False
+
+    def _start_profile(self):
+        if not self.profile or self._profiling:
+            return None
+        self._profiling = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def _stop_profile(self, profile):
+        if profile is not None:
+            profile.disable()
+            self._profiling = False
+
+    @contextmanager
+    def profiling(self, method_name, model_name, session):
+        """ Record the call within this context if it is slow. """
+        profile = self._start_profile()
+        start = time.time()
+        try:
+            with statement_counter.counting() as statements:
+                yield
+        finally:
+            self._stop_profile(profile)
+            duration = time.time() - start
+            if duration >= self.threshold:
+                self._record(
+                    method_name, model_name, session, duration, statements,
+                    profile)
+
+    def _record(
+        self, method_name, model_name, session, duration, statements, profile
+    ):
+        # failing to record must not change the result of the call
+        try:
+            explained = (
+                self._explain(session, statements)
+                if self.explain and method_name in EXPLAINED_METHODS
+                else None
+            )
+            self._write(
+                method_name, model_name, duration, statements, profile,
+                explained)
+        except Exception:
+            logger.exception(
+                'failed to record slow call: %s %s', model_name, method_name)
+
+    def _explain(self, session, statements):
+        dialect_name = session.get_bind().dialect.name
+        prefix = EXPLAIN_PREFIXES.get(dialect_name)
+        if prefix is None:
+            return None
+
+        plans = []
+        for stmt in statements.statements:
+            if not stmt.statement.lstrip().upper().startswith('SELECT'):
+                continue
+            try:
+                rows = session.connection().execute(
+                    prefix + stmt.statement, stmt.parameters).fetchall()
+                plan = [list(row) for row in rows]
+            except Exception as exc:
+                plan = 'failed to explain: {}'.format(exc)
+            plans.append({'statement': stmt.statement, 'plan': plan})
+        return plans
+
+    def _write(
+        self, method_name, model_name, duration, statements, profile,
+        explained
+    ):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        name = '{}_{}_{}_{}'.format(
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), model_name,
+            method_name, uuid.uuid4().hex[:8])
+        record = {
+            'method': method_name,
+            'model': model_name,
+            'duration': duration,
+            'statements': [
+                {
+                    'statement': stmt.statement,
+                    'parameters': repr(stmt.parameters),
+                    'duration': stmt.duration,
+                }
+                for stmt in statements.statements
+            ],
+            'explain': explained,
+            'profile': None,
+        }
+        if profile is not None:
+            profile.dump_stats(
+                os.path.join(self.directory, '{}.prof'.format(name)))
+            summary = StringIO()
+            pstats.Stats(profile, stream=summary).sort_stats(
+                'cumulative').print_stats(PROFILE_SUMMARY_LINES)
+            record['profile'] = summary.getvalue()
+
+        path = os.path.join(self.directory, '{}.json'.format(name))
+        with open(path, 'w') as record_file:
+            json.dump(record, record_file, indent=2, default=repr)
+        logger.warning(
+            'slow call: %s %s took %.3fs, recorded to %s',
+            model_name, method_name, duration, path)
+
+        self._rotate()
+
+    def _rotate(self):
+        # file names start with the time recorded
+        records = sorted(
+            name for name in os.listdir(self.directory)
+            if name.endswith('.json')
+        )
+        for name in records[:len(records) - self.max_files]:
+            base = os.path.join(self.directory, name[:-len('.json')])
+            for path in (base + '.json', base + '.prof'):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,36 @@
+""" Compact, immutable records of table rows, for in-process reads that
+    don't need model instances.
+"""
+from collections import namedtuple
+from weakref import WeakKeyDictionary
+
+# named tuple classes by model class, then by fields
+_record_classes = WeakKeyDictionary()
+
+
+def get_record_cls(model_cls, fields=None):
+    """ Return the named tuple class of the records of `model_cls` with
+        `fields`, by default all of its table columns in table order. The
+        class is created once per model & fields and named after the model,
+        e.g. `MemberRecord`. Fields that aren't valid attribute names (e.g.
+        `class` or `_hidden`) are renamed to their position, e.g. `_1`, and
+        the column names are kept as `_column_names`.
+    """
+    column_names = [col.name for col in model_cls.__table__.columns]
+    if fields is None:
+        fields = column_names
+    else:
+        fields = list(fields)
+        unknown = [name for name in fields if name not in column_names]
+        if unknown:
+            raise ValueError('Unknown field(s) {} of {}'.format(
+                unknown, model_cls.__name__))
+
+    classes = _record_classes.setdefault(model_cls, {})
+    key = tuple(fields)
+    if key not in classes:
+        record_cls = namedtuple(
+            '{}Record'.format(model_cls.__name__), fields, rename=True)
+        record_cls._column_names = key
+        classes[key] = record_cls
+    return classes[key]
@@ -8,30 +8,103 @@ import sqlalchemy as sa
 from sqlalchemy_utils import ChoiceType
 
 
-def default_to_serializable(obj):
+def _get_serializable_value(val):
+    if val is None:
+        return None
+    if isinstance(val, (str, int, float, bool, list, dict)):
+        return val
+    # TODO- can't use Enum in py2
+    if isinstance(val, Enum):
+        return val.value
+    if isinstance(val, (date, datetime)):
+        return val.isoformat()
+    return str(val)
+
+
+def default_to_serializable(obj, exclude=()):
     """ Convert a sqlalchemy model instance to a dict ready for serialization.
+        Fields in `exclude` (e.g. deferred columns) are left out.
     """
     try:
         dict_ = obj.to_dict()
     except AttributeError:
         dict_ = {
             col.name: getattr(obj, col.name)
-            for col in obj.__table__.columns
+            for col in obj.__table__.columns if col.name not in exclude
         }
 
-    def get_value(val):
-        if val is None:
-            return None
-        if isinstance(val, (str, int, float, bool, list, dict)):
-            return val
-        # TODO- can't use Enum in py2
-        if isinstance(val, Enum):
-            return val.value
-        if isinstance(val, (date, datetime)):
-            return val.isoformat()
-        return str(val)
-
-    return {field: get_value(val) for field, val in dict_.items()}
+    return {
+        field: _get_serializable_value(val) for field, val in dict_.items()
+        if field not in exclude
+    }
+
+
+def to_columnar(objs, to_serializable=default_to_serializable, exclude=()):
+    """ Convert a list of sqlalchemy model instances to the compact
+        `{'columns': [...], 'rows': [[...], ...]}` form, where each field name
+        appears only once. Fields in `exclude` are left out by the default
+        serializer.
+    """
+    if (
+        objs and to_serializable is default_to_serializable and
+        not hasattr(objs[0], 'to_dict')
+    ):
+        # build the rows straight from the table columns rather than
+        # serializing a dict per instance.
+        columns = [
+            col.name for col in objs[0].__table__.columns
+            if col.name not in exclude
+        ]
+        rows = [
+            [_get_serializable_value(getattr(obj, name)) for name in columns]
+            for obj in objs
+        ]
+        return {'columns': columns, 'rows': rows}
+
+    if to_serializable is default_to_serializable:
+        dicts = [to_serializable(obj, exclude) for obj in objs]
+    else:
+        dicts = [to_serializable(obj) for obj in objs]
+    columns = []
+    for dict_ in dicts:
+        columns.extend(
+            field for field in sorted(dict_) if field not in columns
+        )
+    rows = [[dict_.get(field) for field in columns] for dict_ in dicts]
+    return {'columns': columns, 'rows': rows}
+
+
+def rows_to_serializable(columns, rows):
+    """ Convert `(column_names, rows)` as returned by `DBStorage.list_rows`
+        into a list of dicts, as `default_to_serializable` would.
+    """
+    return [
+        {
+            name: _get_serializable_value(val)
+            for name, val in zip(columns, row)
+        }
+        for row in rows
+    ]
+
+
+def rows_to_columnar(columns, rows):
+    """ Convert `(column_names, rows)` as returned by `DBStorage.list_rows`
+        into the columnar form of `to_columnar`.
+    """
+    return {
+        'columns': list(columns),
+        'rows': [
+            [_get_serializable_value(val) for val in row] for row in rows
+        ],
+    }
+
+
+def from_columnar(data):
+    """ Client-side helper to convert a columnar result back into a list of
+        dicts.
+    """
+    columns = data['columns']
+    return [dict(zip(columns, row)) for row in data['rows']]
 
 
 def get_default_from_serializable(model_cls):
@@ -0,0 +1,442 @@
+""" Storage of a model whose rows are split across several databases. """
+import eventlet
+
+from .batching import get_pk_key
+from .indexes import get_sort_fields
+from .storage import DBStorage, NotFound
+
+
+class UnsupportedOperation(NotImplementedError):
+    pass
+
+
+def get_filter_values(filters, field, model_name=None):
+    """ Return the set of values of `field` that rows matching a
+        sqlalchemy_filters filter spec may have, or None if `filters` don't
+        restrict it (to `==` or `in` values).
+    """
+    if not filters:
+        return None
+    if isinstance(filters, (list, tuple)):
+        # all of the filters must match
+        values = None
+        for spec in filters:
+            spec_values = get_filter_values(spec, field, model_name)
+            if spec_values is not None:
+                values = (
+                    spec_values if values is None else values & spec_values)
+        return values
+    if not isinstance(filters, dict):
+        return None
+    if 'and' in filters:
+        return get_filter_values(filters['and'], field, model_name)
+    if 'or' in filters:
+        branches = [
+            get_filter_values(spec, field, model_name)
+            for spec in filters['or']
+        ]
+        if not branches or any(values is None for values in branches):
+            return None
+        return set().union(*branches)
+    if (
+        filters.get('field') != field or
+        filters.get('model', model_name) != model_name
+    ):
+        return None
+
+    try:
+        if filters.get('op') in ('==', 'eq'):
+            return {filters['value']}
+        if filters.get('op') == 'in':
+            return set(filters['value'])
+    except (KeyError, TypeError):
+        # invalid, or unhashable values
+        pass
+    return None
+
+
+# dialects sorting nulls first (and last in descending order) by default,
+# which don't support `NULLS FIRST` / `NULLS LAST`
+NULLS_FIRST_DIALECTS = ('mysql',)
+
+
+def _sort_key(value):
+    # nulls sort first, as on SQLite & MySQL
+    return (value is not None, value)
+
+
+def merge_sorted(results, sort_fields, get_value, offset=None, limit=None):
+    """ Merge the sorted `results` of several shards in `sort_fields` order,
+        then apply `offset` & `limit`.
+    """
+    items = [item for result in results for item in result]
+    # sorts are stable, so sort by the last field first
+    for field, direction in reversed(sort_fields):
+        items.sort(
+            key=lambda item: _sort_key(get_value(item, field)),
+            reverse=direction == 'desc')
+    start = offset or 0
+    return items[start:start + limit] if limit else items[start:]
+
+
+class ShardedDBStorage(DBStorage):
+    """ A `DBStorage` of a model whose rows are split across several
+        databases (shards) by the value of its `shard_field`.
+
+        `sessions` are the sessions of the shards, by shard name, and
+        `shard_for(value)` returns the name of the shard holding the rows
+        with a `shard_field` value.
+
+        Creates, upserts and calls for a primary key including the
+        `shard_field` go to a single shard; other primary keys are looked up
+        on all shards. Listing and counting query the shards (only those
+        allowed by `==` or `in` filters on the `shard_field`) concurrently
+        and merge the results. Changes to several shards are committed
+        separately, one shard after the other.
+    """
+
+    # the storage of each shard
+    shard_storage_cls = DBStorage
+
+    # attributes of this storage applying to the storage of each shard
+    SHARED_ATTRIBUTES = (
+        'stats', 'unit_of_work', 'statement_timeout', 'deferred_columns',
+    )
+
+    def __init__(
+        self, model_cls, sessions=None, shard_field=None, shard_for=None,
+        **kwargs
+    ):
+        super(ShardedDBStorage, self).__init__(model_cls, **kwargs)
+        self.sessions = sessions or {}
+        self.shard_field = shard_field
+        self.shard_for = shard_for
+        self._shard_storages = {}
+
+    def shard(self, name):
+        """ Return the storage of the shard `name`. """
+        storage = self._shard_storages.get(name)
+        if storage is None:
+            storage = self.shard_storage_cls(
+                self.model_cls, session=self.sessions[name])
+            self._shard_storages[name] = storage
+        for attr in self.SHARED_ATTRIBUTES:
+            setattr(storage, attr, getattr(self, attr))
+        return storage
+
+    @property
+    def supports_list_rows(self):
+        return (
+            self.shard_storage_cls.query is DBStorage.query and
+            self.shard_storage_cls.list == DBStorage.list and
+            type(self).list == ShardedDBStorage.list
+        )
+
+    def _fan_out(self, shards, fn):
+        """ Call `fn(shard, storage)` for each of `shards`, concurrently if
+            there are several, returning the results in the same order.
+        """
+        storages = [self.shard(shard) for shard in shards]
+        with self.trace.stage('execute'):
+            if len(shards) == 1:
+                return [fn(shards[0], storages[0])]
+
+            threads = [
+                eventlet.spawn(fn, shard, storage)
+                for shard, storage in zip(shards, storages)
+            ]
+            results = []
+            error = None
+            for thread in threads:
+                # wait for all shards, so that none is still using its
+                # session when this call ends
+                try:
+                    results.append(thread.wait())
+                except Exception as exc:
+                    error = error or exc
+        if error is not None:
+            raise error
+        return results
+
+    def _pk_shard(self, pk):
+        # the shard of a primary key, if it includes the `shard_field`
+        pk_names = self.pk_names
+        if self.shard_field not in pk_names:
+            return None
+        return self.shard_for(
+            get_pk_key(pk)[pk_names.index(self.shard_field)])
+
+    def _data_shard(self, data):
+        value = data.get(self.shard_field)
+        shard = None if value is None else self.shard_for(value)
+        if shard not in self.sessions:
+            raise ValueError('No shard for {} with {} {}'.format(
+                self.model_cls.__name__, self.shard_field, value))
+        return shard
+
+    def _find_shard(self, pk, use_primary=False):
+        """ Return the shard of the row with primary key `pk`, and the row
+            if it had to be looked up on all shards.
+        """
+        shard = self._pk_shard(pk)
+        if shard is None:
+            shards = list(self.sessions)
+            found = self._fan_out(
+                shards,
+                lambda shard, storage: storage.get_many(
+                    [pk], use_primary=use_primary))
+            for shard, objs in zip(shards, found):
+                if objs:
+                    return shard, next(iter(objs.values()))
+        elif shard in self.sessions:
+            return shard, None
+        raise NotFound(
+            '{} with ID {} does not exist'.format(self.model_cls.__name__, pk))
+
+    def _filter_shards(self, filters):
+        # the shards that may have rows matching `filters`
+        values = get_filter_values(
+            filters, self.shard_field, self.model_cls.__name__)
+        if values is None:
+            return list(self.sessions)
+        shards = {self.shard_for(value) for value in values}
+        return [shard for shard in self.sessions if shard in shards]
+
+    def _get_sort_fields(self, order_by):
+        specs = [order_by] if isinstance(order_by, dict) else order_by or []
+        sort_fields = get_sort_fields(specs, self.model_cls.__name__)
+        column_names = self.model_cls.__table__.columns.keys()
+        if len(sort_fields) != len(specs) or any(
+            field not in column_names for field, _ in sort_fields
+        ):
+            raise ValueError(
+                'Sharded {} can only be sorted by its own columns'.format(
+                    self.model_cls.__name__))
+        return sort_fields
+
+    def _get_shard_list_kwargs(
+        self, filters, sort_fields, offset, limit, use_primary,
+        include_columns
+    ):
+        # each shard lists enough rows for the merged page, including the
+        # columns sorted on
+        limit = self._get_limit(limit)
+        return limit, dict(
+            filters=filters,
+            limit=(offset or 0) + limit if limit else None,
+            use_primary=use_primary,
+            include_columns=list(include_columns or ()) + [
+                field for field, _ in sort_fields],
+        )
+
+    def _get_shard_order_by(self, storage, sort_fields):
+        # each shard sorts nulls as `merge_sorted` does, or rows it ranks
+        # first may be beyond the shard's limit (e.g. on PostgreSQL)
+        nulls_first = storage._get_dialect_name() in NULLS_FIRST_DIALECTS
+        order_by = []
+        for field, direction in sort_fields:
+            spec = {'field': field, 'direction': direction}
+            if not nulls_first:
+                nulls = 'nullsfirst' if direction == 'asc' else 'nullslast'
+                spec[nulls] = True
+            order_by.append(spec)
+        return order_by
+
+    def _get_total(self, results, filters, use_primary):
+        # like `list` with `with_total`, None if there are no results
+        return self.count(filters, use_primary) if results else None
+
+    def get(self, pk, use_primary=False):
+        shard, obj = self._find_shard(pk, use_primary=use_primary)
+        if obj is not None:
+            return obj
+        return self._fan_out(
+            [shard],
+            lambda shard, storage: storage.get(pk, use_primary=use_primary)
+        )[0]
+
+    def get_many(self, pks, use_primary=False):
+        pks_by_shard = {}
+        for pk in pks:
+            shard = self._pk_shard(pk)
+            for name in (self.sessions if shard is None else [shard]):
+                if name in self.sessions:
+                    pks_by_shard.setdefault(name, []).append(pk)
+
+        objs = {}
+        shards = [shard for shard in self.sessions if shard in pks_by_shard]
+        for shard_objs in self._fan_out(
+            shards,
+            lambda shard, storage: storage.get_many(
+                pks_by_shard[shard], use_primary=use_primary)
+        ):
+            objs.update(shard_objs)
+        return objs
+
+    def list(
+        self, filters=None, order_by=None, offset=None, limit=None,
+        use_primary=False, with_total=False, include_columns=None
+    ):
+        """ List instances matching `filters` on the shards they may be on,
+            merging the results in `order_by` order (nulls first). Sorting
+            is only supported on the model's own columns.
+        """
+        sort_fields = self._get_sort_fields(order_by)
+        limit, shard_kwargs = self._get_shard_list_kwargs(
+            filters, sort_fields, offset, limit, use_primary,
+            include_columns)
+        with self._listing(filters, order_by):
+            results = self._fan_out(
+                self._filter_shards(filters),
+                lambda shard, storage: storage.list(
+                    order_by=self._get_shard_order_by(storage, sort_fields),
+                    **shard_kwargs))
+        results = merge_sorted(results, sort_fields, getattr, offset, limit)
+        self.trace.rows(len(results))
+
+        if with_total:
+            return results, self._get_total(results, filters, use_primary)
+        return results
+
+    def list_rows(
+        self, filters=None, order_by=None, offset=None, limit=None,
+        use_primary=False, with_total=False, include_columns=None
+    ):
+        sort_fields = self._get_sort_fields(order_by)
+        limit, shard_kwargs = self._get_shard_list_kwargs(
+            filters, sort_fields, offset, limit, use_primary,
+            include_columns)
+        with self._listing(filters, order_by):
+            results = self._fan_out(
+                self._filter_shards(filters),
+                lambda shard, storage: storage.list_rows(
+                    order_by=self._get_shard_order_by(storage, sort_fields),
+                    **shard_kwargs))
+
+        def get_column_names(include_columns):
+            excluded = self.get_excluded_columns(include_columns)
+            return [
+                col.name for col in self.model_cls.__table__.columns
+                if col.name not in excluded
+            ]
+
+        shard_column_names = get_column_names(shard_kwargs['include_columns'])
+        rows = merge_sorted(
+            [shard_rows for _, shard_rows in results], sort_fields,
+            lambda row, field: row[shard_column_names.index(field)],
+            offset, limit)
+        column_names = get_column_names(include_columns)
+        if column_names != shard_column_names:
+            # leave out the deferred columns only selected for sorting
+            indexes = [shard_column_names.index(name) for name in column_names]
+            rows = [tuple(row[index] for index in indexes) for row in rows]
+        self.trace.rows(len(rows))
+
+        if with_total:
+            total = self._get_total(rows, filters, use_primary)
+            return (column_names, rows), total
+        return column_names, rows
+
+    def estimate_row_count(self):
+        return sum(self._fan_out(
+            list(self.sessions),
+            lambda shard, storage: storage.estimate_row_count()))
+
+    def supports_window_count(self, use_primary=False):
+        return False
+
+    def count(self, filters=None, use_primary=False):
+        with self._listing(filters, None):
+            return sum(self._fan_out(
+                self._filter_shards(filters),
+                lambda shard, storage: storage.count(
+                    filters=filters, use_primary=use_primary)))
+
+    def spawn_count(self, filters=None, use_primary=False):
+        # `count` already queries the shards concurrently
+        return None
+
+    def update(self, pk, data, flush=True, commit=None):
+        self._written = True
+        shard, _ = self._find_shard(pk, use_primary=True)
+        if self.shard_field in data and self._data_shard(data) != shard:
+            raise ValueError(
+                'Moving {} with ID {} to another shard is not supported'
+                .format(self.model_cls.__name__, pk))
+        return self.shard(shard).update(pk, data, flush=flush, commit=commit)
+
+    def create(self, data, flush=True, commit=None):
+        self._written = True
+        return self.shard(self._data_shard(data)).create(
+            data, flush=flush, commit=commit)
+
+    def delete(self, pk, flush=True, commit=None):
+        self._written = True
+        shard, _ = self._find_shard(pk, use_primary=True)
+        self.shard(shard).delete(pk, flush=flush, commit=commit)
+
+    def _upsert_many(self, records, flush, commit):
+        self._written = True
+        records = list(records)
+        indexes_by_shard = {}
+        for index, data in enumerate(records):
+            indexes_by_shard.setdefault(
+                self._data_shard(data), []).append(index)
+
+        objs = [None] * len(records)
+        for shard, indexes in indexes_by_shard.items():
+            shard_objs = self.shard(shard).bulk_upsert(
+                [records[index] for index in indexes],
+                flush=flush, commit=commit)
+            for index, obj in zip(indexes, shard_objs):
+                objs[index] = obj
+        return objs
+
+    def end_unit_of_work(self, success=True):
+        """ Commit (or roll back) the changes made to each shard in
+            unit-of-work mode, then run any `on_commit` callbacks. If a
+            shard fails to commit, the shards not yet committed are rolled
+            back, but those already committed are not.
+        """
+        callbacks, self._commit_callbacks = self._commit_callbacks, []
+        storages = list(self._shard_storages.values())
+        try:
+            for storage in storages:
+                storage.end_unit_of_work(success=success)
+        except Exception:
+            for storage in storages:
+                storage.session.rollback()
+            raise
+
+        if success:
+            for callback in callbacks:
+                callback()
+
+    def _not_supported(self, method_name):
+        raise UnsupportedOperation('{} is not supported by {}'.format(
+            method_name, type(self).__name__))
+
+    def add(self, obj):
+        self._not_supported('add')
+
+    def get_record(self, pk, fields=None, use_primary=False):
+        self._not_supported('get_record')
+
+    def list_records(
+        self, filters=None, order_by=None, offset=None, limit=None,
+        fields=None, use_primary=False
+    ):
+        self._not_supported('list_records')
+
+    def changes_since(
+        self, column_name, cursor=None, limit=None, use_primary=False
+    ):
+        self._not_supported('changes_since')
+
+    def plan_sync(
+        self, records, delete_missing=False, filters=None, batch_size=500
+    ):
+        self._not_supported('plan_sync')
+
+    def apply_sync(self, plan, flush=True, commit=None):
+        self._not_supported('apply_sync')
@@ -0,0 +1,88 @@
+""" Counting of the SQL statements executed (and their duration), using
+    SQLAlchemy engine events.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+import time
+
+from greenlet import getcurrent
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+Statement = namedtuple('Statement', ['statement', 'parameters', 'duration'])
+
+
+class StatementCount(object):
+    """ The statements executed within a `counting` context. """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+        # `Statement` tuples
+        self.statements = []
+
+    def add(self, statement, parameters, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements.append(Statement(statement, parameters, duration))
+
+
+class StatementCounter(object):
+    """ Counts the statements executed by all engines, attributing them to
+        the greenthread executing them.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._global_counts = []
+        self._starts = {}
+
+    def install(self):
+        if not event.contains(
+            Engine, 'before_cursor_execute', self._before_cursor_execute
+        ):
+            event.listen(
+                Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(
+                Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, *args):
+        if self._counts or self._global_counts:
+            self._starts[getcurrent()] = time.time()
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, *args
+    ):
+        current = getcurrent()
+        start = self._starts.pop(current, None)
+        if start is None:
+            return
+        duration = time.time() - start
+
+        for count in self._counts.get(current, []) + self._global_counts:
+            count.add(statement, parameters, duration)
+
+    @contextmanager
+    def counting(self, all_greenthreads=False):
+        """ Count the statements executed within this context by the current
+            greenthread, or by any greenthread if `all_greenthreads`.
+            Yields a `StatementCount`.
+        """
+        self.install()
+        count = StatementCount()
+        current = getcurrent()
+        if all_greenthreads:
+            counts = self._global_counts
+        else:
+            counts = self._counts.setdefault(current, [])
+        counts.append(count)
+        try:
+            yield count
+        finally:
+            counts.remove(count)
+            if not all_greenthreads and not counts:
+                del self._counts[current]
+
+
+statement_counter = StatementCounter()
@@ -1,29 +1,168 @@
-from sqlalchemy import inspect
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+import copy
+from decimal import Decimal
+from importlib import import_module
+import logging
+import time
+
+import eventlet
+from sqlalchemy import JSON, LargeBinary, PickleType, Text
+from sqlalchemy import and_, func, inspect, or_
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import Session, defer
 from sqlalchemy_filters import apply_filters, apply_sort
 
+from .batching import get_pk_key
+from .indexes import check_filters_indexed, estimate_row_count
+from .instrumentation import NULL_TRACE
+from .records import get_record_cls
+from .timeouts import is_timeout_error, statement_timeout
+
+logger = logging.getLogger(__name__)
+
+
+# minimum server versions supporting `count(*) OVER ()`
+WINDOW_FUNCTION_VERSIONS = {
+    'sqlite': (3, 25),
+    'postgresql': (8, 4),
+    'mysql': (8,),  # also satisfied by MariaDB >= 10.2
+    'mssql': (9,),
+    'oracle': (8,),
+}
+
+
+# types of columns deferred by `deferred_columns='auto'`
+LARGE_COLUMN_TYPES = (Text, LargeBinary, JSON, PickleType)
+
+# python types of primary key columns that the primary key values of synced
+# & upserted records are converted to, e.g. so that a "1" key matches an
+# integer primary key
+COERCED_PK_TYPES = (int, float, Decimal)
+
 
 class NotFound(LookupError):
     pass
 
 
+# The changes that make the stored rows match a set of records:
+# - creates: the records to insert
+# - updates: `(instance, {field: new value})` for the changed instances
+# - deletes: the instances to delete
+# - unchanged: the number of records already matching their row
+SyncPlan = namedtuple(
+    'SyncPlan', ['creates', 'updates', 'deletes', 'unchanged'])
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+def get_large_column_names(model_cls):
+    """ Return the names of the columns of `model_cls` whose type may hold
+        large values, e.g. TEXT, BLOB or JSON columns, excluding primary key
+        columns.
+    """
+    return [
+        col.name for col in model_cls.__table__.columns
+        if isinstance(col.type, LARGE_COLUMN_TYPES) and not col.primary_key
+    ]
+
+
+def get_native_insert(dialect_name):
+    """ Return the dialect-specific `insert` construct supporting upserts,
+        or `None` if it is not available for this dialect or sqlalchemy
+        version.
+    """
+    try:
+        module = import_module('sqlalchemy.dialects.{}'.format(dialect_name))
+    except ImportError:
+        return None
+    return getattr(module, 'insert', None)
+
+
+def build_native_upsert(dialect_name, table, records, pk_names):
+    """ Build an `INSERT ... ON CONFLICT` / `ON DUPLICATE KEY` statement
+        inserting `records` into `table`, updating the existing row on a
+        primary key conflict. Returns `None` if the dialect does not support
+        a native upsert.
+    """
+    insert = get_native_insert(dialect_name)
+    if insert is None:
+        return None
+
+    stmt = insert(table).values(records)
+    update_names = [
+        name for name in sorted(records[0]) if name not in pk_names
+    ]
+
+    if dialect_name == 'mysql':
+        # a no-op update is required to ignore a conflicting row
+        update_names = update_names or pk_names[:1]
+        return stmt.on_duplicate_key_update(
+            **{name: stmt.inserted[name] for name in update_names}
+        )
+
+    if hasattr(stmt, 'on_conflict_do_update'):
+        if not update_names:
+            return stmt.on_conflict_do_nothing(index_elements=pk_names)
+        return stmt.on_conflict_do_update(
+            index_elements=pk_names,
+            set_={name: stmt.excluded[name] for name in update_names}
+        )
+
+    return None
+
+
 class DBStorage(object):
 
-    def __init__(self, model_cls, session=None):
+    def __init__(
+        self, model_cls, session=None, read_session=None, unit_of_work=False
+    ):
         self.model_cls = model_cls
         self.session = session
+        # optional session (e.g. on a read replica) used for reads
+        self.read_session = read_session
+        self.stats = Counter()
+        # in unit-of-work mode writes are only flushed by default and are
+        # committed once, by `end_unit_of_work`.
+        self.unit_of_work = unit_of_work
+        # limits applied to listing
+        self.max_limit = None
+        self.default_limit = None
+        # seconds after which reads are aborted with QueryTimeout
+        self.statement_timeout = None
+        # optional `QueryUsage` recording the fields filtered & sorted on
+        self.query_usage = None
+        self.reject_unindexed_filters = False
+        # rejected only on tables of at least this many rows, if set
+        self.unindexed_filter_min_rows = None
+        # optional `RowCountCache` of the table's row count
+        self.row_count_cache = None
+        # columns left out of `list` & `list_rows` unless included
+        self.deferred_columns = ()
+        self._query_session = None
+        self._written = False
+        self._commit_callbacks = []
+        # records the stages of the current call (see `instrumentation`)
+        self.trace = NULL_TRACE
 
     def _get(self, pk):
-        query = self.query
-        # In order to allow the underlying query to be customized with
-        # additional filters, we cannot use `query.get` and must construct
-        # our own additional PK filter.
-        pk_columns = inspect(self.model_cls).primary_key
-        pk_values = pk if isinstance(pk, (list, tuple)) else (pk,)
+        with self.trace.stage('query'):
+            query = self.query
+            # In order to allow the underlying query to be customized with
+            # additional filters, we cannot use `query.get` and must
+            # construct our own additional PK filter.
+            pk_columns = inspect(self.model_cls).primary_key
+            pk_values = pk if isinstance(pk, (list, tuple)) else (pk,)
 
-        for col, val in zip(pk_columns, pk_values):
-            query = query.filter(getattr(self.model_cls, col.name) == val)
+            for col, val in zip(pk_columns, pk_values):
+                query = query.filter(getattr(self.model_cls, col.name) == val)
 
-        obj = query.one_or_none()
+        with self.trace.stage('execute'):
+            obj = query.one_or_none()
+        self.trace.rows(1 if obj else 0)
 
         if not obj:
             raise NotFound(
@@ -31,59 +170,678 @@ class DBStorage(object):
                 .format(self.model_cls.__name__, pk))
         return obj
 
+    @property
+    def pk_names(self):
+        """ The names of the model's primary key columns. """
+        return [col.name for col in inspect(self.model_cls).primary_key]
+
+    def _get_pk_values(self, data):
+        pk_names = self.pk_names
+        missing = [name for name in pk_names if data.get(name) is None]
+        if missing:
+            raise ValueError(
+                'Primary key field(s) {} are required to upsert {}'
+                .format(missing, self.model_cls.__name__))
+        return tuple(data[name] for name in pk_names)
+
+    def pk_from_data(self, data):
+        """ Return the primary key of the row described by `data`, in the
+            form accepted by `get`.
+        """
+        pk_values = self._get_pk_values(data)
+        return pk_values[0] if len(pk_values) == 1 else pk_values
+
+    def pk_key_from_data(self, data):
+        """ Return the primary key tuple of the row described by `data`,
+            as keyed by `get_many`.
+        """
+        return self._coerce_pk_values(self._get_pk_values(data))
+
+    def _get_dialect_name(self):
+        return self.session.get_bind(
+            mapper=inspect(self.model_cls)).dialect.name
+
+    def _expire_identity(self, pk_values):
+        # make sure a subsequent get reloads any stale instance of a row that
+        # was changed outside of the ORM.
+        identity_key = inspect(self.model_cls).identity_key_from_primary_key(
+            list(pk_values))
+        obj = self.session.identity_map.get(identity_key)
+        if obj is not None:
+            self.session.expire(obj)
+
+    @property
+    def has_written(self):
+        """ Whether changes have been made through this storage. """
+        return self._written
+
+    def _should_commit(self, commit):
+        if commit is None:
+            return not self.unit_of_work
+        return commit
+
+    def on_commit(self, callback):
+        """ Call `callback` once the changes made through this storage are
+            committed. This is immediate unless in unit-of-work mode.
+        """
+        if self.unit_of_work:
+            self._commit_callbacks.append(callback)
+        else:
+            callback()
+
+    def end_unit_of_work(self, success=True):
+        """ Commit (or roll back if not `success`) the changes made in
+            unit-of-work mode, then run any `on_commit` callbacks.
+        """
+        callbacks, self._commit_callbacks = self._commit_callbacks, []
+        if not success:
+            self.session.rollback()
+            return
+
+        if self._written:
+            try:
+                self.session.commit()
+            except Exception:
+                self.session.rollback()
+                raise
+
+        for callback in callbacks:
+            callback()
+
+    @contextmanager
+    def atomic(self):
+        """ Commit the changes made within this context together, at its end
+            (or roll them back if it raises), and defer `on_commit` callbacks
+            until then. In unit-of-work mode this is already the case for
+            the whole unit of work.
+        """
+        if self.unit_of_work:
+            yield
+            return
+
+        self.unit_of_work = True
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            self.unit_of_work = False
+            self.end_unit_of_work(success=success)
+
+    def add(self, obj):
+        """ Add `obj` (e.g. an outbox row) to the session, to be committed
+            with the changes made through this storage.
+        """
+        self._written = True
+        self.session.add(obj)
+
+    def _get_read_session(self, use_primary=False):
+        if use_primary or self._written or self.read_session is None:
+            return 'primary', self.session
+        return 'replica', self.read_session
+
+    @contextmanager
+    def _reading(self, use_primary=False):
+        """ Route queries built within this context to the read session,
+            unless `use_primary` is set or this storage has already written
+            (so that reads always see earlier writes).
+        """
+        role, session = self._get_read_session(use_primary)
+
+        self.stats['reads.{}'.format(role)] += 1
+        logger.debug('%s read from %s', self.model_cls.__name__, role)
+
+        self._query_session = session
+        try:
+            with statement_timeout(
+                session, self.statement_timeout, inspect(self.model_cls)
+            ):
+                yield
+        except DBAPIError as exc:
+            if self.statement_timeout and is_timeout_error(exc):
+                raise QueryTimeout(
+                    '{} query exceeded the {}s statement timeout'.format(
+                        self.model_cls.__name__, self.statement_timeout))
+            raise
+        finally:
+            self._query_session = None
+
     @property
     def query(self):
-        return self.session.query(self.model_cls)
+        session = self._query_session or self.session
+        return session.query(self.model_cls)
+
+    def estimate_row_count(self):
+        """ Return the (estimated) number of rows of the model's table. """
+        return estimate_row_count(self.session, self.model_cls)
+
+    def _get_row_count(self):
+        if self.row_count_cache is None:
+            return self.estimate_row_count()
+        return self.row_count_cache.get(self.estimate_row_count)
+
+    @contextmanager
+    def _listing(self, filters, order_by):
+        """ Check the fields filtered on, and record the fields filtered &
+            sorted on by the query within this context.
+        """
+        if self.reject_unindexed_filters:
+            check_filters_indexed(
+                self.model_cls, filters, self.unindexed_filter_min_rows,
+                self._get_row_count)
+        if self.query_usage is None:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.query_usage.record(
+                self.model_cls.__name__, filters, order_by,
+                time.time() - start)
+
+    def get(self, pk, use_primary=False):
+        with self._reading(use_primary):
+            return self._get(pk)
+
+    def get_many(self, pks, use_primary=False):
+        """ Get the instances with any of the primary keys `pks` in a single
+            query. Returns a dict of the instances found, keyed by primary key
+            tuple. Keys that are not found are omitted.
+        """
+        pk_columns = inspect(self.model_cls).primary_key
+        pk_fields = [getattr(self.model_cls, col.name) for col in pk_columns]
+        pk_keys = [get_pk_key(pk) for pk in pks]
+
+        if not pk_keys:
+            return {}
+
+        if len(pk_fields) == 1:
+            criterion = pk_fields[0].in_([key[0] for key in pk_keys])
+        else:
+            criterion = or_(*[
+                and_(*[field == val for field, val in zip(pk_fields, key)])
+                for key in pk_keys
+            ])
+
+        with self._reading(use_primary):
+            with self.trace.stage('query'):
+                query = self.query.filter(criterion)
+            with self.trace.stage('execute'):
+                objs = query.all()
+        self.trace.rows(len(objs))
+
+        return {
+            tuple(getattr(obj, col.name) for col in pk_columns): obj
+            for obj in objs
+        }
+
+    def get_excluded_columns(self, include_columns=None):
+        """ Return the names of the `deferred_columns` not in
+            `include_columns`, which `list` & `list_rows` leave out.
+        """
+        include_columns = include_columns or ()
+        return [
+            name for name in self.deferred_columns
+            if name not in include_columns
+        ]
+
+    def list(
+        self, filters=None, order_by=None, offset=None, limit=None,
+        use_primary=False, with_total=False, include_columns=None
+    ):
+        """ List instances matching `filters`.
+            If `with_total` is set, the number of instances matching `filters`
+            is selected in the same query (see `supports_window_count`) and
+            a `(instances, total)` tuple is returned. `total` is None if no
+            instances are returned, e.g. if `offset` is beyond the results.
+            The `deferred_columns` not in `include_columns` are only loaded
+            if accessed.
+        """
+        with self._listing(filters, order_by), self._reading(use_primary):
+            with self.trace.stage('query'):
+                query = self.query
+                excluded = self.get_excluded_columns(include_columns)
+                if excluded:
+                    query = query.options(*[
+                        defer(getattr(self.model_cls, name))
+                        for name in excluded
+                    ])
+                query = self._apply_list_options(
+                    query, filters, order_by, offset, limit, with_total)
+            with self.trace.stage('execute'):
+                results = query.all()
+        self.trace.rows(len(results))
+
+        if with_total:
+            return self._split_total(results, lambda row: row[0])
+        return results
+
+    @property
+    def supports_list_rows(self):
+        """ Whether `list_rows` returns the same rows as `list`, i.e. neither
+            the `query` property nor `list` have been customized.
+        """
+        return (
+            type(self).query is DBStorage.query and
+            # `==` as Python 2 creates a new unbound method on each access
+            type(self).list == DBStorage.list
+        )
+
+    def list_rows(
+        self, filters=None, order_by=None, offset=None, limit=None,
+        use_primary=False, with_total=False, include_columns=None
+    ):
+        """ Like `list`, but select the table columns only, returning a
+            `(column_names, rows)` tuple where each row is a plain tuple of
+            values. This avoids the cost of building model instances.
+            With `with_total`, a `((column_names, rows), total)` tuple is
+            returned. The `deferred_columns` not in `include_columns` are
+            not selected.
+        """
+        excluded = self.get_excluded_columns(include_columns)
+        columns = [
+            col for col in self.model_cls.__table__.columns
+            if col.name not in excluded
+        ]
+        column_names = [col.name for col in columns]
+        with self._listing(filters, order_by), self._reading(use_primary):
+            with self.trace.stage('query'):
+                session = self._query_session
+                query = session.query(
+                    *[getattr(self.model_cls, col.name) for col in columns])
+                query = self._apply_list_options(
+                    query, filters, order_by, offset, limit, with_total)
+            with self.trace.stage('execute'):
+                rows = query.all()
+        self.trace.rows(len(rows))
+
+        if with_total:
+            rows, total = self._split_total(rows, lambda row: row[:-1])
+            return (column_names, rows), total
+        return column_names, rows
+
+    def _query_records(self, fields):
+        # select the record fields only, from the (possibly customized) query
+        record_cls = get_record_cls(self.model_cls, fields)
+        # the attribute name of a column may differ, e.g. `class_` for a
+        # `class` column
+        mapper = inspect(self.model_cls)
+        columns = self.model_cls.__table__.columns
+        query = self.query.with_entities(*[
+            getattr(
+                self.model_cls,
+                mapper.get_property_by_column(columns[name]).key)
+            for name in record_cls._column_names])
+        return record_cls, query
 
-    def get(self, pk):
-        return self._get(pk)
+    def get_record(self, pk, fields=None, use_primary=False):
+        """ Like `get`, but return a read-only record of the row (see
+            `list_records`) rather than a model instance.
+        """
+        pk_values = get_pk_key(pk)
+        with self._reading(use_primary):
+            with self.trace.stage('query'):
+                record_cls, query = self._query_records(fields)
+                for name, val in zip(self.pk_names, pk_values):
+                    query = query.filter(
+                        getattr(self.model_cls, name) == val)
+            with self.trace.stage('execute'):
+                row = query.one_or_none()
+        self.trace.rows(1 if row else 0)
 
-    def list(self, filters=None, order_by=None, offset=None, limit=None):
-        query = self.query
+        if row is None:
+            raise NotFound(
+                '{} with ID {} does not exist'
+                .format(self.model_cls.__name__, pk))
+        return record_cls._make(row)
+
+    def list_records(
+        self, filters=None, order_by=None, offset=None, limit=None,
+        fields=None, use_primary=False
+    ):
+        """ Like `list`, but return read-only records of the rows, named
+            tuples with the table columns (or only `fields`) as attributes,
+            e.g. `MemberRecord(id=1, name='Bob')`. Records are much smaller
+            than model instances and aren't tracked by the session, but
+            have no relationships, column properties or methods of the
+            model.
+        """
+        with self._listing(filters, order_by), self._reading(use_primary):
+            with self.trace.stage('query'):
+                record_cls, query = self._query_records(fields)
+                query = self._apply_list_options(
+                    query, filters, order_by, offset, limit)
+            with self.trace.stage('execute'):
+                rows = query.all()
+        self.trace.rows(len(rows))
+        return [record_cls._make(row) for row in rows]
+
+    def _split_total(self, rows, get_result):
+        # separate the `count(*) OVER ()` column from the results
+        total = rows[0][-1] if rows else None
+        return [get_result(row) for row in rows], total
+
+    def supports_window_count(self, use_primary=False):
+        """ Whether the database can select the total count of a listing in
+            the same query with `count(*) OVER ()`.
+        """
+        _, session = self._get_read_session(use_primary)
+        dialect = session.get_bind(mapper=inspect(self.model_cls)).dialect
+        min_version = WINDOW_FUNCTION_VERSIONS.get(dialect.name)
+        return bool(
+            min_version and dialect.server_version_info and
+            tuple(dialect.server_version_info) >= min_version
+        )
+
+    def _get_limit(self, limit):
+        if limit is None:
+            limit = self.default_limit or self.max_limit
+        if self.max_limit and (not limit or limit > self.max_limit):
+            raise ValueError(
+                'Invalid limit ({}), the maximum is {}'.format(
+                    limit, self.max_limit))
+        return limit
+
+    def changes_since(
+        self, column_name, cursor=None, limit=None, use_primary=False
+    ):
+        """ List instances ordered by `column_name` then primary key, after
+            the `(value, *pk_values)` tuple `cursor`, for iterating over the
+            instances changed since a version or timestamp. Instances whose
+            `column_name` is null are not listed.
+        """
+        column = getattr(self.model_cls, column_name)
+        fields = [column] + [
+            getattr(self.model_cls, name) for name in self.pk_names]
+
+        criteria = [column.isnot(None)]
+        if cursor is not None:
+            # `fields > cursor`, compared as tuples
+            criteria.append(or_(*[
+                and_(*[
+                    field == val for field, val in zip(fields[:i], cursor)
+                ] + [fields[i] > cursor[i]])
+                for i in range(len(fields))
+            ]))
+
+        with self._reading(use_primary):
+            with self.trace.stage('query'):
+                query = self.query.filter(*criteria).order_by(*fields)
+                if limit:
+                    query = query.limit(limit)
+            with self.trace.stage('execute'):
+                objs = query.all()
+        self.trace.rows(len(objs))
+        return objs
+
+    def _apply_list_options(
+        self, query, filters, order_by, offset, limit, with_total=False
+    ):
+        limit = self._get_limit(limit)
         if filters:
             query = apply_filters(query, filters)
         if order_by:
             query = apply_sort(query, order_by)
+        if with_total:
+            # added after filtering/sorting, which inspect the query entities
+            query = query.add_columns(func.count().over())
         if offset:
             query = query.offset(offset)
         if limit:
             query = query.limit(limit)
+        return query
 
-        return query.all()
+    def count(self, filters=None, use_primary=False):
+        with self._listing(filters, None), self._reading(use_primary):
+            with self.trace.stage('query'):
+                query = self.query
+                if filters:
+                    query = apply_filters(query, filters)
 
-    def count(self, filters=None):
-        query = self.query
-        if filters:
-            query = apply_filters(query, filters)
+            with self.trace.stage('execute'):
+                return query.count()
 
-        return query.count()
+    def spawn_count(self, filters=None, use_primary=False):
+        """ Start counting in a new greenthread, on a separate session (and
+            so a separate pooled connection). Returns the greenthread, whose
+            `wait()` returns the count, or None if the count must use this
+            storage's session to see uncommitted writes.
+        """
+        if self._written:
+            return None
 
-    def update(self, pk, data, flush=True, commit=True):
+        role, session = self._get_read_session(use_primary)
+        bind = session.get_bind(mapper=inspect(self.model_cls))
+        if isinstance(bind, Connection):
+            bind = bind.engine
+
+        def count():
+            storage = copy.copy(self)
+            storage.session = Session(bind=bind)
+            # keep the stats for this read attributed to the right session
+            storage.read_session = (
+                storage.session if role == 'replica' else None)
+            try:
+                return storage.count(filters=filters)
+            finally:
+                storage.session.close()
+
+        return eventlet.spawn(count)
+
+    def _save(self, flush, commit, obj=None):
+        # commit, or flush (and reload `obj`) if not committing
+        with self.trace.stage('execute'):
+            if self._should_commit(commit):
+                self.session.commit()
+            elif flush:
+                self.session.flush()
+                if obj is not None:
+                    self.session.refresh(obj)
+
+    def update(self, pk, data, flush=True, commit=None):
+        self._written = True
         obj = self._get(pk)
         for key, value in data.items():
             setattr(obj, key, value)
-        if commit:
-            self.session.commit()
-        elif flush:
-            self.session.flush()
-            self.session.refresh(obj)
+        self._save(flush, commit, obj)
         return obj
 
-    def create(self, data, flush=True, commit=True):
+    def create(self, data, flush=True, commit=None):
+        self._written = True
         obj = self.model_cls(**data)
         self.session.add(obj)
-        if commit:
-            self.session.commit()
-        elif flush:
-            self.session.flush()
-            self.session.refresh(obj)
+        self._save(flush, commit, obj)
 
         return obj
 
-    def delete(self, pk, flush=True, commit=True):
+    def delete(self, pk, flush=True, commit=None):
+        self._written = True
         obj = self._get(pk)
         self.session.delete(obj)
-        if commit:
-            self.session.commit()
-        elif flush:
-            self.session.flush()
+        self._save(flush, commit)
+
+    def _coerce_pk_values(self, pk_values):
+        # convert the primary key values to the python type of their column
+        coerced = []
+        for col, value in zip(inspect(self.model_cls).primary_key, pk_values):
+            try:
+                python_type = col.type.python_type
+            except NotImplementedError:
+                python_type = None
+            if python_type in COERCED_PK_TYPES and not isinstance(
+                value, python_type
+            ):
+                try:
+                    value = python_type(value)
+                except (TypeError, ValueError, ArithmeticError):
+                    raise ValueError('Invalid primary key {} of {}'.format(
+                        pk_values, self.model_cls.__name__))
+            coerced.append(value)
+        return tuple(coerced)
+
+    def _get_many_batched(self, pk_keys, batch_size):
+        objs = {}
+        for start in range(0, len(pk_keys), batch_size):
+            objs.update(self.get_many(
+                pk_keys[start:start + batch_size], use_primary=True))
+        return objs
+
+    def plan_sync(
+        self, records, delete_missing=False, filters=None, batch_size=500
+    ):
+        """ Compare `records` (each with its primary key, and all or some of
+            the other fields) with the existing rows, loaded `batch_size` at
+            a time, returning the `SyncPlan` making the rows match them.
+            With `delete_missing`, rows matching `filters` that are not in
+            `records` are deleted. The primary key values of `records` are
+            converted to the types of their columns.
+        """
+        records_by_key = OrderedDict()
+        for data in records:
+            pk_values = self.pk_key_from_data(data)
+            if pk_values in records_by_key:
+                raise ValueError(
+                    'Duplicate primary key {} in records to sync'.format(
+                        pk_values))
+            records_by_key[pk_values] = dict(
+                data, **dict(zip(self.pk_names, pk_values)))
+
+        existing = self._get_many_batched(list(records_by_key), batch_size)
+
+        creates = []
+        updates = []
+        unchanged = 0
+        for pk_values, data in records_by_key.items():
+            obj = existing.get(pk_values)
+            if obj is None:
+                creates.append(data)
+                continue
+            changes = {
+                key: value for key, value in data.items()
+                if getattr(obj, key) != value
+            }
+            if changes:
+                updates.append((obj, changes))
+            else:
+                unchanged += 1
+
+        deletes = []
+        if delete_missing:
+            with self._reading(use_primary=True):
+                with self.trace.stage('query'):
+                    query = self.query
+                    if filters:
+                        query = apply_filters(query, filters)
+                    # streamed, so that the keys of the whole table aren't
+                    # loaded at once
+                    query = query.with_entities(*[
+                        getattr(self.model_cls, name)
+                        for name in self.pk_names
+                    ]).yield_per(batch_size)
+                with self.trace.stage('execute'):
+                    missing = [
+                        tuple(row) for row in query
+                        if tuple(row) not in records_by_key
+                    ]
+            deletes = list(
+                self._get_many_batched(missing, batch_size).values())
+
+        return SyncPlan(creates, updates, deletes, unchanged)
+
+    def apply_sync(self, plan, flush=True, commit=None):
+        """ Apply the changes of a `SyncPlan`, returning the created
+            instances. The session's unit of work batches the statements of
+            each kind.
+        """
+        self._written = True
+        created_objs = [self.model_cls(**data) for data in plan.creates]
+        self.session.add_all(created_objs)
+        for obj, changes in plan.updates:
+            for key, value in changes.items():
+                setattr(obj, key, value)
+        for obj in plan.deletes:
+            self.session.delete(obj)
+        self._save(flush, commit)
+        return created_objs
+
+    def _upsert_in_transaction(self, data, pk_values, obj=None):
+        """ Upsert fallback for dialects without a native upsert, updating
+            `obj`, the existing instance if any. The insert is attempted in a
+            savepoint so that a row concurrently inserted by another
+            transaction results in an update instead.
+        """
+        if obj is None:
+            obj = self.model_cls(**data)
+            try:
+                with self.session.begin_nested():
+                    self.session.add(obj)
+                return obj
+            except IntegrityError:
+                obj = self._get(pk_values)
+
+        for key, value in data.items():
+            setattr(obj, key, value)
+        return obj
+
+    def _upsert_many(self, records, flush, commit):
+        self._written = True
+        records = list(records)
+        pk_names = self.pk_names
+
+        # a statement can't upsert the same row twice, so records with the
+        # same primary key are merged, the later fields winning
+        records_by_key = OrderedDict()
+        for data in records:
+            records_by_key.setdefault(
+                self.pk_key_from_data(data), {}).update(data)
+
+        # multi-row VALUES clauses require every row to have the same fields,
+        # so native statements are grouped by field names.
+        groups = {}
+        for data in records_by_key.values():
+            groups.setdefault(tuple(sorted(data)), []).append(data)
+
+        with self.trace.stage('query'):
+            dialect_name = self._get_dialect_name()
+            stmts = [
+                build_native_upsert(
+                    dialect_name, self.model_cls.__table__, group, pk_names)
+                for group in groups.values()
+            ]
+
+        if stmts and all(stmt is not None for stmt in stmts):
+            with self.trace.stage('execute'):
+                self.session.flush()
+                for stmt in stmts:
+                    self.session.execute(stmt)
+            for pk_values in records_by_key:
+                self._expire_identity(pk_values)
+        else:
+            existing = self.get_many(list(records_by_key), use_primary=True)
+            for pk_values, data in records_by_key.items():
+                self._upsert_in_transaction(
+                    data, pk_values, existing.get(pk_values))
+
+        self._save(flush, commit)
+
+        # the resulting rows, loaded in a single query
+        objs = self.get_many(list(records_by_key), use_primary=True)
+        missing = [key for key in records_by_key if key not in objs]
+        if missing:
+            raise NotFound('{} with ID {} does not exist'.format(
+                self.model_cls.__name__, missing[0]))
+        return [objs[self.pk_key_from_data(data)] for data in records]
+
+    def upsert(self, data, flush=True, commit=None):
+        """ Insert `data` as a new row or update the existing row with the
+            same primary key, returning the resulting instance.
+        """
+        return self._upsert_many([data], flush, commit)[0]
+
+    def bulk_upsert(self, records, flush=True, commit=None):
+        """ Upsert each of `records`, returning the resulting instances in the
+            same order.
+        """
+        return self._upsert_many(records, flush, commit)
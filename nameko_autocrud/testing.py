@@ -0,0 +1,36 @@
+""" Helpers for testing services using nameko-autocrud. """
+from contextlib import contextmanager
+
+from .statements import statement_counter
+
+
+@contextmanager
+def count_statements():
+    """ Count the SQL statements executed within this context, by any
+        greenthread (e.g. by workers started with `entrypoint_hook`).
+        Yields a `StatementCount`.
+    """
+    with statement_counter.counting(all_greenthreads=True) as count:
+        yield count
+
+
+@contextmanager
+def assert_statements(count=None, max_count=None):
+    """ Assert that exactly `count`, or at most `max_count`, SQL statements
+        are executed within this context, e.g.
+
+            with assert_statements(max_count=3):
+                update_member(1, {'name': 'Bob'})
+    """
+    with count_statements() as statements:
+        yield statements
+
+    executed = '\n'.join(stmt.statement for stmt in statements.statements)
+    if count is not None:
+        assert statements.count == count, (
+            'Expected {} statement(s), {} were executed:\n{}'.format(
+                count, statements.count, executed))
+    if max_count is not None:
+        assert statements.count <= max_count, (
+            'Expected at most {} statement(s), {} were executed:\n{}'.format(
+                max_count, statements.count, executed))
@@ -0,0 +1,99 @@
+""" Dialect-specific statement timeouts. """
+from contextlib import contextmanager
+import logging
+import time
+
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+# number of SQLite virtual machine instructions between timeout checks
+SQLITE_PROGRESS_INTERVAL = 1000
+
+POSTGRESQL_QUERY_CANCELED = '57014'
+MYSQL_EXECUTION_TIME_EXCEEDED = (3024, 1969)
+
+
+@contextmanager
+def _postgresql_timeout(session, timeout):
+    session.execute(
+        'SET LOCAL statement_timeout = {:d}'.format(int(timeout * 1000)))
+    try:
+        yield
+    except DBAPIError:
+        # the failed statement aborted the transaction, which must be rolled
+        # back, ending the `SET LOCAL` with it. Resetting it would fail and
+        # hide the error.
+        raise
+    except BaseException:
+        session.execute('SET LOCAL statement_timeout TO DEFAULT')
+        raise
+    session.execute('SET LOCAL statement_timeout TO DEFAULT')
+
+
+@contextmanager
+def _mysql_timeout(session, timeout):
+    # only applies to SELECT statements
+    session.execute(
+        'SET SESSION max_execution_time = {:d}'.format(int(timeout * 1000)))
+    try:
+        yield
+    finally:
+        session.execute('SET SESSION max_execution_time = DEFAULT')
+
+
+@contextmanager
+def _sqlite_timeout(session, timeout):
+    connection = session.connection().connection
+    deadline = time.time() + timeout
+
+    def abort_if_expired():
+        # a non-zero return value interrupts the running statement
+        return time.time() > deadline
+
+    connection.set_progress_handler(
+        abort_if_expired, SQLITE_PROGRESS_INTERVAL)
+    try:
+        yield
+    finally:
+        connection.set_progress_handler(None, SQLITE_PROGRESS_INTERVAL)
+
+
+TIMEOUTS = {
+    'postgresql': _postgresql_timeout,
+    'mysql': _mysql_timeout,
+    'sqlite': _sqlite_timeout,
+}
+
+
+@contextmanager
+def statement_timeout(session, timeout, mapper=None):
+    """ Abort statements executed in `session` within this context that run
+        for longer than `timeout` seconds (if set).
+    """
+    if not timeout:
+        yield
+        return
+
+    dialect_name = session.get_bind(mapper=mapper).dialect.name
+    set_timeout = TIMEOUTS.get(dialect_name)
+    if set_timeout is None:
+        logger.debug('statement timeouts unsupported for %s', dialect_name)
+        yield
+        return
+
+    with set_timeout(session, timeout):
+        yield
+
+
+def is_timeout_error(exc):
+    """ Whether the DBAPIError `exc` was raised because a statement
+        exceeded its timeout.
+    """
+    orig = exc.orig
+    if getattr(orig, 'pgcode', None) == POSTGRESQL_QUERY_CANCELED:
+        return True
+    args = getattr(orig, 'args', ())
+    if args and args[0] in MYSQL_EXECUTION_TIME_EXCEEDED:
+        return True
+    return str(orig) == 'interrupted'
@@ -9,7 +9,7 @@ setup(
     packages=find_packages(exclude=['test', 'test.*']),
     install_requires=[
         "nameko>=2.6.0",
-        "sqlalchemy>=1.0.16",
+        "sqlalchemy>=1.1.0",
         "sqlalchemy_filters>=0.4.0",
         "python-dateutil>=2.6.1",
         "sqlalchemy-utils>=0.32.5",
@@ -1,10 +1,15 @@
 from collections import namedtuple
 
 import pytest
+from eventlet.event import Event
 from nameko_sqlalchemy import DB_URIS_KEY
+from nameko.extensions import Entrypoint
+from nameko.testing.utils import get_extension
 from nameko.testing.services import replace_dependencies
 from nameko.constants import AMQP_URI_CONFIG_KEY
-from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy import (
+    Column, DateTime, Integer, LargeBinary, String, Text, create_engine
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy_utils import create_database, drop_database, database_exists
 from sqlalchemy.orm import sessionmaker
@@ -34,6 +39,27 @@ def multi_pk_model(dec_base):
     return MultiPkModel
 
 
+@pytest.fixture
+def versioned_model(dec_base):
+    class VersionedModel(dec_base):
+        __tablename__ = 'versioned'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        updated_at = Column(DateTime)
+    return VersionedModel
+
+
+@pytest.fixture
+def document_model(dec_base):
+    class DocumentModel(dec_base):
+        __tablename__ = 'document'
+        id = Column(Integer, primary_key=True)
+        title = Column(String)
+        body = Column(Text)
+        attachment = Column(LargeBinary)
+    return DocumentModel
+
+
 @pytest.fixture
 def db_uri(tmpdir):
     db_uri = 'sqlite:///{}'.format(tmpdir.join("db").strpath)
@@ -115,3 +141,33 @@ def create_service(example_model, container_factory, config, session):
         return ServiceMeta(container, *mocked_dependencies, **dependency_map)
 
     return _create
+
+
+@pytest.fixture
+def call_concurrently():
+    """ Spawn concurrent workers for entrypoint `method_name` of `container`,
+        one for each `(args, kwargs)` in `calls`. Returns the results, or the
+        exception raised, in order.
+
+        (`entrypoint_hook` can't be used concurrently for the same entrypoint
+        as it returns the result of the first worker to complete.)
+    """
+    def call(container, method_name, calls):
+        entrypoint = get_extension(
+            container, Entrypoint, method_name=method_name)
+
+        events = []
+        for args, kwargs in calls:
+            event = Event()
+
+            def handle_result(worker_ctx, result, exc_info, event=event):
+                event.send(result if exc_info is None else exc_info[1])
+                return result, exc_info
+
+            container.spawn_worker(
+                entrypoint, args, kwargs, handle_result=handle_result)
+            events.append(event)
+
+        return [event.wait() for event in events]
+
+    return call
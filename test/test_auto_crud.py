@@ -84,3 +84,53 @@ class TestRequiredParams:
                 db_storage_cls=db_storage_cls,
             )
         assert missing in str(exc)
+
+    def test_unknown_deferred_columns(self, example_model):
+        with pytest.raises(ValueError) as exc:
+            AutoCrud(
+                'session',
+                model_cls=example_model,
+                deferred_columns=['name', 'body'],
+            )
+        assert str(exc.value) == (
+            "Unknown deferred_columns ['body'] of ExampleModel")
+
+    def test_auto_deferred_columns(self, document_model):
+        crud = AutoCrud(
+            'session', model_cls=document_model, deferred_columns='auto')
+        assert crud.deferred_columns == ('body', 'attachment')
+
+    def test_row_count_cache(self, example_model):
+        crud = AutoCrud('session', model_cls=example_model)
+        assert crud.row_count_cache is None
+
+        crud = AutoCrud(
+            'session', model_cls=example_model,
+            reject_unindexed_filters=True, unindexed_filter_min_rows=1000,
+            unindexed_filter_count_ttl=60)
+        assert crud.row_count_cache.ttl == 60
+
+    def test_invalid_unindexed_filter_min_rows(self, example_model):
+        with pytest.raises(ValueError) as exc:
+            AutoCrud(
+                'session', model_cls=example_model,
+                reject_unindexed_filters=True, unindexed_filter_min_rows=-1)
+        assert 'Invalid unindexed_filter_min_rows (-1)' in str(exc.value)
+
+    def test_changes_since_without_changes_column(self, example_model):
+        with pytest.raises(ValueError) as exc:
+            AutoCrud(
+                'session',
+                model_cls=example_model,
+                changes_since_method_name='example_changes',
+            )
+        assert 'changes_column' in str(exc)
+
+    def test_outbox_relay_without_outbox_model(self, example_model):
+        with pytest.raises(ValueError) as exc:
+            AutoCrudWithEvents(
+                'session', 'dispatcher', 'exmpl',
+                model_cls=example_model,
+                outbox_relay_method_name='relay_outbox',
+            )
+        assert 'outbox_model' in str(exc)
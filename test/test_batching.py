@@ -0,0 +1,129 @@
+from collections import Counter
+
+import eventlet
+from eventlet.event import Event
+import pytest
+
+from nameko_autocrud.batching import GetBatcher, get_pk_key
+
+
+def test_get_pk_key():
+    assert get_pk_key(1) == (1,)
+    assert get_pk_key([1, 'foo']) == (1, 'foo')
+    assert get_pk_key((1, 'foo')) == (1, 'foo')
+
+
+class TestGetBatcher:
+
+    @pytest.fixture
+    def loaded(self):
+        return []
+
+    @pytest.fixture
+    def load_many(self, loaded):
+        def load_many(pks):
+            loaded.append(sorted(pks))
+            return {pk: {'id': pk[0]} for pk in pks if pk[0] != 404}
+        return load_many
+
+    def not_found(self):
+        raise LookupError('not found')
+
+    def load(self, batcher, pks, load_many):
+        threads = [
+            eventlet.spawn(batcher.load, pk, load_many, self.not_found)
+            for pk in pks
+        ]
+        results = []
+        for thread in threads:
+            try:
+                results.append(thread.wait())
+            except LookupError:
+                results.append('not found')
+        return results
+
+    def test_concurrent_gets_batched(self, load_many, loaded):
+        batcher = GetBatcher(0.01, 100, Counter())
+
+        results = self.load(batcher, [1, 2, 3, 2], load_many)
+
+        assert results == [{'id': 1}, {'id': 2}, {'id': 3}, {'id': 2}]
+        assert loaded == [[(1,), (2,), (3,)]]
+        assert batcher.stats == {'get_batches': 1, 'get_batched_keys': 3}
+        assert batcher.batch is None
+
+    def test_max_size(self, load_many, loaded):
+        batcher = GetBatcher(0.01, 2, Counter())
+
+        results = self.load(batcher, [1, 2, 3], load_many)
+
+        assert results == [{'id': 1}, {'id': 2}, {'id': 3}]
+        assert loaded == [[(1,), (2,)], [(3,)]]
+
+    def test_no_batching(self, load_many, loaded):
+        batcher = GetBatcher(10, 1, Counter())
+
+        assert batcher.load(1, load_many, self.not_found) == {'id': 1}
+        assert loaded == [[(1,)]]
+
+    def test_not_found(self, load_many, loaded):
+        batcher = GetBatcher(0.01, 100, Counter())
+
+        results = self.load(batcher, [404, 1, 404], load_many)
+
+        assert results == ['not found', {'id': 1}, 'not found']
+        assert loaded == [[(1,), (404,)]]
+
+    def test_load_error(self):
+        batcher = GetBatcher(0.01, 100, Counter())
+
+        def load_many(pks):
+            raise ValueError('boom')
+
+        threads = [
+            eventlet.spawn(batcher.load, pk, load_many, self.not_found)
+            for pk in [1, 2]
+        ]
+        for thread in threads:
+            with pytest.raises(ValueError):
+                thread.wait()
+
+    def test_load_error_single(self):
+        batcher = GetBatcher(0, 100, Counter())
+
+        def load_many(pks):
+            raise ValueError('boom')
+
+        with pytest.raises(ValueError):
+            batcher.load(1, load_many, self.not_found)
+
+    @pytest.mark.parametrize('kill_while_loading', [False, True])
+    def test_killed_leader(self, load_many, loaded, kill_while_loading):
+        batcher = GetBatcher(0.01, 100, Counter())
+        loading = Event()
+
+        def slow_load_many(pks):
+            loading.send()
+            eventlet.sleep(0.01)
+            return load_many(pks)
+
+        def load_one(pk):
+            return lambda: load_many([get_pk_key(pk)])[get_pk_key(pk)]
+
+        leader = eventlet.spawn(batcher.load, 1, slow_load_many, load_one(1))
+        eventlet.sleep(0)
+        waiters = [
+            eventlet.spawn(batcher.load, pk, slow_load_many, load_one(pk))
+            for pk in [2, 3]
+        ]
+        if kill_while_loading:
+            loading.wait()
+        else:
+            eventlet.sleep(0)
+        leader.kill()
+
+        # the waiting callers are released, loading their own key
+        assert [thread.wait() for thread in waiters] == [
+            {'id': 2}, {'id': 3}]
+        assert loaded == [[(2,)], [(3,)]]
+        assert batcher.batch is None
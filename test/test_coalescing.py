@@ -0,0 +1,122 @@
+from collections import Counter
+
+import eventlet
+import pytest
+
+from nameko_autocrud.coalescing import SingleFlight, get_call_key
+from nameko_autocrud.managers import CrudManager
+
+
+class TestGetCallKey:
+
+    def test_normalised_arguments(self):
+        keys = {
+            get_call_key('list', CrudManager.list, args, kwargs)
+            for args, kwargs in [
+                ((), {'filters': {'a': 1}, 'limit': 2}),
+                (({'a': 1},), {'limit': 2}),
+                (({'a': 1}, None, None, 2), {}),
+            ]
+        }
+        assert len(keys) == 1
+
+    def test_different_arguments(self):
+        assert (
+            get_call_key('get', CrudManager.get, (1,), {}) !=
+            get_call_key('get', CrudManager.get, (2,), {})
+        )
+
+    def test_different_methods(self):
+        assert (
+            get_call_key('list', CrudManager.list, (), {}) !=
+            get_call_key('count', CrudManager.count, (), {})
+        )
+
+    def test_invalid_arguments(self):
+        assert get_call_key('get', CrudManager.get, (), {}) is None
+
+
+class TestSingleFlight:
+
+    @pytest.fixture
+    def single_flight(self):
+        return SingleFlight(Counter())
+
+    def test_concurrent_calls_coalesced(self, single_flight):
+        calls = []
+
+        def fn():
+            calls.append(None)
+            eventlet.sleep(0.01)
+            return {'results': [1, 2]}
+
+        threads = [
+            eventlet.spawn(single_flight.call, 'key', fn) for _ in range(5)
+        ]
+        results = [thread.wait() for thread in threads]
+
+        assert len(calls) == 1
+        assert results == [{'results': [1, 2]}] * 5
+        # every caller gets its own copy
+        assert len({id(result) for result in results}) == 5
+        assert single_flight.stats == {'coalesced': 4}
+        assert single_flight.in_flight == {}
+
+    def test_different_keys_not_coalesced(self, single_flight):
+        def fn(value):
+            eventlet.sleep(0.01)
+            return value
+
+        threads = [
+            eventlet.spawn(single_flight.call, key, lambda key=key: fn(key))
+            for key in ('a', 'b')
+        ]
+        assert [thread.wait() for thread in threads] == ['a', 'b']
+        assert single_flight.stats == {}
+
+    def test_sequential_calls_not_coalesced(self, single_flight):
+        result = {'value': 1}
+        assert single_flight.call('key', lambda: result) is result
+        assert single_flight.call('key', lambda: result) is result
+        assert single_flight.stats == {}
+
+    def test_exception_shared(self, single_flight):
+        def fn():
+            eventlet.sleep(0.01)
+            raise ValueError('boom')
+
+        threads = [
+            eventlet.spawn(single_flight.call, 'key', fn) for _ in range(2)
+        ]
+        for thread in threads:
+            with pytest.raises(ValueError):
+                thread.wait()
+        assert single_flight.in_flight == {}
+
+    def test_exception(self, single_flight):
+        def fn():
+            raise ValueError('boom')
+
+        with pytest.raises(ValueError):
+            single_flight.call('key', fn)
+        assert single_flight.in_flight == {}
+
+    def test_killed_call(self, single_flight):
+        calls = []
+
+        def fn():
+            calls.append(None)
+            eventlet.sleep(0.01)
+            return len(calls)
+
+        leader = eventlet.spawn(single_flight.call, 'key', fn)
+        eventlet.sleep(0)
+        followers = [
+            eventlet.spawn(single_flight.call, 'key', fn) for _ in range(2)
+        ]
+        eventlet.sleep(0)
+        leader.kill()
+
+        # the waiting calls are released, and make the call again once
+        assert [thread.wait() for thread in followers] == [2, 2]
+        assert single_flight.in_flight == {}
@@ -0,0 +1,148 @@
+import pytest
+from mock import Mock
+
+from nameko.rpc import rpc
+from nameko.testing.services import entrypoint_hook
+from nameko_sqlalchemy import DatabaseSession
+
+from nameko_autocrud import AutoCrud, CrudBatch
+
+
+@pytest.fixture
+def service_cls(dec_base, example_model, multi_pk_model):
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=example_model,
+            get_method_name='get_example_model',
+            count_method_name='count_example_models',
+            create_method_name='create_example_model',
+            update_method_name='update_example_model',
+        )
+        multi_pk_crud = AutoCrud(
+            'session',
+            model_cls=multi_pk_model,
+            list_method_name='list_multi_pks',
+            create_method_name='create_multi_pk',
+        )
+        batch = CrudBatch(max_operations=5)
+
+        @rpc
+        def count_both(self):
+            return [
+                item['result'] for item in self.batch([
+                    {'method': 'count_example_models'},
+                    {'method': 'list_multi_pks'},
+                ])
+            ]
+
+    return ExampleService
+
+
+@pytest.fixture
+def container(service_cls, create_service):
+    return create_service(service_cls).container
+
+
+def test_crud_batch(container):
+    with entrypoint_hook(container, 'crud_batch') as crud_batch:
+        assert crud_batch([
+            {'method': 'create_example_model', 'args': [{'id': 1}]},
+            {
+                'method': 'create_multi_pk',
+                'kwargs': {'data': {'id': 1, 'name': 'a', 'value': 2}},
+            },
+            {'method': 'get_example_model', 'args': [1]},
+            {'method': 'count_example_models'},
+            {'method': 'list_multi_pks'},
+        ]) == [
+            {'result': {'id': 1, 'name': None}},
+            {'result': {'id': 1, 'name': 'a', 'value': 2}},
+            {'result': {'id': 1, 'name': None}},
+            {'result': 1},
+            {'result': [{'id': 1, 'name': 'a', 'value': 2}]},
+        ]
+
+
+def test_errors_are_returned(container):
+    with entrypoint_hook(container, 'crud_batch') as crud_batch:
+        [created, missing, count] = crud_batch([
+            {'method': 'create_example_model', 'args': [{'id': 1}]},
+            {'method': 'get_example_model', 'args': [2]},
+            {'method': 'count_example_models'},
+        ])
+    assert created == {'result': {'id': 1, 'name': None}}
+    assert missing['error']['exc_type'] == 'NotFound'
+    assert count == {'result': 1}
+
+
+def test_atomic(container):
+    with entrypoint_hook(container, 'crud_batch') as crud_batch:
+        assert crud_batch([
+            {'method': 'create_example_model', 'args': [{'id': 1}]},
+            {'method': 'update_example_model', 'args': [1, {'name': 'x'}]},
+        ], atomic=True) == [
+            {'result': {'id': 1, 'name': None}},
+            {'result': {'id': 1, 'name': 'x'}},
+        ]
+
+        with pytest.raises(Exception) as exc:
+            crud_batch([
+                {'method': 'create_example_model', 'args': [{'id': 2}]},
+                {
+                    'method': 'create_multi_pk',
+                    'args': [{'id': 1, 'name': 'a'}],
+                },
+                {'method': 'update_example_model', 'args': [3, {}]},
+            ], atomic=True)
+        assert type(exc.value).__name__ == 'NotFound'
+
+        # the earlier operations were rolled back
+        assert crud_batch([
+            {'method': 'count_example_models'},
+            {'method': 'list_multi_pks'},
+        ]) == [{'result': 1}, {'result': []}]
+
+
+@pytest.mark.parametrize('operations, message', [
+    ([{'method': 'delete_example_model'}],
+     'Unknown crud_batch method (delete_example_model)'),
+    ([{'method': 'count_both'}], 'Unknown crud_batch method (count_both)'),
+    (['count_example_models'], 'Invalid operation (count_example_models)'),
+    ([{'method': 'count_example_models'}] * 6,
+     'Too many operations (6), the maximum is 5'),
+])
+def test_invalid_operations(container, operations, message):
+    with entrypoint_hook(container, 'crud_batch') as crud_batch:
+        with pytest.raises(ValueError) as exc:
+            crud_batch(operations)
+    assert str(exc.value) == message
+
+
+def test_dependency(container):
+    with entrypoint_hook(container, 'count_both') as count_both:
+        assert count_both() == [0, []]
+
+
+def test_method_name_clash(service_cls):
+    with pytest.raises(ValueError) as exc:
+        CrudBatch().bind(Mock(service_cls=service_cls), 'crud_batch')
+    assert str(exc.value) == (
+        'CrudBatch attribute `crud_batch` would hide its method')
+
+
+def test_wont_overwrite_service_method(service_cls, create_service):
+
+    class ExampleService(service_cls):
+
+        @rpc
+        def crud_batch(self, operations, atomic=False):
+            return 'custom'
+
+    container = create_service(ExampleService).container
+    with entrypoint_hook(container, 'crud_batch') as crud_batch:
+        assert crud_batch([]) == 'custom'
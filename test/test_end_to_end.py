@@ -1,11 +1,20 @@
+import os
+
+import eventlet
 import pytest
+from mock import patch
 
 from nameko.exceptions import ExtensionNotFound
-from nameko.rpc import rpc
+from nameko.rpc import Rpc, rpc
 from nameko.testing.services import entrypoint_hook
+from nameko.testing.utils import get_extension
 from nameko_sqlalchemy import DatabaseSession
 
-from nameko_autocrud import AutoCrud
+from nameko_autocrud import (
+    AutoCrud, DBStorage, HistogramInstrumentation, NotFound, QueryTimeout,
+    QueryUsage, SlowCallProfiler, TooManyRequests, UnindexedFilter,
+    from_columnar
+)
 
 
 @pytest.fixture
@@ -25,6 +34,8 @@ def service(create_service, dec_base, example_model):
             create_method_name='create_example_model',
             update_method_name='update_example_model',
             delete_method_name='delete_example_model',
+            upsert_method_name='upsert_example_model',
+            bulk_upsert_method_name='bulk_upsert_example_models',
         )
 
     return create_service(ExampleService)
@@ -161,6 +172,648 @@ def test_end_to_end(service):
         assert result == [updated_record_2]
 
 
+def test_upsert(service):
+    container = service.container
+
+    record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+    record_2 = {'id': 2, 'name': 'Phil Connors'}
+    updated_record_1 = {'id': 1, 'name': 'Ned Ryerson'}
+
+    with entrypoint_hook(
+        container, "upsert_example_model"
+    ) as upsert_example_model:
+
+        result = upsert_example_model(record_1)
+        assert result == record_1
+
+        result = upsert_example_model(updated_record_1)
+        assert result == updated_record_1
+
+    with entrypoint_hook(
+        container, "bulk_upsert_example_models"
+    ) as bulk_upsert_example_models:
+
+        result = bulk_upsert_example_models([record_1, record_2])
+        assert result == [record_1, record_2]
+
+    with entrypoint_hook(
+        container, "list_example_models"
+    ) as list_example_models:
+
+        result = list_example_models()
+        assert result == [record_1, record_2]
+
+
+def test_columnar_format(service):
+    container = service.container
+
+    record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+    record_2 = {'id': 2, 'name': 'Phil Connors'}
+
+    with entrypoint_hook(
+        container, "create_example_model"
+    ) as create_example_model:
+        create_example_model(record_1)
+        create_example_model(record_2)
+
+    columnar = {
+        'columns': ['id', 'name'],
+        'rows': [[1, 'Bob Dobalina'], [2, 'Phil Connors']],
+    }
+
+    with entrypoint_hook(
+        container, "list_example_models"
+    ) as list_example_models:
+        result = list_example_models(format='columnar')
+        assert result == columnar
+        assert from_columnar(result) == [record_1, record_2]
+
+    with entrypoint_hook(
+        container, "page_example_models"
+    ) as page_example_models:
+        result = page_example_models(10, 1, format='columnar')
+        assert result['results'] == columnar
+        assert result['num_results'] == 2
+
+
+def test_read_session(create_service, dec_base, example_model):
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        read_session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            read_session_provider='read_session',
+            model_cls=example_model,
+            get_method_name='get_example_model',
+            list_method_name='list_example_models',
+            page_method_name='page_example_models',
+            count_method_name='count_example_models',
+            create_method_name='create_example_model',
+        )
+
+    container = create_service(ExampleService).container
+    provider = get_extension(container, AutoCrud)
+
+    record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+
+    with entrypoint_hook(
+        container, "create_example_model"
+    ) as create_example_model:
+        create_example_model(record_1)
+
+    with entrypoint_hook(container, "get_example_model") as get_example_model:
+        assert get_example_model(1) == record_1
+        assert get_example_model(1, use_primary=True) == record_1
+
+    with entrypoint_hook(
+        container, "page_example_models"
+    ) as page_example_models:
+        assert page_example_models(10, 1)['results'] == [record_1]
+
+    assert provider.stats == {'reads.replica': 3, 'reads.primary': 1}
+
+
+def test_coalesce_reads(
+    create_service, call_concurrently, dec_base, example_model
+):
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=example_model,
+            coalesce_reads=True,
+            get_method_name='get_example_model',
+            create_method_name='create_example_model',
+        )
+
+    container = create_service(ExampleService).container
+    provider = get_extension(container, AutoCrud)
+
+    record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+
+    with entrypoint_hook(
+        container, "create_example_model"
+    ) as create_example_model:
+        create_example_model(record_1)
+
+    storage_get = DBStorage.get
+
+    def slow_get(self, *args, **kwargs):
+        eventlet.sleep(0.01)
+        return storage_get(self, *args, **kwargs)
+
+    with patch.object(DBStorage, 'get', slow_get):
+        results = call_concurrently(container, 'get_example_model', [
+            ((1,), {}),
+            ((), {'pk': 1}),
+            ((1,), {}),
+            ((1,), {'use_primary': True}),
+        ])
+        assert results == [record_1] * 4
+
+    assert provider.stats['coalesced'] == 2
+
+
+def test_batched_gets(
+    create_service, call_concurrently, dec_base, example_model
+):
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=example_model,
+            get_batch_window=0.01,
+            get_method_name='get_example_model',
+            create_method_name='create_example_model',
+        )
+
+        @rpc
+        def create_and_get(self, record):
+            self.example_crud.create(record)
+            return self.get_example_model(record['id'])
+
+    container = create_service(ExampleService).container
+    provider = get_extension(container, AutoCrud)
+
+    records = [
+        {'id': 1, 'name': 'Bob Dobalina'},
+        {'id': 2, 'name': 'Phil Connors'},
+    ]
+
+    with entrypoint_hook(
+        container, "create_example_model"
+    ) as create_example_model:
+        for record in records:
+            create_example_model(record)
+
+    results = call_concurrently(container, 'get_example_model', [
+        ((1,), {}),
+        ((), {'pk': 2}),
+        ((3,), {}),
+        ((1,), {'use_primary': True}),
+        ((), {}),
+    ])
+
+    assert results[:2] == records
+    assert str(results[2]) == 'ExampleModel with ID 3 does not exist'
+    assert results[3] == records[0]
+    assert isinstance(results[4], TypeError)
+    assert provider.stats['get_batches'] == 1
+    assert provider.stats['get_batched_keys'] == 3
+
+    # gets after a write in the same worker are not batched
+    with entrypoint_hook(container, "create_and_get") as create_and_get:
+        record_3 = {'id': 3, 'name': 'Ned Ryerson'}
+        assert create_and_get(record_3) == record_3
+
+    assert provider.stats['get_batches'] == 1
+
+
+def test_concurrency_limits(
+    create_service, call_concurrently, dec_base, example_model
+):
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=example_model,
+            get_method_name='get_example_model',
+            list_method_name='list_example_models',
+            create_method_name='create_example_model',
+            list_concurrency=(1, 1),
+        )
+
+    container = create_service(ExampleService).container
+    provider = get_extension(container, AutoCrud)
+
+    record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+
+    with entrypoint_hook(
+        container, "create_example_model"
+    ) as create_example_model:
+        create_example_model(record_1)
+
+    storage_list_rows = DBStorage.list_rows
+
+    def slow_list_rows(self, *args, **kwargs):
+        eventlet.sleep(0.01)
+        return storage_list_rows(self, *args, **kwargs)
+
+    with patch.object(DBStorage, 'list_rows', slow_list_rows):
+        results = call_concurrently(
+            container, 'list_example_models', [((), {})] * 3)
+
+        # gets are not limited
+        with entrypoint_hook(
+            container, "get_example_model"
+        ) as get_example_model:
+            assert get_example_model(1) == record_1
+
+    assert results[:2] == [[record_1], [record_1]]
+    assert isinstance(results[2], TooManyRequests)
+    assert provider.stats['rejected.list'] == 1
+
+    # rejected calls are expected exceptions of the rpc method
+    entrypoint = get_extension(
+        container, Rpc, method_name='list_example_models')
+    assert entrypoint.expected_exceptions == (TooManyRequests,)
+    entrypoint = get_extension(
+        container, Rpc, method_name='get_example_model')
+    assert entrypoint.expected_exceptions == ()
+
+
+def test_changes_since(versioned_model, create_service, dec_base):
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=versioned_model,
+            create_method_name='create_versioned',
+            update_method_name='update_versioned',
+            changes_since_method_name='versioned_changes',
+            changes_column='updated_at',
+            changes_batch_size=2,
+        )
+
+    container = create_service(ExampleService).container
+
+    with entrypoint_hook(container, 'create_versioned') as create:
+        for id_ in range(1, 4):
+            create({
+                'id': id_, 'name': 'v{}'.format(id_),
+                'updated_at': '2020-01-0{}T00:00:00'.format(id_),
+            })
+
+    with entrypoint_hook(container, 'versioned_changes') as changes_since:
+        changes = changes_since()
+        assert [result['id'] for result in changes['results']] == [1, 2]
+        assert changes['more'] is True
+        changes = changes_since(changes['cursor'])
+        assert [result['id'] for result in changes['results']] == [3]
+        assert changes['more'] is False
+        cursor = changes['cursor']
+
+    with entrypoint_hook(container, 'update_versioned') as update:
+        update(1, {'name': 'changed', 'updated_at': '2020-01-04T00:00:00'})
+
+    with entrypoint_hook(container, 'versioned_changes') as changes_since:
+        changes = changes_since(cursor)
+        assert changes['results'] == [{
+            'id': 1, 'name': 'changed', 'updated_at': '2020-01-04T00:00:00'
+        }]
+        assert changes['cursor'] == ['2020-01-04T00:00:00', 1]
+
+
+def test_sync(create_service, dec_base, example_model):
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=example_model,
+            list_method_name='list_example_models',
+            sync_method_name='sync_example_models',
+            sync_batch_size=2,
+        )
+
+    container = create_service(ExampleService).container
+
+    records = [{'id': id_, 'name': 'a{}'.format(id_)} for id_ in range(5)]
+    with entrypoint_hook(container, 'sync_example_models') as sync:
+        assert sync(records) == {
+            'created': 5, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+
+        records[1]['name'] = 'b1'
+        # only the records with names starting with 'a'
+        assert sync(records[1:4], delete_missing=True, filters=[
+            {'field': 'name', 'op': 'like', 'value': 'a%'}
+        ]) == {'created': 0, 'updated': 1, 'deleted': 2, 'unchanged': 2}
+
+        with pytest.raises(ValueError):
+            sync([records[1], records[1]])
+
+    with entrypoint_hook(container, 'list_example_models') as list_:
+        assert list_() == records[1:4]
+
+
+def test_deferred_columns(document_model, create_service, dec_base):
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=document_model,
+            get_method_name='get_document',
+            list_method_name='list_documents',
+            page_method_name='page_documents',
+            create_method_name='create_document',
+            deferred_columns=['body'],
+        )
+
+    container = create_service(ExampleService).container
+
+    document = {'id': 1, 'title': 'foo', 'body': 'text', 'attachment': None}
+    with entrypoint_hook(container, 'create_document') as create_document:
+        create_document(document)
+
+    with entrypoint_hook(container, 'get_document') as get_document:
+        assert get_document(1) == document
+
+    with entrypoint_hook(container, 'list_documents') as list_documents:
+        assert list_documents() == [
+            {'id': 1, 'title': 'foo', 'attachment': None}]
+        assert list_documents(include_columns=['body']) == [document]
+
+    with entrypoint_hook(container, 'page_documents') as page_documents:
+        assert page_documents(10, 1, format='columnar')['results'] == {
+            'columns': ['id', 'title', 'attachment'],
+            'rows': [[1, 'foo', None]],
+        }
+
+
+def test_limits_and_timeouts(create_service, dec_base, example_model):
+
+    class SlowStorage(DBStorage):
+
+        def count(self, filters=None, use_primary=False):
+            if filters == 'slow':
+                with self._reading(use_primary):
+                    self.query.session.execute(
+                        'WITH RECURSIVE cnt(x) AS (SELECT 1 UNION ALL '
+                        'SELECT x + 1 FROM cnt WHERE x < 100000000) '
+                        'SELECT count(*) FROM cnt'
+                    )
+            return super(SlowStorage, self).count(filters, use_primary)
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=example_model,
+            db_storage_cls=SlowStorage,
+            list_method_name='list_example_models',
+            count_method_name='count_example_models',
+            create_method_name='create_example_model',
+            max_limit=3,
+            default_limit=2,
+            count_timeout=0.01,
+        )
+
+    container = create_service(ExampleService).container
+
+    with entrypoint_hook(
+        container, "create_example_model"
+    ) as create_example_model:
+        for id_ in range(1, 5):
+            create_example_model({'id': id_, 'name': 'name'})
+
+    with entrypoint_hook(
+        container, "list_example_models"
+    ) as list_example_models:
+        assert len(list_example_models()) == 2
+        assert len(list_example_models(limit=3)) == 3
+        with pytest.raises(ValueError):
+            list_example_models(limit=4)
+
+    with entrypoint_hook(
+        container, "count_example_models"
+    ) as count_example_models:
+        assert count_example_models() == 4
+        with pytest.raises(QueryTimeout):
+            count_example_models('slow')
+
+    # timeouts are expected exceptions of the rpc method
+    entrypoint = get_extension(
+        container, Rpc, method_name='count_example_models')
+    assert entrypoint.expected_exceptions == (QueryTimeout,)
+    entrypoint = get_extension(
+        container, Rpc, method_name='list_example_models')
+    assert entrypoint.expected_exceptions == ()
+
+    provider = get_extension(container, AutoCrud)
+    assert provider.statement_timeouts == {'count': 0.01}
+
+
+def test_instrumentation(create_service, dec_base, example_model):
+
+    instrumentation = HistogramInstrumentation()
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=example_model,
+            get_method_name='get_example_model',
+            list_method_name='list_example_models',
+            count_method_name='count_example_models',
+            create_method_name='create_example_model',
+            instrumentation=instrumentation,
+        )
+
+    container = create_service(ExampleService).container
+
+    record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+
+    with entrypoint_hook(
+        container, "create_example_model"
+    ) as create_example_model:
+        create_example_model(record_1)
+
+    with entrypoint_hook(
+        container, "get_example_model"
+    ) as get_example_model:
+        assert get_example_model(1) == record_1
+
+    with entrypoint_hook(
+        container, "list_example_models"
+    ) as list_example_models:
+        assert list_example_models() == [record_1]
+
+    with entrypoint_hook(
+        container, "count_example_models"
+    ) as count_example_models:
+        assert count_example_models() == 1
+
+    snapshot = instrumentation.snapshot()
+    model_name = example_model.__name__
+    assert {
+        (method_name, stage) for method_name, model, stage in snapshot
+        if model == model_name
+    } == {
+        ('create', 'manager'),
+        ('create', 'deserialize'),
+        ('create', 'execute'),
+        ('create', 'serialize'),
+        ('get', 'manager'),
+        ('get', 'query'),
+        ('get', 'execute'),
+        ('get', 'rows'),
+        ('get', 'serialize'),
+        ('list', 'manager'),
+        ('list', 'query'),
+        ('list', 'execute'),
+        ('list', 'rows'),
+        ('list', 'serialize'),
+        ('count', 'manager'),
+        ('count', 'query'),
+        ('count', 'execute'),
+    }
+    assert snapshot[('list', model_name, 'rows')]['sum'] == 1
+
+
+def test_statement_budget(create_service, dec_base, example_model):
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=example_model,
+            get_method_name='get_example_model',
+            create_method_name='create_example_model',
+            statement_budget=1,
+        )
+
+    container = create_service(ExampleService).container
+    provider = get_extension(container, AutoCrud)
+
+    record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+
+    with patch('nameko_autocrud.logger') as logger:
+        with entrypoint_hook(
+            container, "create_example_model"
+        ) as create_example_model:
+            # insert, commit & reload
+            create_example_model(record_1)
+
+        with entrypoint_hook(
+            container, "get_example_model"
+        ) as get_example_model:
+            assert get_example_model(1) == record_1
+            with pytest.raises(NotFound):
+                get_example_model(2)
+
+    assert provider.stats['statements.create'] == 2
+    assert provider.stats['statements.get'] == 2
+    assert provider.stats['statement_time.get'] > 0
+    assert provider.stats['over_statement_budget.create'] == 1
+    assert provider.stats['over_statement_budget.get'] == 0
+    assert logger.warning.call_count == 1
+
+
+def test_statement_budget_by_method(example_model):
+    provider = AutoCrud(
+        'session', model_cls=example_model, statement_budget={'get': 1})
+    assert provider.statement_budgets == {'get': 1}
+    assert provider.count_statements
+
+    provider = AutoCrud('session', model_cls=example_model)
+    assert not provider.count_statements
+
+
+def test_slow_call_profiler(create_service, dec_base, example_model, tmpdir):
+
+    directory = tmpdir.join('profiles').strpath
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=example_model,
+            list_method_name='list_example_models',
+            count_method_name='count_example_models',
+            slow_call_profiler=SlowCallProfiler(directory, threshold=0.01),
+        )
+
+    container = create_service(ExampleService).container
+
+    storage_count = DBStorage.count
+
+    def slow_count(self, *args, **kwargs):
+        eventlet.sleep(0.02)
+        return storage_count(self, *args, **kwargs)
+
+    with entrypoint_hook(
+        container, "list_example_models"
+    ) as list_example_models:
+        assert list_example_models() == []
+
+    with patch.object(DBStorage, 'count', slow_count):
+        with entrypoint_hook(
+            container, "count_example_models"
+        ) as count_example_models:
+            assert count_example_models() == 0
+
+    [name] = [name for name in os.listdir(directory) if name.endswith('json')]
+    assert '_{}_count_'.format(example_model.__name__) in name
+
+
+def test_query_usage(create_service, dec_base, example_model):
+
+    query_usage = QueryUsage()
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        session = DatabaseSession(dec_base)
+        example_crud = AutoCrud(
+            'session',
+            model_cls=example_model,
+            page_method_name='page_example_models',
+            count_method_name='count_example_models',
+            query_usage=query_usage,
+            reject_unindexed_filters=True,
+        )
+
+    container = create_service(ExampleService).container
+
+    with entrypoint_hook(
+        container, "page_example_models"
+    ) as page_example_models:
+        page_example_models(
+            page_size=10, page_num=1,
+            filters=[{'field': 'id', 'op': '>', 'value': 1}],
+            order_by=[{'field': 'name', 'direction': 'asc'}])
+
+    with entrypoint_hook(
+        container, "count_example_models"
+    ) as count_example_models:
+        with pytest.raises(UnindexedFilter):
+            count_example_models(
+                filters=[{'field': 'name', 'op': '==', 'value': 'a'}])
+
+    # page both counts & lists
+    assert query_usage.filters[('ExampleModel', 'id', '>')].count == 2
+    assert query_usage.sorts[('ExampleModel', 'name', 'asc')].count == 1
+    assert ('ExampleModel', 'name', '==') not in query_usage.filters
+
+
 def test_wont_overwrite_service_methods(service2):
     """ service2 already implements a get_example_model method.
         Check it is not replaced with the autocrud version.
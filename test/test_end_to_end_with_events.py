@@ -1,11 +1,15 @@
 import pytest
-from mock import call
+from mock import call, patch
 
 from nameko.events import EventDispatcher
+from nameko.rpc import rpc
 from nameko.testing.services import entrypoint_hook
 from nameko_sqlalchemy import DatabaseSession
+from sqlalchemy.orm import Session
 
-from nameko_autocrud import AutoCrudWithEvents
+from nameko_autocrud import (
+    AutoCrudWithEvents, CallbackInstrumentation, DBStorage, make_outbox_model
+)
 
 
 class TestEndToEndWithEvents:
@@ -34,10 +38,99 @@ class TestEndToEndWithEvents:
                 create_method_name='create_example_model',
                 update_method_name='update_example_model',
                 delete_method_name='delete_example_model',
+                upsert_method_name='upsert_example_model',
+                bulk_upsert_method_name='bulk_upsert_example_models',
+                sync_method_name='sync_example_models',
             )
 
         return create_service(ExampleService, 'event_dispatcher')
 
+    def test_sync_with_events(self, service):
+        container = service.container
+
+        with entrypoint_hook(
+            container, "bulk_upsert_example_models"
+        ) as bulk_upsert_example_models:
+            bulk_upsert_example_models([
+                {'id': 1, 'name': 'Bob Dobalina'},
+                {'id': 2, 'name': 'Phil Connors'},
+                {'id': 3, 'name': 'Ned Ryerson'},
+            ])
+        service.event_dispatcher.reset_mock()
+
+        with entrypoint_hook(
+            container, "sync_example_models"
+        ) as sync_example_models:
+            result = sync_example_models([
+                {'id': 1, 'name': 'Bob Dobalina'},
+                {'id': 2, 'name': 'Rita Hanson'},
+                {'id': 4, 'name': 'Buster Green'},
+            ], delete_missing=True)
+
+        assert result == {
+            'created': 1, 'updated': 1, 'deleted': 1, 'unchanged': 1}
+        # no event for the unchanged record
+        assert service.event_dispatcher.call_args_list == [
+            call('example_model_created', {
+                'example_model': {'id': 4, 'name': 'Buster Green'},
+            }),
+            call('example_model_updated', {
+                'example_model': {'id': 2, 'name': 'Rita Hanson'},
+                'changed': ['name'],
+                'before': {'id': 2, 'name': 'Phil Connors'},
+            }),
+            call('example_model_deleted', {
+                'example_model': {'id': 3, 'name': 'Ned Ryerson'},
+            }),
+        ]
+
+    def test_upsert_with_events(self, service):
+        container = service.container
+
+        record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+        record_2 = {'id': 2, 'name': 'Phil Connors'}
+        updated_record_1 = {'id': 1, 'name': 'Ned Ryerson'}
+
+        with entrypoint_hook(
+            container, "upsert_example_model"
+        ) as upsert_example_model:
+
+            result = upsert_example_model(record_1)
+            assert result == record_1
+
+            result = upsert_example_model(updated_record_1)
+            assert result == updated_record_1
+
+            # no change
+            result = upsert_example_model(updated_record_1)
+            assert result == updated_record_1
+
+        assert service.event_dispatcher.call_args_list == [
+            call('example_model_created', {'example_model': record_1}),
+            call('example_model_updated', {
+                'example_model': updated_record_1,
+                'changed': ['name'],
+                'before': record_1,
+            }),
+        ]
+        service.event_dispatcher.reset_mock()
+
+        with entrypoint_hook(
+            container, "bulk_upsert_example_models"
+        ) as bulk_upsert_example_models:
+
+            result = bulk_upsert_example_models([record_1, record_2])
+            assert result == [record_1, record_2]
+
+        assert service.event_dispatcher.call_args_list == [
+            call('example_model_updated', {
+                'example_model': record_1,
+                'changed': ['name'],
+                'before': updated_record_1,
+            }),
+            call('example_model_created', {'example_model': record_2}),
+        ]
+
     def test_end_to_end_with_events(self, service):
         container = service.container
 
@@ -282,3 +375,345 @@ class TestEndToEndWithEventsCustomEventSerializer:
                 {'example_model': {'name': 'Bob Dobalina'}})
         ]
         service.event_dispatcher.reset_mock()
+
+
+class TestEndToEndWithEventsUnitOfWork:
+
+    @pytest.fixture
+    def service(self, create_service, dec_base, example_model):
+
+        class ExampleService(object):
+            name = "exampleservice"
+
+            session = DatabaseSession(dec_base)
+            event_dispatcher = EventDispatcher()
+
+            example_crud = AutoCrudWithEvents(
+                'session',
+                'event_dispatcher',
+                'example_model',
+                model_cls=example_model,
+                unit_of_work=True,
+                create_event_name='example_model_created',
+                update_event_name='example_model_updated',
+                list_method_name='list_example_models',
+                create_method_name='create_example_model',
+            )
+
+            @rpc
+            def create_and_rename(self, record, name, fail=False):
+                self.create_example_model(record)
+                self.example_crud.update(record['id'], {'name': name})
+                if fail:
+                    raise ValueError('boom')
+
+        return create_service(ExampleService, 'event_dispatcher')
+
+    def test_commit_at_end_of_worker(self, service, session):
+        container = service.container
+
+        record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+
+        with entrypoint_hook(
+            container, "create_and_rename"
+        ) as create_and_rename:
+            with patch.object(
+                Session, 'commit', autospec=True, side_effect=Session.commit
+            ) as commit:
+                create_and_rename(record_1, 'Ned Ryerson')
+
+        assert commit.call_count == 1
+
+        with entrypoint_hook(
+            container, "list_example_models"
+        ) as list_example_models:
+            assert list_example_models() == [
+                {'id': 1, 'name': 'Ned Ryerson'}
+            ]
+
+        assert service.event_dispatcher.call_args_list == [
+            call('example_model_created', {'example_model': record_1}),
+        ]
+
+    def test_rollback_on_error(self, service):
+        container = service.container
+
+        record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+
+        with entrypoint_hook(
+            container, "create_and_rename"
+        ) as create_and_rename:
+            with pytest.raises(ValueError):
+                create_and_rename(record_1, 'Ned Ryerson', fail=True)
+
+        with entrypoint_hook(
+            container, "list_example_models"
+        ) as list_example_models:
+            assert list_example_models() == []
+
+        assert service.event_dispatcher.call_args_list == []
+
+    def test_commit_error_is_raised_to_caller(self, service):
+        container = service.container
+
+        record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+
+        with entrypoint_hook(
+            container, "create_and_rename"
+        ) as create_and_rename:
+            with patch.object(
+                Session, 'commit', side_effect=ValueError('commit failed')
+            ):
+                with pytest.raises(ValueError) as exc:
+                    create_and_rename(record_1, 'Ned Ryerson')
+        assert str(exc.value) == 'commit failed'
+
+        # the service is still running, and the changes were rolled back
+        with entrypoint_hook(
+            container, "list_example_models"
+        ) as list_example_models:
+            assert list_example_models() == []
+
+        assert service.event_dispatcher.call_args_list == []
+
+    def test_rollback_error_is_logged(self, service):
+        container = service.container
+
+        with entrypoint_hook(
+            container, "list_example_models"
+        ) as list_example_models:
+            with patch.object(
+                Session, 'rollback', side_effect=ValueError('boom')
+            ), patch('nameko_autocrud.logger') as logger:
+                assert list_example_models() == []
+
+        assert logger.exception.call_count == 1
+
+
+class TestEndToEndWithDeltaUpdateEvents:
+
+    @pytest.fixture
+    def stages(self):
+        return []
+
+    @pytest.fixture
+    def service(
+        self, create_service, dec_base, example_model, stages,
+        full_update_event_name
+    ):
+
+        def record_duration(method_name, model_name, stage, duration):
+            stages.append((method_name, stage))
+
+        def to_event_serializable(obj):
+            return {'id': obj.id, 'name': obj.name, 'more': 'data'}
+
+        class ExampleService(object):
+            name = "exampleservice"
+
+            session = DatabaseSession(dec_base)
+            event_dispatcher = EventDispatcher()
+
+            example_crud = AutoCrudWithEvents(
+                'session',
+                'event_dispatcher',
+                'example_model',
+                model_cls=example_model,
+                to_event_serializable=to_event_serializable,
+                update_event_payload='delta',
+                instrumentation=CallbackInstrumentation(record_duration),
+                update_event_name='example_model_updated',
+                full_update_event_name=full_update_event_name,
+                create_method_name='create_example_model',
+                update_method_name='update_example_model',
+            )
+
+        return create_service(ExampleService, 'event_dispatcher')
+
+    @pytest.fixture(params=[None, 'example_model_updated_full'])
+    def full_update_event_name(self, request):
+        return request.param
+
+    def test_delta_update_events(
+        self, service, stages, full_update_event_name
+    ):
+        container = service.container
+
+        with entrypoint_hook(
+            container, "create_example_model"
+        ) as create_example_model:
+            create_example_model({'id': 1, 'name': 'Bob Dobalina'})
+
+        with entrypoint_hook(
+            container, "update_example_model"
+        ) as update_example_model:
+            result = update_example_model(1, {'name': 'Ned Ryerson'})
+            assert result == {'id': 1, 'name': 'Ned Ryerson'}
+
+            # no change
+            update_example_model(1, {'name': 'Ned Ryerson'})
+
+        expected_calls = [
+            call('example_model_updated', {
+                'example_model': {'id': 1, 'name': 'Ned Ryerson'},
+                'changed': ['name'],
+                'before': {'name': 'Bob Dobalina'},
+            }),
+        ]
+        if full_update_event_name:
+            # only dispatched for the subscribers that opted in
+            expected_calls.append(call('example_model_updated_full', {
+                'example_model': {
+                    'id': 1, 'name': 'Ned Ryerson', 'more': 'data'},
+                'changed': ['name'],
+                'before': {'id': 1, 'name': 'Bob Dobalina', 'more': 'data'},
+            }))
+        assert service.event_dispatcher.call_args_list == expected_calls
+        assert stages.count(('update', 'dispatch')) == len(expected_calls)
+
+
+class TestEndToEndWithEventsOutbox:
+
+    @pytest.fixture
+    def outbox_model(self, dec_base):
+        return make_outbox_model(dec_base)
+
+    @pytest.fixture
+    def service(self, dec_base, outbox_model, create_service, example_model):
+
+        class ExampleService(object):
+            name = "exampleservice"
+
+            session = DatabaseSession(dec_base)
+            event_dispatcher = EventDispatcher()
+
+            example_crud = AutoCrudWithEvents(
+                'session',
+                'event_dispatcher',
+                'example_model',
+                model_cls=example_model,
+                outbox_model=outbox_model,
+                outbox_relay_method_name='relay_outbox',
+                outbox_relay_interval=3600,
+                create_event_name='example_model_created',
+                update_event_name='example_model_updated',
+                delete_event_name='example_model_deleted',
+                list_method_name='list_example_models',
+                create_method_name='create_example_model',
+                update_method_name='update_example_model',
+                delete_method_name='delete_example_model',
+                upsert_method_name='upsert_example_model',
+                bulk_upsert_method_name='bulk_upsert_example_models',
+            )
+
+        return create_service(ExampleService, 'event_dispatcher')
+
+    def test_events_are_relayed(self, service, outbox_model, session):
+        container = service.container
+
+        record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+        record_2 = {'id': 2, 'name': 'Phil Connors'}
+        updated_record_1 = {'id': 1, 'name': 'Ned Ryerson'}
+
+        with entrypoint_hook(
+            container, "create_example_model"
+        ) as create_example_model:
+            create_example_model(record_1)
+
+        with entrypoint_hook(
+            container, "update_example_model"
+        ) as update_example_model:
+            update_example_model(1, {'name': 'Ned Ryerson'})
+
+        with entrypoint_hook(
+            container, "upsert_example_model"
+        ) as upsert_example_model:
+            upsert_example_model(record_2)
+
+        with entrypoint_hook(
+            container, "bulk_upsert_example_models"
+        ) as bulk_upsert_example_models:
+            bulk_upsert_example_models([record_2])
+
+        with entrypoint_hook(
+            container, "delete_example_model"
+        ) as delete_example_model:
+            delete_example_model(2)
+
+        # events are written to the outbox rather than dispatched
+        assert service.event_dispatcher.call_args_list == []
+        assert session.query(outbox_model).count() == 4
+
+        with entrypoint_hook(container, "relay_outbox") as relay_outbox:
+            assert relay_outbox() == 4
+            assert relay_outbox() == 0
+
+        assert service.event_dispatcher.call_args_list == [
+            call('example_model_created', {'example_model': record_1}),
+            call('example_model_updated', {
+                'example_model': updated_record_1,
+                'changed': ['name'],
+                'before': record_1,
+            }),
+            call('example_model_created', {'example_model': record_2}),
+            call('example_model_deleted', {'example_model': record_2}),
+        ]
+
+    def test_change_rolled_back_with_event(self, service, outbox_model):
+        container = service.container
+
+        record_1 = {'id': 1, 'name': 'Bob Dobalina'}
+
+        with entrypoint_hook(
+            container, "create_example_model"
+        ) as create_example_model:
+            create_example_model(record_1)
+
+        with entrypoint_hook(
+            container, "update_example_model"
+        ) as update_example_model:
+            with patch.object(
+                DBStorage, 'add', side_effect=ValueError('boom')
+            ):
+                with pytest.raises(ValueError):
+                    update_example_model(1, {'name': 'Ned Ryerson'})
+
+        with entrypoint_hook(
+            container, "list_example_models"
+        ) as list_example_models:
+            assert list_example_models() == [record_1]
+
+        with entrypoint_hook(container, "relay_outbox") as relay_outbox:
+            assert relay_outbox() == 1
+
+        assert service.event_dispatcher.call_args_list == [
+            call('example_model_created', {'example_model': record_1}),
+        ]
+
+    def test_wont_overwrite_service_methods(
+        self, dec_base, outbox_model, create_service, example_model
+    ):
+
+        class ExampleService(object):
+            name = "exampleservice"
+
+            session = DatabaseSession(dec_base)
+            event_dispatcher = EventDispatcher()
+
+            example_crud = AutoCrudWithEvents(
+                'session',
+                'event_dispatcher',
+                'example_model',
+                model_cls=example_model,
+                outbox_model=outbox_model,
+                outbox_relay_method_name='relay_outbox',
+            )
+
+            @rpc
+            def relay_outbox(self):
+                return 'hello'
+
+        container = create_service(ExampleService).container
+
+        with entrypoint_hook(container, "relay_outbox") as relay_outbox:
+            assert relay_outbox() == 'hello'
@@ -0,0 +1,277 @@
+from mock import Mock, patch
+import pytest
+from sqlalchemy import (
+    Column, ForeignKey, Index, Integer, String, UniqueConstraint
+)
+from sqlalchemy.ext.declarative import declarative_base
+
+from nameko_autocrud.indexes import (
+    QueryUsage, RowCountCache, UnindexedFilter, advise, check_filters_indexed,
+    estimate_row_count, format_advice, get_filter_fields, get_indexed_fields,
+    get_sort_fields, main
+)
+
+Base = declarative_base(name='indexesbase')
+
+
+class IndexedModel(Base):
+    __tablename__ = 'indexed'
+    __table_args__ = (
+        Index('ix_indexed_name_score', 'name', 'score'),
+        UniqueConstraint('code'),
+    )
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    score = Column(Integer)
+    code = Column(String)
+    email = Column(String, index=True)
+    city = Column(String)
+    parent_id = Column(Integer, ForeignKey('indexed.id'))
+
+
+class TestGetFilterFields:
+
+    def test_no_filters(self):
+        assert get_filter_fields(None) == []
+
+    def test_single_filter(self):
+        assert get_filter_fields({'field': 'name', 'op': 'like'}) == [
+            ('name', 'like')]
+
+    def test_default_op(self):
+        assert get_filter_fields([{'field': 'name'}]) == [('name', '==')]
+
+    def test_boolean_functions(self):
+        filters = [
+            {'or': [
+                {'field': 'name', 'op': '==', 'value': 'a'},
+                {'not': [{'field': 'score', 'op': '>', 'value': 1}]},
+            ]},
+            {'and': [{'field': 'city', 'op': 'in', 'value': ['x']}]},
+        ]
+        assert get_filter_fields(filters) == [
+            ('name', '=='), ('score', '>'), ('city', 'in')]
+
+    def test_other_models(self):
+        filters = [
+            {'model': 'Other', 'field': 'name', 'op': '=='},
+            {'model': 'Example', 'field': 'city', 'op': '=='},
+            {'field': 'score', 'op': '=='},
+        ]
+        assert get_filter_fields(filters, 'Example') == [
+            ('city', '=='), ('score', '==')]
+
+    def test_invalid_specs(self):
+        assert get_filter_fields(['name', {'op': '=='}]) == []
+
+
+class TestGetSortFields:
+
+    def test_no_sort(self):
+        assert get_sort_fields(None) == []
+
+    def test_sort(self):
+        order_by = [
+            {'field': 'name'},
+            {'field': 'score', 'direction': 'desc'},
+            {'model': 'Other', 'field': 'city'},
+            'invalid',
+        ]
+        assert get_sort_fields(order_by, 'Example') == [
+            ('name', 'asc'), ('score', 'desc')]
+
+    def test_single_sort(self):
+        assert get_sort_fields({'field': 'name'}) == [('name', 'asc')]
+
+
+def test_get_indexed_fields():
+    # only the leading column of multi-column indexes, and not foreign keys
+    assert get_indexed_fields(IndexedModel) == {'id', 'name', 'code', 'email'}
+
+
+class TestCheckFiltersIndexed:
+
+    def test_indexed(self):
+        check_filters_indexed(IndexedModel, [
+            {'field': 'name', 'op': '==', 'value': 'a'},
+            {'field': 'id', 'op': '>', 'value': 1},
+        ])
+        check_filters_indexed(IndexedModel, None)
+
+    def test_unindexed(self):
+        with pytest.raises(UnindexedFilter) as exc:
+            check_filters_indexed(IndexedModel, {'or': [
+                {'field': 'score', 'op': '==', 'value': 1},
+                {'field': 'city', 'op': '==', 'value': 'x'},
+                {'field': 'city', 'op': 'in', 'value': ['x']},
+            ]})
+        assert str(exc.value) == (
+            "Filtering IndexedModel on unindexed field(s) ['city', 'score'] "
+            "is not allowed")
+
+    def test_min_rows(self):
+        filters = [{'field': 'city', 'op': '==', 'value': 'x'}]
+        count_rows = Mock(return_value=99)
+        check_filters_indexed(IndexedModel, filters, 100, count_rows)
+        count_rows.return_value = 100
+        with pytest.raises(UnindexedFilter):
+            check_filters_indexed(IndexedModel, filters, 100, count_rows)
+
+        count_rows.reset_mock()
+        check_filters_indexed(
+            IndexedModel, [{'field': 'id', 'op': '==', 'value': 1}], 100,
+            count_rows)
+        assert not count_rows.called
+
+
+def test_row_count_cache():
+    cache = RowCountCache(ttl=60)
+    count_rows = Mock(side_effect=[10, 20])
+    with patch('nameko_autocrud.indexes.time.time', return_value=100):
+        assert cache.get(count_rows) == 10
+    with patch('nameko_autocrud.indexes.time.time', return_value=159):
+        assert cache.get(count_rows) == 10
+    with patch('nameko_autocrud.indexes.time.time', return_value=160):
+        assert cache.get(count_rows) == 20
+    assert count_rows.call_count == 2
+
+
+class TestEstimateRowCount:
+
+    @pytest.mark.parametrize('dialect, estimate, expected', [
+        ('postgresql', 1234.0, 1234),
+        ('postgresql', -1.0, 0),
+        ('postgresql', None, 0),
+        ('mysql', 56, 56),
+    ])
+    def test_estimated(self, dialect, estimate, expected):
+        session = Mock()
+        session.get_bind.return_value.dialect.name = dialect
+        session.execute.return_value.scalar.return_value = estimate
+
+        assert estimate_row_count(session, IndexedModel) == expected
+        (statement, params), _ = session.execute.call_args
+        assert params == {'table': 'indexed'}
+        assert not session.query.called
+
+    def test_counted(self):
+        session = Mock()
+        session.get_bind.return_value.dialect.name = 'sqlite'
+        select_from = session.query.return_value.select_from
+        select_from.return_value.scalar.return_value = 7
+
+        assert estimate_row_count(session, IndexedModel) == 7
+        select_from.assert_called_once_with(
+            IndexedModel.__table__)
+        assert not session.execute.called
+
+
+@pytest.fixture
+def query_usage():
+    usage = QueryUsage()
+    usage.record(
+        'IndexedModel',
+        [
+            {'field': 'city', 'op': '==', 'value': 'x'},
+            {'field': 'name', 'op': '==', 'value': 'a'},
+        ],
+        [{'field': 'score', 'direction': 'desc'}],
+        0.5)
+    usage.record(
+        'IndexedModel',
+        [{'field': 'city', 'op': 'in', 'value': ['x']}],
+        [{'field': 'score'}],
+        1.5)
+    usage.record(
+        'IndexedModel', {'field': 'city', 'op': '==', 'value': 'y'}, None,
+        0.25)
+    usage.record('Other', [{'field': 'city', 'op': '=='}], None, 10)
+    return usage
+
+
+class TestQueryUsage:
+
+    def test_record(self, query_usage):
+        city = query_usage.filters[('IndexedModel', 'city', '==')]
+        assert (city.count, city.total_time, city.max_time) == (2, 0.75, 0.5)
+        score = query_usage.sorts[('IndexedModel', 'score', 'asc')]
+        assert (score.count, score.total_time, score.max_time) == (
+            1, 1.5, 1.5)
+
+    def test_field_recorded_once_per_query(self):
+        usage = QueryUsage()
+        usage.record('Example', [
+            {'field': 'name', 'op': '==', 'value': 'a'},
+            {'field': 'name', 'op': '==', 'value': 'b'},
+        ], None, 1)
+        assert usage.filters[('Example', 'name', '==')].count == 1
+
+    def test_to_dict(self, query_usage):
+        data = query_usage.to_dict()
+        assert data['filters'][0] == {
+            'model': 'IndexedModel', 'field': 'city', 'op': '==',
+            'count': 2, 'total_time': 0.75, 'max_time': 0.5,
+        }
+        assert len(data['filters']) == 4
+        assert data['sorts'] == [
+            {
+                'model': 'IndexedModel', 'field': 'score',
+                'direction': 'asc', 'count': 1, 'total_time': 1.5,
+                'max_time': 1.5,
+            },
+            {
+                'model': 'IndexedModel', 'field': 'score',
+                'direction': 'desc', 'count': 1, 'total_time': 0.5,
+                'max_time': 0.5,
+            },
+        ]
+
+    def test_dump_and_load(self, query_usage, tmpdir):
+        path = tmpdir.join('usage.json').strpath
+        query_usage.dump(path)
+        assert QueryUsage.load(path).to_dict() == query_usage.to_dict()
+
+
+class TestAdvise:
+
+    def test_advise(self, query_usage):
+        assert advise(query_usage, [IndexedModel]) == [
+            {
+                'model': 'IndexedModel', 'table': 'indexed', 'field': 'city',
+                'filter_ops': ['==', 'in'], 'filter_count': 3,
+                'sort_count': 0, 'total_time': 2.25, 'max_time': 1.5,
+            },
+            {
+                'model': 'IndexedModel', 'table': 'indexed',
+                'field': 'score', 'filter_ops': [], 'filter_count': 0,
+                'sort_count': 2, 'total_time': 2.0, 'max_time': 1.5,
+            },
+        ]
+
+    def test_all_indexed(self):
+        usage = QueryUsage()
+        usage.record('IndexedModel', [{'field': 'name'}], None, 1)
+        assert advise(usage, [IndexedModel]) == []
+
+    def test_format_advice(self, query_usage):
+        assert format_advice(advise(query_usage, [IndexedModel])) == (
+            'IndexedModel.city: filtered 3 times (==, in), 2.250s total, '
+            '1.500s max; consider an index on indexed(city)\n'
+            'IndexedModel.score: sorted 2 times, 2.000s total, 1.500s max; '
+            'consider an index on indexed(score)'
+        )
+
+    def test_format_no_advice(self):
+        assert format_advice([]) == (
+            'All filtered and sorted fields are indexed.')
+
+
+def test_main(query_usage, tmpdir, capsys):
+    path = tmpdir.join('usage.json').strpath
+    query_usage.dump(path)
+
+    main([path, 'test.test_indexes:IndexedModel'])
+
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == format_advice(
+        advise(query_usage, [IndexedModel])).splitlines()
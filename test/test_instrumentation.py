@@ -0,0 +1,83 @@
+from mock import Mock, call
+
+from nameko_autocrud.instrumentation import (
+    NULL_TRACE, CallbackInstrumentation, Histogram, HistogramInstrumentation,
+    Instrumentation
+)
+
+
+class TestInstrumentation:
+
+    def test_disabled(self):
+        trace = Instrumentation().start_call('get', 'Model')
+        assert trace is NULL_TRACE
+        with trace.stage('execute'):
+            trace.rows(1)
+
+    def test_base_records_nothing(self):
+        instrumentation = Instrumentation()
+        instrumentation.enabled = True
+        trace = instrumentation.start_call('get', 'Model')
+        with trace.stage('execute'):
+            trace.rows(1)
+
+
+class TestHistogram:
+
+    def test_observe(self):
+        histogram = Histogram((1, 10, float('inf')))
+        assert histogram.percentile(50) is None
+
+        for value in (0.5, 0.5, 2, 20):
+            histogram.observe(value)
+
+        assert histogram.percentile(50) == 1
+        assert histogram.percentile(75) == 10
+        assert histogram.percentile(99) == float('inf')
+        assert histogram.to_dict() == {
+            'count': 4,
+            'sum': 23,
+            'buckets': {1: 2, 10: 1, float('inf'): 1},
+        }
+
+
+class TestHistogramInstrumentation:
+
+    def test_record(self):
+        instrumentation = HistogramInstrumentation()
+        trace = instrumentation.start_call('list', 'Model')
+        with trace.stage('execute'):
+            pass
+        trace.rows(5)
+
+        snapshot = instrumentation.snapshot()
+        assert set(snapshot) == {
+            ('list', 'Model', 'execute'), ('list', 'Model', 'rows')
+        }
+        assert snapshot[('list', 'Model', 'execute')]['count'] == 1
+        assert snapshot[('list', 'Model', 'rows')]['buckets'][10] == 1
+
+
+class TestCallbackInstrumentation:
+
+    def test_callbacks(self):
+        on_duration = Mock()
+        on_rows = Mock()
+        instrumentation = CallbackInstrumentation(on_duration, on_rows)
+
+        trace = instrumentation.start_call('get', 'Model')
+        with trace.stage('serialize'):
+            pass
+        trace.rows(1)
+
+        (method_name, model_name, stage, duration), _ = on_duration.call_args
+        assert (method_name, model_name, stage) == (
+            'get', 'Model', 'serialize')
+        assert duration >= 0
+        assert on_rows.call_args == call('get', 'Model', 1)
+
+    def test_without_rows_callback(self):
+        on_duration = Mock()
+        trace = CallbackInstrumentation(on_duration).start_call('get', 'M')
+        trace.rows(1)
+        assert not on_duration.called
@@ -0,0 +1,69 @@
+import eventlet
+import pytest
+
+from nameko_autocrud.limits import ConcurrencyLimiter, TooManyRequests
+
+
+class TestConcurrencyLimiter:
+
+    def run_concurrently(self, limiter, num_calls):
+        running = []
+        max_running = []
+
+        def call():
+            with limiter.limit():
+                running.append(None)
+                max_running.append(len(running))
+                eventlet.sleep(0.01)
+                running.pop()
+            return 'done'
+
+        def safe_call():
+            try:
+                return call()
+            except TooManyRequests as exc:
+                return exc
+
+        threads = [eventlet.spawn(safe_call) for _ in range(num_calls)]
+        return [thread.wait() for thread in threads], max(max_running)
+
+    def test_limit_with_queue(self):
+        limiter = ConcurrencyLimiter('list', 2, 1)
+        results, max_running = self.run_concurrently(limiter, 4)
+
+        assert results[:3] == ['done'] * 3
+        assert isinstance(results[3], TooManyRequests)
+        assert str(results[3]) == 'Too many concurrent list requests'
+        assert max_running == 2
+        assert limiter.queued == 0
+
+    def test_limit_without_queue(self):
+        limiter = ConcurrencyLimiter('list', 1)
+        results, max_running = self.run_concurrently(limiter, 2)
+
+        assert results[0] == 'done'
+        assert isinstance(results[1], TooManyRequests)
+
+    def test_released_on_error(self):
+        limiter = ConcurrencyLimiter('list', 1)
+        with pytest.raises(ValueError):
+            with limiter.limit():
+                raise ValueError()
+
+        with limiter.limit():
+            pass
+
+    @pytest.mark.parametrize('config, expected', [
+        (3, (3, 0)),
+        ((3, 5), (3, 5)),
+        ([3, 5], (3, 5)),
+    ])
+    def test_from_config(self, config, expected):
+        limiter = ConcurrencyLimiter.from_config('list', config)
+        assert (limiter.semaphore.balance, limiter.max_queued) == expected
+
+    @pytest.mark.parametrize('max_concurrent, max_queued', [(0, 0), (1, -1)])
+    def test_invalid(self, max_concurrent, max_queued):
+        with pytest.raises(ValueError) as exc:
+            ConcurrencyLimiter('list', max_concurrent, max_queued)
+        assert 'Invalid concurrency limit for list' in str(exc)
@@ -1,6 +1,14 @@
+from datetime import datetime
+
 import pytest
+from mock import Mock, call, patch
 
-from nameko_autocrud.managers import CrudManager
+from nameko_autocrud.managers import CrudManager, CrudManagerWithEvents
+from nameko_autocrud.serializers import (
+    default_to_serializable, get_default_from_serializable
+)
+from nameko_autocrud.storage import DBStorage
+from nameko_autocrud.testing import count_statements
 
 
 class TestCrudManager:
@@ -16,3 +24,399 @@ class TestCrudManager:
         with pytest.raises(ValueError) as exc:
             manager.page(1, 0)
         assert 'Invalid page_num (0)' in str(exc)
+
+    def test_invalid_page_strategy(self):
+        with pytest.raises(ValueError) as exc:
+            CrudManager(None, None, page_strategy='magic')
+        assert 'Invalid page_strategy (magic)' in str(exc)
+
+    def test_invalid_update_event_payload(self):
+        with pytest.raises(ValueError) as exc:
+            CrudManagerWithEvents(
+                None, None, dispatcher_accessor=lambda service: None,
+                update_event_payload='some')
+        assert 'Invalid update_event_payload (some)' in str(exc)
+
+    def test_invalid_format(self):
+        manager = CrudManager(None, None)
+        with pytest.raises(ValueError) as exc:
+            manager.list(format='xml')
+        assert 'Invalid format (xml)' in str(exc)
+
+
+@pytest.fixture
+def instances(example_model, session):
+    session.add_all([
+        example_model(id=1, name='foo'),
+        example_model(id=2, name='bar'),
+        example_model(id=3, name='baz'),
+    ])
+    session.commit()
+
+
+@pytest.fixture
+def make_manager(example_model, session):
+    def make(storage_cls=DBStorage, to_serializable=None, **kwargs):
+        return CrudManager(
+            None, None,
+            db_storage=storage_cls(example_model, session=session),
+            to_serializable=to_serializable or default_to_serializable,
+            from_serializable=get_default_from_serializable(example_model),
+            **kwargs
+        )
+    return make
+
+
+class TestCrudManagerList:
+
+    def test_list_rows(self, instances, make_manager):
+        manager = make_manager()
+        assert manager._can_list_rows()
+
+        results = manager.list(
+            filters=[{'field': 'id', 'op': '>', 'value': 1}],
+            order_by=[{'field': 'name', 'direction': 'asc'}],
+            offset=1, limit=1
+        )
+        assert results == [{'id': 3, 'name': 'baz'}]
+
+        assert manager.list(format='columnar') == {
+            'columns': ['id', 'name'],
+            'rows': [[1, 'foo'], [2, 'bar'], [3, 'baz']],
+        }
+
+    def test_list_instances_with_custom_serializer(
+        self, instances, make_manager
+    ):
+        manager = make_manager(
+            to_serializable=lambda obj: {'name': obj.name})
+        assert not manager._can_list_rows()
+
+        assert manager.list(limit=2) == [{'name': 'foo'}, {'name': 'bar'}]
+        assert manager.list(limit=2, format='columnar') == {
+            'columns': ['name'],
+            'rows': [['foo'], ['bar']],
+        }
+
+    def test_list_instances_with_custom_query(
+        self, instances, make_manager, example_model
+    ):
+        class CustomStorage(DBStorage):
+            @property
+            def query(self):
+                return super(CustomStorage, self).query.filter(
+                    example_model.name == 'baz')
+
+        manager = make_manager(storage_cls=CustomStorage)
+        assert not manager._can_list_rows()
+
+        assert manager.list() == [{'id': 3, 'name': 'baz'}]
+
+
+class TestCrudManagerChangesSince:
+
+    @pytest.fixture
+    def manager(self, versioned_model, session):
+        session.add_all([
+            versioned_model(
+                id=1, name='foo', updated_at=datetime(2020, 1, 2)),
+            versioned_model(
+                id=2, name='bar', updated_at=datetime(2020, 1, 1)),
+            versioned_model(
+                id=3, name='baz', updated_at=datetime(2020, 1, 2)),
+            versioned_model(id=4, name='new', updated_at=None),
+        ])
+        session.commit()
+        return CrudManager(
+            None, None,
+            db_storage=DBStorage(versioned_model, session=session),
+            to_serializable=default_to_serializable,
+            from_serializable=get_default_from_serializable(versioned_model),
+            changes_column='updated_at', changes_batch_size=2,
+        )
+
+    def test_changes_since(self, manager):
+        changes = manager.changes_since()
+        assert [result['id'] for result in changes['results']] == [2, 1]
+        assert changes['cursor'] == ['2020-01-02T00:00:00', 1]
+        assert changes['more'] is True
+
+        changes = manager.changes_since(changes['cursor'])
+        assert changes == {
+            'results': [{
+                'id': 3, 'name': 'baz', 'updated_at': '2020-01-02T00:00:00',
+            }],
+            'cursor': ['2020-01-02T00:00:00', 3],
+            'more': False,
+        }
+
+        # nothing changed since
+        assert manager.changes_since(changes['cursor']) == {
+            'results': [], 'cursor': changes['cursor'], 'more': False,
+        }
+
+    def test_limit(self, manager):
+        changes = manager.changes_since(limit=1)
+        assert [result['id'] for result in changes['results']] == [2]
+        assert changes['more'] is True
+
+        with pytest.raises(ValueError) as exc:
+            manager.changes_since(limit=3)
+        assert 'Invalid limit (3), the maximum is 2' in str(exc)
+        with pytest.raises(ValueError):
+            manager.changes_since(limit=0)
+
+    @pytest.mark.parametrize('cursor', [
+        '2020-01-02T00:00:00', ['2020-01-02T00:00:00'], {'id': 1},
+    ])
+    def test_invalid_cursor(self, manager, cursor):
+        with pytest.raises(ValueError) as exc:
+            manager.changes_since(cursor)
+        assert 'Invalid cursor' in str(exc)
+
+
+class TestCrudManagerDeferredColumns:
+
+    @pytest.fixture
+    def make_manager(self, document_model, session):
+        session.add(document_model(id=1, title='foo', body='text'))
+        session.commit()
+        session.expunge_all()
+
+        class DocumentStorage(DBStorage):
+            # customized, so instances are listed
+            @property
+            def query(self):
+                return super(DocumentStorage, self).query
+
+        def make(to_serializable=default_to_serializable):
+            storage = DocumentStorage(document_model, session=session)
+            storage.deferred_columns = ('body', 'attachment')
+            return CrudManager(
+                None, None, db_storage=storage,
+                to_serializable=to_serializable,
+                from_serializable=get_default_from_serializable(
+                    document_model),
+            )
+        return make
+
+    def test_list_instances(self, make_manager, session):
+        manager = make_manager()
+        assert manager.list() == [{'id': 1, 'title': 'foo'}]
+        assert manager.list(format='columnar') == {
+            'columns': ['id', 'title'], 'rows': [[1, 'foo']]}
+        assert manager.page(10, 1, include_columns=['body'])['results'] == [
+            {'id': 1, 'title': 'foo', 'body': 'text'}]
+
+    def test_custom_serializer(self, make_manager):
+        manager = make_manager(to_serializable=lambda obj: {'body': obj.body})
+        storage = manager.db_storage
+        with patch.object(storage, 'list', wraps=storage.list) as list_:
+            assert manager.list() == [{'body': 'text'}]
+        # selected by the query, rather than lazily loaded by the serializer
+        _, kwargs = list_.call_args
+        assert kwargs['include_columns'] == ('body', 'attachment')
+
+    def test_model_to_dict(self, make_manager, document_model):
+        document_model.to_dict = lambda obj: {'id': obj.id, 'body': obj.body}
+        manager = make_manager()
+        storage = manager.db_storage
+        with patch.object(storage, 'list', wraps=storage.list) as list_:
+            # the keys of deferred columns are still left out
+            assert manager.list() == [{'id': 1}]
+        _, kwargs = list_.call_args
+        assert kwargs['include_columns'] == ('body', 'attachment')
+
+
+class TestCrudManagerPage:
+
+    @pytest.fixture(params=[None, 'concurrent', 'window'])
+    def page_strategy(self, request):
+        return request.param
+
+    @pytest.mark.parametrize('to_serializable', [
+        None, lambda obj: {'id': obj.id, 'name': obj.name}
+    ])
+    def test_page(
+        self, instances, make_manager, page_strategy, to_serializable
+    ):
+        manager = make_manager(
+            page_strategy=page_strategy, to_serializable=to_serializable)
+
+        assert manager.page(2, 2) == {
+            'results': [{'id': 3, 'name': 'baz'}],
+            'num_pages': 2,
+            'num_results': 3,
+            'page_num': 2,
+        }
+        assert manager.page(
+            1, 1, filters=[{'field': 'id', 'op': '>', 'value': 1}],
+            order_by=[{'field': 'id', 'direction': 'desc'}],
+            format='columnar'
+        ) == {
+            'results': {'columns': ['id', 'name'], 'rows': [[3, 'baz']]},
+            'num_pages': 2,
+            'num_results': 2,
+            'page_num': 1,
+        }
+
+    def test_page_beyond_results(
+        self, instances, make_manager, page_strategy
+    ):
+        manager = make_manager(page_strategy=page_strategy)
+
+        assert manager.page(2, 3) == {
+            'results': [],
+            'num_pages': 2,
+            'num_results': 3,
+            'page_num': 3,
+        }
+
+    def test_window_not_supported(self, instances, make_manager):
+        manager = make_manager(page_strategy='window')
+
+        with patch.object(
+            DBStorage, 'supports_window_count', return_value=False
+        ), patch.object(
+            DBStorage, 'list_rows', wraps=manager.db_storage.list_rows
+        ) as list_rows:
+            result = manager.page(2, 1)
+
+        assert result['num_results'] == 3
+        assert list_rows.call_args[1].get('with_total') is None
+
+    def test_concurrent_after_write(self, instances, make_manager, session):
+        manager = make_manager(page_strategy='concurrent')
+        manager.db_storage.create({'id': 4, 'name': 'NEW'}, commit=False)
+
+        # the count must see the uncommitted row
+        result = manager.page(10, 1)
+        assert result['num_results'] == 4
+        assert len(result['results']) == 4
+
+    @pytest.mark.parametrize('page_strategy', [None, 'concurrent'])
+    def test_list_error(
+        self, instances, make_manager, page_strategy
+    ):
+        manager = make_manager(page_strategy=page_strategy)
+        count_thread = Mock()
+
+        with patch.object(
+            DBStorage, 'spawn_count', return_value=count_thread
+        ), patch.object(
+            DBStorage, 'list_rows', side_effect=ValueError('boom')
+        ):
+            with pytest.raises(ValueError):
+                manager.page(2, 1)
+
+        # the concurrent count is killed
+        assert count_thread.kill.call_count == (
+            1 if page_strategy == 'concurrent' else 0)
+
+
+class TestCrudManagerWithEventsSerialization:
+
+    @pytest.fixture
+    def to_serializable(self):
+        return Mock(wraps=default_to_serializable)
+
+    @pytest.fixture
+    def dispatcher(self):
+        return Mock()
+
+    @pytest.fixture
+    def manager(self, example_model, session, to_serializable, dispatcher):
+        return CrudManagerWithEvents(
+            None, None,
+            db_storage=DBStorage(example_model, session=session),
+            to_serializable=to_serializable,
+            from_serializable=get_default_from_serializable(example_model),
+            dispatcher_accessor=lambda service: dispatcher,
+            event_entity_name='example',
+            create_event_name='created',
+            update_event_name='updated',
+            delete_event_name='deleted',
+        )
+
+    def test_create(self, manager, to_serializable, dispatcher):
+        result = manager.create({'id': 4, 'name': 'NEW'})
+        assert result == {'id': 4, 'name': 'NEW'}
+        assert to_serializable.call_count == 1
+
+        # the event has a copy of the result
+        event_data = dispatcher.call_args[0][1]['example']
+        assert event_data == result
+        assert event_data is not result
+
+    def test_update(self, instances, manager, to_serializable, dispatcher):
+        result = manager.update(1, {'name': 'CHANGE'})
+        assert result == {'id': 1, 'name': 'CHANGE'}
+        # before & after the update
+        assert to_serializable.call_count == 2
+        assert dispatcher.call_args[0][1] == {
+            'example': result,
+            'changed': ['name'],
+            'before': {'id': 1, 'name': 'foo'},
+        }
+
+    def test_delete(self, instances, manager, to_serializable):
+        assert manager.delete(1) == {'id': 1, 'name': 'foo'}
+        assert to_serializable.call_count == 1
+
+    def test_upserts(self, instances, manager, to_serializable):
+        assert manager.upsert({'id': 1, 'name': 'CHANGE'}) == {
+            'id': 1, 'name': 'CHANGE'}
+        assert to_serializable.call_count == 2
+        to_serializable.reset_mock()
+
+        assert manager.bulk_upsert([{'id': 5, 'name': 'NEW'}]) == [
+            {'id': 5, 'name': 'NEW'}]
+        assert to_serializable.call_count == 1
+
+    def test_bulk_upsert_event_per_row(self, instances, manager, dispatcher):
+        assert manager.bulk_upsert([
+            {'id': 5, 'name': 'a'},
+            {'id': 1, 'name': 'CHANGE'},
+            {'id': 5, 'name': 'b'},
+        ]) == [
+            {'id': 5, 'name': 'b'},
+            {'id': 1, 'name': 'CHANGE'},
+            {'id': 5, 'name': 'b'},
+        ]
+        assert dispatcher.call_args_list == [
+            call('created', {'example': {'id': 5, 'name': 'b'}}),
+            call('updated', {
+                'example': {'id': 1, 'name': 'CHANGE'},
+                'changed': ['name'],
+                'before': {'id': 1, 'name': 'foo'},
+            }),
+        ]
+
+    def test_bulk_upsert_statements(self, instances, manager, dispatcher):
+        records = [{'id': id_, 'name': 'name'} for id_ in range(1, 21)]
+        with count_statements() as statements:
+            manager.bulk_upsert(records)
+        assert dispatcher.call_count == 20
+
+        selects = [
+            stmt for stmt in statements.statements
+            if stmt.statement.startswith('SELECT')
+        ]
+        # the rows before, the existing rows for the upsert fallback and
+        # the resulting rows
+        assert len(selects) == 3
+
+    def test_custom_event_serializer(self, example_model, session, dispatcher):
+        manager = CrudManagerWithEvents(
+            None, None,
+            db_storage=DBStorage(example_model, session=session),
+            to_serializable=default_to_serializable,
+            from_serializable=get_default_from_serializable(example_model),
+            to_event_serializable=lambda obj: {'id': obj.id},
+            dispatcher_accessor=lambda service: dispatcher,
+            event_entity_name='example',
+            create_event_name='created',
+        )
+        assert manager.create({'id': 4, 'name': 'NEW'}) == {
+            'id': 4, 'name': 'NEW'}
+        assert dispatcher.call_args[0][1] == {'example': {'id': 4}}
@@ -0,0 +1,56 @@
+import pytest
+from mock import Mock, call
+
+from nameko_autocrud.outbox import (
+    make_outbox_event, make_outbox_model, relay_events
+)
+
+
+@pytest.fixture
+def outbox_model(dec_base):
+    return make_outbox_model(dec_base)
+
+
+@pytest.fixture
+def events(outbox_model, session):
+    events_ = [
+        make_outbox_event(outbox_model, 'created', {'id': id_})
+        for id_ in range(1, 6)
+    ]
+    session.add_all(events_)
+    session.commit()
+    return events_
+
+
+def get_pending(outbox_model, session):
+    return [
+        event.id for event in session.query(outbox_model)
+        .filter(outbox_model.sent_at.is_(None))
+    ]
+
+
+class TestRelayEvents:
+
+    def test_relay(self, outbox_model, events, session):
+        dispatch = Mock()
+        assert relay_events(
+            session, outbox_model, dispatch, batch_size=2) == 5
+
+        assert dispatch.call_args_list == [
+            call('created', {'id': id_}) for id_ in range(1, 6)
+        ]
+        assert get_pending(outbox_model, session) == []
+
+        # sent events are not relayed again
+        dispatch.reset_mock()
+        assert relay_events(session, outbox_model, dispatch) == 0
+        assert not dispatch.called
+
+    def test_dispatch_failure(self, outbox_model, events, session):
+        dispatch = Mock(side_effect=[None, None, None, ValueError('boom')])
+        with pytest.raises(ValueError):
+            relay_events(session, outbox_model, dispatch, batch_size=2)
+
+        # events dispatched before the failure are marked sent
+        session.rollback()
+        assert get_pending(outbox_model, session) == [4, 5]
@@ -0,0 +1,155 @@
+import json
+import os
+
+from mock import patch
+import pytest
+
+from nameko_autocrud.profiling import SlowCallProfiler
+
+
+@pytest.fixture
+def directory(tmpdir):
+    return tmpdir.join('profiles').strpath
+
+
+def read_records(directory):
+    return [
+        json.load(open(os.path.join(directory, name)))
+        for name in sorted(os.listdir(directory)) if name.endswith('.json')
+    ]
+
+
+class TestSlowCallProfiler:
+
+    def test_slow_call(self, directory, session):
+        profiler = SlowCallProfiler(directory, threshold=0, explain=True)
+
+        with profiler.profiling('list', 'Model', session):
+            session.execute('SELECT 1 WHERE 1 = :one', {'one': 1})
+
+        [record] = read_records(directory)
+        assert record['method'] == 'list'
+        assert record['model'] == 'Model'
+        assert record['duration'] > 0
+        [statement] = record['statements']
+        assert statement['statement'] == 'SELECT 1 WHERE 1 = ?'
+        assert statement['parameters'] == '(1,)'
+        [explained] = record['explain']
+        assert explained['statement'] == 'SELECT 1 WHERE 1 = ?'
+        assert explained['plan']
+        assert 'cumulative' in record['profile']
+
+        assert len([
+            name for name in os.listdir(directory) if name.endswith('.prof')
+        ]) == 1
+
+    def test_fast_call(self, directory, session):
+        profiler = SlowCallProfiler(directory, threshold=10)
+        with profiler.profiling('list', 'Model', session):
+            session.execute('SELECT 1')
+        assert not os.path.exists(directory)
+
+    def test_slow_call_with_error(self, directory, session):
+        profiler = SlowCallProfiler(directory, threshold=0)
+        with pytest.raises(ValueError):
+            with profiler.profiling('get', 'Model', session):
+                session.execute('SELECT 1')
+                raise ValueError('boom')
+
+        [record] = read_records(directory)
+        assert record['method'] == 'get'
+        assert record['explain'] is None
+        assert len(record['statements']) == 1
+
+    def test_one_profile_at_a_time(self, directory, session):
+        profiler = SlowCallProfiler(directory, threshold=0)
+        with profiler.profiling('list', 'Outer', session):
+            with profiler.profiling('list', 'Inner', session):
+                pass
+
+        records = read_records(directory)
+        assert {
+            record['model']: record['profile'] is not None
+            for record in records
+        } == {'Outer': True, 'Inner': False}
+
+        # profiling is available again
+        with profiler.profiling('list', 'Next', session):
+            pass
+        assert read_records(directory)[-1]['profile'] is not None
+
+    def test_without_profile(self, directory, session):
+        profiler = SlowCallProfiler(directory, threshold=0, profile=False)
+        with profiler.profiling('list', 'Model', session):
+            pass
+        [record] = read_records(directory)
+        assert record['profile'] is None
+
+    def test_explain_only_selects(self, directory, session):
+        profiler = SlowCallProfiler(
+            directory, threshold=0, explain=True, profile=False)
+        with profiler.profiling('count', 'Model', session):
+            session.execute('CREATE TABLE other (id INTEGER)')
+            session.execute('SELECT * FROM other')
+            session.execute('DROP TABLE other')
+
+        [record] = read_records(directory)
+        assert len(record['statements']) == 3
+        [explained] = record['explain']
+        assert explained['statement'] == 'SELECT * FROM other'
+        # the table no longer exists
+        assert explained['plan'].startswith('failed to explain')
+
+    def test_explain_unsupported_dialect(self, directory, session):
+        profiler = SlowCallProfiler(
+            directory, threshold=0, explain=True, profile=False)
+        with patch.object(session.get_bind().dialect, 'name', 'other'):
+            with profiler.profiling('list', 'Model', session):
+                session.execute('SELECT 1')
+
+        [record] = read_records(directory)
+        assert record['explain'] is None
+
+    def test_rotation(self, directory, session):
+        profiler = SlowCallProfiler(directory, threshold=0, max_files=2)
+        for model_name in ('First', 'Second', 'Third'):
+            with profiler.profiling('get', model_name, session):
+                pass
+
+        assert [
+            record['model'] for record in read_records(directory)
+        ] == ['Second', 'Third']
+        assert len(os.listdir(directory)) == 4
+
+    def test_rotation_without_profiles(self, directory, session):
+        profiler = SlowCallProfiler(
+            directory, threshold=0, max_files=1, profile=False)
+        for model_name in ('First', 'Second'):
+            with profiler.profiling('get', model_name, session):
+                pass
+
+        assert os.listdir(directory) == [
+            name for name in os.listdir(directory) if 'Second' in name
+        ]
+
+    @pytest.mark.parametrize('max_files', [0, -1])
+    def test_invalid_max_files(self, directory, max_files):
+        with pytest.raises(ValueError) as exc:
+            SlowCallProfiler(directory, threshold=0, max_files=max_files)
+        assert 'Invalid max_files ({})'.format(max_files) in str(exc.value)
+
+    def test_write_error_logged(self, directory, session):
+        profiler = SlowCallProfiler(directory, threshold=0)
+
+        with patch.object(
+            profiler, '_write', side_effect=OSError('disk full')
+        ), patch('nameko_autocrud.profiling.logger') as logger:
+            with profiler.profiling('get', 'Model', session):
+                pass
+
+            # the error of the call isn't replaced
+            with pytest.raises(ValueError):
+                with profiler.profiling('get', 'Model', session):
+                    raise ValueError('boom')
+
+        assert logger.exception.call_count == 2
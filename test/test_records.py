@@ -0,0 +1,48 @@
+import pytest
+from sqlalchemy import Column, Integer
+from sqlalchemy.ext.declarative import declarative_base
+
+from nameko_autocrud.records import get_record_cls
+
+
+def test_record_cls(example_model):
+    record_cls = get_record_cls(example_model)
+    assert record_cls.__name__ == 'ExampleModelRecord'
+    assert record_cls._fields == ('id', 'name')
+    assert record_cls(1, 'foo') == (1, 'foo')
+    assert record_cls._column_names == ('id', 'name')
+
+    # created once
+    assert get_record_cls(example_model) is record_cls
+
+
+def test_record_cls_fields(example_model):
+    record_cls = get_record_cls(example_model, fields=['name'])
+    assert record_cls._fields == ('name',)
+    assert get_record_cls(example_model, fields=('name',)) is record_cls
+    assert get_record_cls(example_model) is not record_cls
+
+
+def test_unknown_fields(example_model):
+    with pytest.raises(ValueError) as exc:
+        get_record_cls(example_model, fields=['name', 'size'])
+    assert str(exc.value) == "Unknown field(s) ['size'] of ExampleModel"
+
+
+def test_records_are_immutable(example_model):
+    record = get_record_cls(example_model)(1, 'foo')
+    with pytest.raises(AttributeError):
+        record.name = 'bar'
+
+
+def test_invalid_field_names():
+    class Lesson(declarative_base(name='recordsbase')):
+        __tablename__ = 'lesson'
+        id = Column(Integer, primary_key=True)
+        _hidden = Column('_hidden', Integer)
+        class_ = Column('class', Integer)
+
+    record_cls = get_record_cls(Lesson)
+    assert record_cls._fields == ('id', '_1', '_2')
+    assert record_cls._column_names == ('id', '_hidden', 'class')
+    assert record_cls(1, 2, 3)._2 == 3
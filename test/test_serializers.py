@@ -7,7 +7,8 @@ import sqlalchemy as sa
 from sqlalchemy_utils.types import ChoiceType, JSONType
 
 from nameko_autocrud.serializers import (
-    default_to_serializable, get_default_from_serializable
+    default_to_serializable, from_columnar, get_default_from_serializable,
+    to_columnar
 )
 
 
@@ -75,6 +76,11 @@ class TestDefaultSerialization:
             'choice_field': 'B'
         }
 
+    def test_default_to_serializable_exclude(self, example_model):
+        instance = example_model(id=1, name='foo')
+        assert default_to_serializable(instance, exclude=['name']) == {
+            'id': 1}
+
     def test_default_from_serializable(self, model, db_uri, session):
 
         dict_ = get_default_from_serializable(model)({
@@ -95,3 +101,69 @@ class TestDefaultSerialization:
         instance = model(**dict_)
         session.add(instance)
         session.commit()
+
+
+class TestColumnar:
+
+    @pytest.fixture
+    def instances(self, example_model):
+        return [
+            example_model(id=1, name='foo'),
+            example_model(id=2, name=None),
+        ]
+
+    def test_to_columnar(self, instances):
+        assert to_columnar(instances) == {
+            'columns': ['id', 'name'],
+            'rows': [[1, 'foo'], [2, None]],
+        }
+
+    def test_to_columnar_empty(self):
+        assert to_columnar([]) == {'columns': [], 'rows': []}
+
+    def test_to_columnar_custom_serializer(self, instances):
+        def to_serializable(obj):
+            if obj.name is None:
+                return {'id': obj.id}
+            return {'name': obj.name, 'id': obj.id, 'upper': obj.name.upper()}
+
+        assert to_columnar(instances, to_serializable) == {
+            'columns': ['id', 'name', 'upper'],
+            'rows': [[1, 'foo', 'FOO'], [2, None, None]],
+        }
+
+    def test_to_columnar_model_to_dict(self, dec_base):
+        class DictModel(dec_base):
+            __tablename__ = 'dict_model'
+            id = sa.Column(sa.Integer, primary_key=True)
+
+            def to_dict(self):
+                return {'id': self.id, 'double': self.id * 2}
+
+        assert to_columnar([DictModel(id=2)]) == {
+            'columns': ['double', 'id'],
+            'rows': [[4, 2]],
+        }
+
+    def test_to_columnar_exclude(self, instances, dec_base):
+        assert to_columnar(instances, exclude=['name']) == {
+            'columns': ['id'],
+            'rows': [[1], [2]],
+        }
+
+        class DictModel(dec_base):
+            __tablename__ = 'dict_model'
+            id = sa.Column(sa.Integer, primary_key=True)
+
+            def to_dict(self):
+                return {'id': self.id, 'double': self.id * 2}
+
+        assert to_columnar([DictModel(id=2)], exclude=['double']) == {
+            'columns': ['id'],
+            'rows': [[2]],
+        }
+
+    def test_from_columnar(self, instances):
+        assert from_columnar(to_columnar(instances)) == [
+            default_to_serializable(instance) for instance in instances
+        ]
@@ -0,0 +1,570 @@
+import pytest
+from mock import Mock, patch
+
+from nameko.testing.services import entrypoint_hook
+from nameko_sqlalchemy import DB_URIS_KEY, DatabaseSession
+from sqlalchemy import Column, Integer, String, Text, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from nameko_autocrud import (
+    DBStorage, NotFound, ShardedAutoCrud, ShardedDBStorage,
+    UnsupportedOperation
+)
+from nameko_autocrud.sharding import get_filter_values, merge_sorted
+
+
+ShardedBase = declarative_base(name='shardedbase')
+
+
+class TenantItem(ShardedBase):
+    __tablename__ = 'tenant_item'
+    tenant = Column(String, primary_key=True)
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    notes = Column(Text)
+
+
+class RegionItem(ShardedBase):
+    __tablename__ = 'region_item'
+    id = Column(Integer, primary_key=True)
+    region = Column(String)
+    name = Column(String)
+
+
+SHARDS = ('eu', 'us')
+
+
+def get_tenant_shard(tenant):
+    # tenants are named after their region, e.g. `eu-acme`
+    return tenant.split('-')[0]
+
+
+@pytest.fixture
+def shard_uris(tmpdir):
+    return {
+        shard: 'sqlite:///{}'.format(tmpdir.join(shard).strpath)
+        for shard in SHARDS
+    }
+
+
+@pytest.fixture
+def shard_sessions(shard_uris):
+    sessions = {}
+    for shard, uri in shard_uris.items():
+        engine = create_engine(uri)
+        ShardedBase.metadata.create_all(engine)
+        sessions[shard] = sessionmaker(bind=engine)()
+
+    yield sessions
+
+    for session in sessions.values():
+        session.close()
+
+
+@pytest.fixture
+def storage(shard_sessions):
+    return ShardedDBStorage(
+        TenantItem, sessions=shard_sessions, shard_field='tenant',
+        shard_for=get_tenant_shard)
+
+
+@pytest.fixture
+def region_storage(shard_sessions):
+    return ShardedDBStorage(
+        RegionItem, sessions=shard_sessions, shard_field='region',
+        shard_for=lambda region: region)
+
+
+@pytest.fixture
+def items(storage):
+    for tenant, id_, name in [
+        ('eu-a', 1, 'b'), ('us-a', 1, 'd'), ('eu-b', 2, None),
+        ('us-b', 3, 'a'), ('eu-a', 4, 'c'),
+    ]:
+        storage.create(dict(
+            tenant=tenant, id=id_, name=name, notes='notes {}'.format(id_)))
+
+
+def shard_keys(session, model_cls=TenantItem):
+    return sorted(
+        tuple(row) for row in session.query(
+            *[col for col in model_cls.__table__.primary_key.columns]))
+
+
+@pytest.mark.parametrize('filters, values', [
+    (None, None),
+    ([], None),
+    ({'field': 'tenant', 'op': '==', 'value': 'a'}, {'a'}),
+    ({'field': 'tenant', 'op': 'eq', 'value': 'a'}, {'a'}),
+    ({'field': 'tenant', 'op': 'in', 'value': ['a', 'b']}, {'a', 'b'}),
+    ({'field': 'tenant', 'op': '!=', 'value': 'a'}, None),
+    ({'field': 'name', 'op': '==', 'value': 'a'}, None),
+    (
+        {'model': 'Other', 'field': 'tenant', 'op': '==', 'value': 'a'},
+        None
+    ),
+    ({'field': 'tenant', 'op': 'in', 'value': [['a']]}, None),
+    ({'field': 'tenant', 'op': '=='}, None),
+    ('invalid', None),
+    (
+        [
+            {'field': 'tenant', 'op': 'in', 'value': ['a', 'b']},
+            {'field': 'name', 'op': '==', 'value': 'x'},
+            {'field': 'tenant', 'op': 'in', 'value': ['b', 'c']},
+        ],
+        {'b'}
+    ),
+    (
+        {'and': [
+            {'field': 'tenant', 'op': '==', 'value': 'a'},
+            {'field': 'tenant', 'op': '==', 'value': 'b'},
+        ]},
+        set()
+    ),
+    (
+        {'or': [
+            {'field': 'tenant', 'op': '==', 'value': 'a'},
+            {'field': 'tenant', 'op': 'in', 'value': ['b']},
+        ]},
+        {'a', 'b'}
+    ),
+    (
+        {'or': [
+            {'field': 'tenant', 'op': '==', 'value': 'a'},
+            {'field': 'name', 'op': '==', 'value': 'b'},
+        ]},
+        None
+    ),
+    ({'or': []}, None),
+    ({'not': [{'field': 'tenant', 'op': '==', 'value': 'a'}]}, None),
+])
+def test_get_filter_values(filters, values):
+    assert get_filter_values(filters, 'tenant', 'TenantItem') == values
+
+
+def test_merge_sorted():
+    results = [
+        [(1, 'a'), (2, 'b'), (3, None)],
+        [(1, None), (1, 'c'), (2, 'a')],
+    ]
+
+    def get_value(item, field):
+        return item[field]
+
+    assert merge_sorted(
+        results, [(0, 'asc'), (1, 'desc')], get_value
+    ) == [(1, 'c'), (1, 'a'), (1, None), (2, 'b'), (2, 'a'), (3, None)]
+    assert merge_sorted(
+        results, [(1, 'asc')], get_value, offset=1, limit=3
+    ) == [(1, None), (1, 'a'), (2, 'a')]
+    # without sort fields, shards are concatenated in order
+    assert merge_sorted(results, [], get_value, limit=4) == (
+        results[0] + results[1][:1])
+
+
+class TestShardedDBStorage:
+
+    def test_create(self, storage, shard_sessions, items):
+        assert shard_keys(shard_sessions['eu']) == [
+            ('eu-a', 1), ('eu-a', 4), ('eu-b', 2)]
+        assert shard_keys(shard_sessions['us']) == [('us-a', 1), ('us-b', 3)]
+
+    @pytest.mark.parametrize('data', [{'id': 1}, {'tenant': 'ap-a', 'id': 1}])
+    def test_create_without_shard(self, storage, data):
+        with pytest.raises(ValueError) as exc:
+            storage.create(data)
+        assert 'No shard for TenantItem with tenant' in str(exc.value)
+
+    def test_get(self, storage, items):
+        storage.stats.clear()
+        obj = storage.get(('us-a', 1))
+        assert (obj.tenant, obj.id, obj.name) == ('us-a', 1, 'd')
+        # only the shard of the key is queried
+        assert storage.stats['reads.primary'] == 1
+
+    @pytest.mark.parametrize('pk', [('us-a', 2), ('ap-a', 1)])
+    def test_get_not_found(self, storage, items, pk):
+        with pytest.raises(NotFound):
+            storage.get(pk)
+
+    def test_get_without_shard_field_in_pk(self, region_storage):
+        region_storage.create({'id': 1, 'region': 'us', 'name': 'a'})
+        region_storage.create({'id': 2, 'region': 'eu', 'name': 'b'})
+
+        region_storage.stats.clear()
+        assert region_storage.get(1).name == 'a'
+        # all shards are queried
+        assert region_storage.stats['reads.primary'] == 2
+
+        with pytest.raises(NotFound):
+            region_storage.get(3)
+
+    def test_get_many(self, storage, region_storage, items):
+        objs = storage.get_many([
+            ('eu-a', 4), ('us-b', 3), ('us-b', 4), ('ap-a', 1)])
+        assert sorted(objs) == [('eu-a', 4), ('us-b', 3)]
+        assert storage.get_many([]) == {}
+
+        region_storage.create({'id': 1, 'region': 'us', 'name': 'a'})
+        region_storage.create({'id': 2, 'region': 'eu', 'name': 'b'})
+        objs = region_storage.get_many([1, 2, 3])
+        assert {pk: obj.region for pk, obj in objs.items()} == {
+            (1,): 'us', (2,): 'eu'}
+
+    def test_list(self, storage, items):
+        results = storage.list(order_by=[
+            {'field': 'id', 'direction': 'asc'},
+            {'field': 'tenant', 'direction': 'desc'},
+        ])
+        assert [(obj.tenant, obj.id) for obj in results] == [
+            ('us-a', 1), ('eu-a', 1), ('eu-b', 2), ('us-b', 3), ('eu-a', 4)]
+
+        results = storage.list(
+            order_by={'field': 'name', 'direction': 'asc'},
+            offset=1, limit=3)
+        assert [obj.name for obj in results] == ['a', 'b', 'c']
+
+        results = storage.list(
+            order_by={'field': 'name', 'direction': 'desc'}, limit=5)
+        assert [obj.name for obj in results] == ['d', 'c', 'b', 'a', None]
+
+        assert len(storage.list()) == 5
+
+    @pytest.mark.parametrize('dialect, nulls', [
+        ('sqlite', [{'nullsfirst': True}, {'nullslast': True}]),
+        ('postgresql', [{'nullsfirst': True}, {'nullslast': True}]),
+        ('mysql', [{}, {}]),
+    ])
+    def test_shards_sort_nulls_first(self, storage, items, dialect, nulls):
+        order_by = [
+            {'field': 'name', 'direction': 'asc'},
+            {'field': 'id', 'direction': 'desc'},
+        ]
+        with patch.object(
+            DBStorage, '_get_dialect_name', return_value=dialect
+        ), patch.object(
+            DBStorage, 'list', autospec=True, return_value=[]
+        ) as shard_list:
+            storage.list(order_by=order_by)
+
+        _, kwargs = shard_list.call_args
+        assert kwargs['order_by'] == [
+            dict(spec, **spec_nulls)
+            for spec, spec_nulls in zip(order_by, nulls)
+        ]
+
+    def test_list_prunes_shards(self, storage, items):
+        storage.stats.clear()
+        results = storage.list(filters=[
+            {'field': 'tenant', 'op': 'in', 'value': ['us-a', 'us-b']}])
+        assert sorted(obj.id for obj in results) == [1, 3]
+        assert storage.stats['reads.primary'] == 1
+
+        assert storage.list(filters=[
+            {'field': 'tenant', 'op': '==', 'value': 'ap-a'}]) == []
+
+    def test_list_with_total(self, storage, items):
+        results, total = storage.list(
+            filters=[{'field': 'id', 'op': '<', 'value': 3}],
+            order_by=[{'field': 'name', 'direction': 'desc'}],
+            limit=2, with_total=True)
+        assert [obj.name for obj in results] == ['d', 'b']
+        assert total == 3
+
+        assert storage.list(offset=10, with_total=True) == ([], None)
+
+    def test_list_limits(self, storage, items):
+        storage.max_limit = 2
+        with pytest.raises(ValueError):
+            storage.list(limit=3)
+
+        storage.default_limit = 1
+        results = storage.list(
+            order_by=[{'field': 'name', 'direction': 'asc'}])
+        assert [obj.name for obj in results] == [None]
+
+    def test_list_sorted_on_deferred_column(self, storage, items):
+        storage.deferred_columns = ('notes',)
+        results = storage.list(
+            order_by=[{'field': 'notes', 'direction': 'desc'}], limit=2)
+        assert [obj.id for obj in results] == [4, 3]
+
+        columns, rows = storage.list_rows(
+            order_by=[{'field': 'notes', 'direction': 'desc'}], limit=2)
+        assert columns == ['tenant', 'id', 'name']
+        assert rows == [('eu-a', 4, 'c'), ('us-b', 3, 'a')]
+
+    def test_list_rows(self, storage, items):
+        columns, rows = storage.list_rows(
+            filters=[{'field': 'tenant', 'op': '==', 'value': 'eu-a'}],
+            order_by=[{'field': 'id', 'direction': 'desc'}])
+        assert columns == ['tenant', 'id', 'name', 'notes']
+        assert rows == [
+            ('eu-a', 4, 'c', 'notes 4'), ('eu-a', 1, 'b', 'notes 1')]
+
+        (columns, rows), total = storage.list_rows(
+            order_by=[{'field': 'id', 'direction': 'asc'}],
+            offset=4, with_total=True)
+        assert rows == [('eu-a', 4, 'c', 'notes 4')]
+        assert total == 5
+
+        assert storage.list_rows(filters=[
+            {'field': 'tenant', 'op': '==', 'value': 'ap-a'}
+        ]) == (['tenant', 'id', 'name', 'notes'], [])
+
+    @pytest.mark.parametrize('order_by', [
+        [{'field': 'missing', 'direction': 'asc'}],
+        [{'model': 'Other', 'field': 'id', 'direction': 'asc'}],
+        [{'direction': 'asc'}],
+    ])
+    def test_list_invalid_sort(self, storage, order_by):
+        with pytest.raises(ValueError) as exc:
+            storage.list(order_by=order_by)
+        assert str(exc.value) == (
+            'Sharded TenantItem can only be sorted by its own columns')
+
+    def test_count(self, storage, items):
+        assert storage.count() == 5
+        storage.stats.clear()
+        assert storage.count(filters=[
+            {'field': 'tenant', 'op': '==', 'value': 'eu-a'}]) == 2
+        assert storage.stats['reads.primary'] == 1
+        assert storage.count(filters=[
+            {'field': 'tenant', 'op': '==', 'value': 'ap-a'}]) == 0
+
+    def test_estimate_row_count(self, storage, items):
+        assert storage.estimate_row_count() == 5
+
+    def test_count_is_concurrent(self, storage):
+        assert storage.supports_window_count() is False
+        assert storage.spawn_count() is None
+        assert storage.supports_list_rows is True
+
+    def test_supports_list_rows(self, shard_sessions):
+        class CustomShardStorage(DBStorage):
+            def list(self, *args, **kwargs):
+                return super().list(*args, **kwargs)[:1]
+
+        class CustomListStorage(ShardedDBStorage):
+            def list(self, *args, **kwargs):
+                return super().list(*args, **kwargs)[:1]
+
+        class CustomShardedStorage(ShardedDBStorage):
+            shard_storage_cls = CustomShardStorage
+
+        assert not CustomListStorage(TenantItem).supports_list_rows
+        assert not CustomShardedStorage(TenantItem).supports_list_rows
+
+    def test_shard_error(self, storage, items):
+        storage.shard('eu').count = Mock(side_effect=ValueError('boom'))
+        with pytest.raises(ValueError) as exc:
+            storage.count()
+        assert str(exc.value) == 'boom'
+
+    def test_update(self, storage, region_storage, items):
+        obj = storage.update(('us-b', 3), {'name': 'x', 'tenant': 'us-b'})
+        assert obj.name == 'x'
+
+        with pytest.raises(ValueError) as exc:
+            storage.update(('us-b', 3), {'tenant': 'eu-b'})
+        assert 'to another shard is not supported' in str(exc.value)
+
+        with pytest.raises(NotFound):
+            storage.update(('us-b', 4), {'name': 'x'})
+
+        region_storage.create({'id': 1, 'region': 'us', 'name': 'a'})
+        assert region_storage.update(1, {'name': 'b'}).name == 'b'
+
+    def test_delete(self, storage, shard_sessions, items):
+        storage.delete(('eu-a', 1))
+        assert shard_keys(shard_sessions['eu']) == [('eu-a', 4), ('eu-b', 2)]
+
+        with pytest.raises(NotFound):
+            storage.delete(('ap-a', 1))
+
+    def test_bulk_upsert(self, storage, shard_sessions, items):
+        objs = storage.bulk_upsert([
+            {'tenant': 'us-a', 'id': 1, 'name': 'x'},
+            {'tenant': 'eu-c', 'id': 5, 'name': 'y'},
+            {'tenant': 'us-c', 'id': 6, 'name': 'z'},
+        ])
+        assert [(obj.tenant, obj.id, obj.name) for obj in objs] == [
+            ('us-a', 1, 'x'), ('eu-c', 5, 'y'), ('us-c', 6, 'z')]
+        assert storage.upsert({'tenant': 'eu-a', 'id': 1}).name == 'b'
+        assert storage.count() == 7
+
+    def test_unit_of_work(self, storage):
+        storage.unit_of_work = True
+        callback = Mock()
+        storage.create({'tenant': 'eu-a', 'id': 1})
+        storage.create({'tenant': 'us-a', 'id': 1})
+        storage.on_commit(callback)
+        assert storage.has_written
+        assert callback.call_count == 0
+
+        storage.end_unit_of_work()
+        assert callback.call_count == 1
+        assert storage.count() == 2
+
+        storage.create({'tenant': 'us-a', 'id': 2})
+        storage.on_commit(callback)
+        storage.end_unit_of_work(success=False)
+        assert callback.call_count == 1
+        assert storage.count() == 2
+
+    def test_atomic_commit_failure(self, storage, shard_sessions):
+        with patch.object(
+            shard_sessions['eu'], 'commit', side_effect=ValueError('boom')
+        ):
+            with pytest.raises(ValueError):
+                with storage.atomic():
+                    storage.create({'tenant': 'eu-a', 'id': 1})
+                    storage.create({'tenant': 'us-a', 'id': 1})
+
+        # the shards not committed yet are rolled back
+        assert storage.count() == 0
+
+    @pytest.mark.parametrize('method_name, args', [
+        ('add', [object()]),
+        ('get_record', [1]),
+        ('list_records', []),
+        ('changes_since', ['name']),
+        ('plan_sync', [[]]),
+        ('apply_sync', [None]),
+    ])
+    def test_not_supported(self, storage, method_name, args):
+        with pytest.raises(UnsupportedOperation) as exc:
+            getattr(storage, method_name)(*args)
+        assert str(exc.value) == (
+            '{} is not supported by ShardedDBStorage'.format(method_name))
+
+
+@pytest.fixture
+def config(config, shard_uris):
+    config[DB_URIS_KEY].update({
+        'exampleservice:{}'.format(shard): uri
+        for shard, uri in shard_uris.items()
+    })
+    return config
+
+
+@pytest.fixture
+def service(shard_sessions, create_service):
+
+    class ExampleService(object):
+        name = "exampleservice"
+
+        eu_session = DatabaseSession(declarative_base(name='eu'))
+        us_session = DatabaseSession(declarative_base(name='us'))
+        item_crud = ShardedAutoCrud(
+            {'eu': 'eu_session', 'us': 'us_session'},
+            'tenant',
+            shard_for=get_tenant_shard,
+            model_cls=TenantItem,
+            get_method_name='get_item',
+            page_method_name='page_items',
+            count_method_name='count_items',
+            create_method_name='create_item',
+            update_method_name='update_item',
+            delete_method_name='delete_item',
+            bulk_upsert_method_name='bulk_upsert_items',
+            deferred_columns=['notes'],
+        )
+
+    return create_service(ExampleService)
+
+
+def test_sharded_auto_crud(service, shard_sessions):
+    container = service.container
+
+    with entrypoint_hook(container, 'bulk_upsert_items') as bulk_upsert:
+        bulk_upsert([
+            {'tenant': 'eu-a', 'id': 1, 'name': 'b'},
+            {'tenant': 'us-a', 'id': 2, 'name': 'a'},
+            {'tenant': 'eu-b', 'id': 3, 'name': 'c'},
+        ])
+    with entrypoint_hook(container, 'create_item') as create:
+        assert create({'tenant': 'us-a', 'id': 4, 'name': 'd'}) == {
+            'tenant': 'us-a', 'id': 4, 'name': 'd', 'notes': None}
+
+    assert shard_keys(shard_sessions['eu']) == [('eu-a', 1), ('eu-b', 3)]
+    assert shard_keys(shard_sessions['us']) == [('us-a', 2), ('us-a', 4)]
+
+    with entrypoint_hook(container, 'page_items') as page:
+        assert page(
+            2, 1, order_by=[{'field': 'name', 'direction': 'desc'}]
+        ) == {
+            'results': [
+                {'tenant': 'us-a', 'id': 4, 'name': 'd'},
+                {'tenant': 'eu-b', 'id': 3, 'name': 'c'},
+            ],
+            'num_pages': 2,
+            'num_results': 4,
+            'page_num': 1,
+        }
+        assert page(
+            10, 1,
+            filters=[{'field': 'tenant', 'op': '==', 'value': 'us-a'}],
+            order_by=[{'field': 'id', 'direction': 'asc'}],
+        )['results'] == [
+            {'tenant': 'us-a', 'id': 2, 'name': 'a'},
+            {'tenant': 'us-a', 'id': 4, 'name': 'd'},
+        ]
+
+    with entrypoint_hook(container, 'update_item') as update:
+        assert update(['eu-b', 3], {'name': 'x'})['name'] == 'x'
+    with entrypoint_hook(container, 'delete_item') as delete:
+        delete(['us-a', 2])
+    with entrypoint_hook(container, 'get_item') as get:
+        assert get(['eu-b', 3])['name'] == 'x'
+        with pytest.raises(NotFound):
+            get(['us-a', 2])
+    with entrypoint_hook(container, 'count_items') as count:
+        assert count() == 3
+
+
+@pytest.mark.parametrize('args, kwargs, error', [
+    (
+        [{}, 'tenant'], {},
+        "`['shard_session_providers']` param(s) are missing"
+    ),
+    (
+        [{'eu': 'session'}, None], {},
+        "`['shard_field']` param(s) are missing"
+    ),
+    (
+        [{'eu': 'session'}, 'tenant'],
+        {'read_session_provider': 'session'},
+        "`['read_session_provider']` param(s) are not supported"
+    ),
+    (
+        [{'eu': 'session'}, 'tenant'],
+        {'sync_method_name': 'sync_items'},
+        "`['sync_method_name']` param(s) are not supported"
+    ),
+    (
+        [{'eu': 'session'}, 'tenant'],
+        {'changes_since_method_name': 'item_changes'},
+        "`['changes_since_method_name']` param(s) are not supported"
+    ),
+    (
+        [{'eu': 'session'}, 'tenant'],
+        {'outbox_model': object},
+        "`['outbox_model']` param(s) are not supported"
+    ),
+    (
+        [{'eu': 'session'}, 'region'], {},
+        'Unknown shard_field region of TenantItem'
+    ),
+])
+def test_sharded_auto_crud_invalid(args, kwargs, error):
+    with pytest.raises(ValueError) as exc:
+        ShardedAutoCrud(*args, model_cls=TenantItem, **kwargs)
+    assert error in str(exc.value)
+
+
+def test_sharded_auto_crud_default_shard_for():
+    provider = ShardedAutoCrud(
+        {'eu': 'session'}, 'tenant', model_cls=TenantItem)
+    assert provider.shard_for('eu') == 'eu'
@@ -0,0 +1,50 @@
+import eventlet
+import pytest
+
+from nameko_autocrud.statements import StatementCounter
+
+
+@pytest.fixture
+def counter():
+    return StatementCounter()
+
+
+def test_counts_current_greenthread(counter, session):
+    with counter.counting() as count:
+        session.execute('SELECT 1')
+        eventlet.spawn(session.execute, 'SELECT 2').wait()
+        session.execute('SELECT 3')
+
+    session.execute('SELECT 4')
+
+    assert count.count == 2
+    assert [stmt.statement for stmt in count.statements] == [
+        'SELECT 1', 'SELECT 3'
+    ]
+    assert count.duration == sum(stmt.duration for stmt in count.statements)
+
+
+def test_nested(counter, session):
+    with counter.counting() as outer:
+        session.execute('SELECT 1')
+        with counter.counting() as inner:
+            session.execute('SELECT 2')
+        session.execute('SELECT 3')
+
+    assert outer.count == 3
+    assert inner.count == 1
+
+
+def test_all_greenthreads(counter, session):
+    with counter.counting(all_greenthreads=True) as count:
+        session.execute('SELECT 1')
+        eventlet.spawn(session.execute, 'SELECT 2').wait()
+
+    assert count.count == 2
+
+
+def test_install_once(counter, session):
+    counter.install()
+    with counter.counting() as count:
+        session.execute('SELECT 1')
+    assert count.count == 1
@@ -1,6 +1,20 @@
 import pytest
+from mock import Mock, patch
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Query, object_session, sessionmaker
+from sqlalchemy.types import UserDefinedType
 
-from nameko_autocrud.storage import DBStorage, NotFound
+from nameko_autocrud.indexes import (
+    QueryUsage, RowCountCache, UnindexedFilter
+)
+from nameko_autocrud.storage import (
+    DBStorage, NotFound, QueryTimeout, build_native_upsert,
+    get_large_column_names
+)
+from nameko_autocrud.testing import count_statements
 
 
 @pytest.fixture
@@ -90,6 +104,27 @@ class TestStorageGet:
             storage.get([1, 'foo'])
 
 
+class TestStorageGetMany:
+
+    def test_get_many(self, instances, storage):
+        assert storage.get_many([1, 3, 4]) == {
+            (1,): instances[0],
+            (3,): instances[2],
+        }
+
+    def test_get_many_empty(self, storage):
+        assert storage.get_many([]) == {}
+
+    def test_get_many_multiple_primary_keys(
+        self, multi_pk_instances, session, multi_pk_model
+    ):
+        storage = DBStorage(multi_pk_model, session=session)
+        assert storage.get_many([[1, 'foo'], (2, 'foo'), (2, 'bar')]) == {
+            (1, 'foo'): multi_pk_instances[0],
+            (2, 'foo'): multi_pk_instances[3],
+        }
+
+
 class TestStorageList:
 
     def test_list(self, instances, storage):
@@ -137,6 +172,109 @@ class TestStorageList:
         assert results == [instances[0]]
 
 
+class TestStorageListRows:
+
+    def test_list_rows(self, instances, storage):
+        columns, rows = storage.list_rows()
+        assert columns == ['id', 'name']
+        assert rows == [(1, 'foo'), (2, 'bar'), (3, 'baz')]
+
+    def test_list_rows_options(self, instances, storage):
+        columns, rows = storage.list_rows(
+            filters={'field': 'id', 'op': '<', 'value': 3},
+            order_by=[{'field': 'id', 'direction': 'desc'}],
+            offset=1, limit=1
+        )
+        assert rows == [(1, 'foo')]
+
+    def test_supports_list_rows(self, storage, example_model):
+        class CustomStorage(DBStorage):
+            @property
+            def query(self):
+                return super().query.filter(example_model.name == 'baz')
+
+        class CustomListStorage(DBStorage):
+            def list(self, *args, **kwargs):
+                return super().list(*args, **kwargs)[:1]
+
+        assert storage.supports_list_rows
+        assert not CustomStorage(example_model).supports_list_rows
+        assert not CustomListStorage(example_model).supports_list_rows
+
+
+class TestStorageListWithTotal:
+
+    def test_list_with_total(self, instances, storage):
+        results, total = storage.list(
+            filters={'field': 'id', 'op': '<', 'value': 3},
+            order_by=[{'field': 'id', 'direction': 'desc'}],
+            limit=1, with_total=True
+        )
+        assert results == [instances[1]]
+        assert total == 2
+
+    def test_list_rows_with_total(self, instances, storage):
+        (columns, rows), total = storage.list_rows(
+            offset=1, limit=1, with_total=True)
+        assert columns == ['id', 'name']
+        assert rows == [(2, 'bar')]
+        assert total == 3
+
+    def test_list_with_total_no_results(self, instances, storage):
+        assert storage.list(offset=3, with_total=True) == ([], None)
+
+    def test_supports_window_count(self, storage):
+        assert storage.supports_window_count()
+
+    @pytest.mark.parametrize('dialect_name, version, supported', [
+        ('sqlite', (3, 24, 0), False),
+        ('mysql', (5, 7, 1), False),
+        ('mysql', (8, 0, 1), True),
+        ('postgresql', (9, 6), True),
+        ('postgresql', None, False),
+        ('firebird', (3, 0), False),
+    ])
+    def test_supports_window_count_versions(
+        self, storage, session, dialect_name, version, supported
+    ):
+        dialect = Mock(server_version_info=version)
+        dialect.name = dialect_name
+        with patch.object(session, 'get_bind') as get_bind:
+            get_bind.return_value.dialect = dialect
+            assert storage.supports_window_count() is supported
+
+
+class TestStorageSpawnCount:
+
+    def test_spawn_count(self, instances, storage):
+        count_thread = storage.spawn_count(
+            filters={'field': 'id', 'op': '<', 'value': 3})
+        assert count_thread.wait() == 2
+        assert storage.stats == {'reads.primary': 1}
+
+    def test_spawn_count_engine_bind(self, instances, example_model, db_uri):
+        session = sessionmaker(bind=create_engine(db_uri))()
+        storage = DBStorage(example_model, session=session)
+        assert storage.spawn_count().wait() == 3
+        session.close()
+
+    def test_spawn_count_read_session(
+        self, instances, example_model, session, connection
+    ):
+        read_session = sessionmaker(bind=connection)()
+        storage = DBStorage(
+            example_model, session=session, read_session=read_session)
+
+        assert storage.spawn_count().wait() == 3
+        assert storage.stats == {'reads.replica': 1}
+        assert storage.spawn_count(use_primary=True).wait() == 3
+        assert storage.stats == {'reads.replica': 1, 'reads.primary': 1}
+
+    def test_spawn_count_after_write(self, instances, storage):
+        storage.create({'id': 4, 'name': 'NEW'}, commit=False)
+        assert storage.spawn_count() is None
+
+
 class TestStorageCount:
 
     def test_count(self, instances, storage):
@@ -237,3 +375,757 @@ class TestStorageUpdate:
             session.rollback()
             assert storage.list() == [instances[0], instances[1], instances[2]]
             assert get_name_via_query(session, 2) == 'bar'
+
+
+class TestStorageUpsert:
+
+    def test_upsert_inserts_new_row(self, instances, storage, session):
+        result = storage.upsert({'id': 4, 'name': 'NEW'})
+        assert (result.id, result.name) == (4, 'NEW')
+
+        session.rollback()
+        assert storage.get(4).name == 'NEW'
+
+    def test_upsert_updates_existing_row(self, instances, storage, session):
+        result = storage.upsert({'id': 1, 'name': 'CHANGE'})
+        assert (result.id, result.name) == (1, 'CHANGE')
+
+        session.rollback()
+        assert storage.get(1).name == 'CHANGE'
+        assert storage.count() == 3
+
+    def test_upsert_flush_no_commit(self, instances, storage, session):
+        result = storage.upsert(
+            {'id': 1, 'name': 'CHANGE'}, flush=True, commit=False)
+        assert result.name == 'CHANGE'
+        assert get_name_via_query(session, 1) == 'CHANGE'
+
+        session.rollback()
+        assert get_name_via_query(session, 1) == 'foo'
+
+    def test_upsert_no_flush_no_commit(self, instances, storage, session):
+        result = storage.upsert(
+            {'id': 1, 'name': 'CHANGE'}, flush=False, commit=False)
+        assert result.name == 'CHANGE'
+
+        session.rollback()
+        assert get_name_via_query(session, 1) == 'foo'
+
+    def test_upsert_requires_primary_key(self, storage):
+        with pytest.raises(ValueError) as exc:
+            storage.upsert({'name': 'NEW'})
+        assert "Primary key field(s) ['id'] are required" in str(exc)
+
+    def test_upsert_multiple_primary_keys(
+        self, multi_pk_instances, session, multi_pk_model
+    ):
+        storage = DBStorage(multi_pk_model, session=session)
+        result = storage.upsert({'id': 1, 'name': 'foo', 'value': 10})
+        assert result.value == 10
+        assert storage.get([1, 'foo']).value == 10
+        assert storage.count() == 4
+
+    def test_bulk_upsert(self, instances, storage, session):
+        results = storage.bulk_upsert([
+            {'id': 2, 'name': 'CHANGE'},
+            {'id': 4, 'name': 'NEW'},
+        ])
+        assert [(obj.id, obj.name) for obj in results] == [
+            (2, 'CHANGE'), (4, 'NEW')
+        ]
+
+        session.rollback()
+        assert [(obj.id, obj.name) for obj in storage.list()] == [
+            (1, 'foo'), (2, 'CHANGE'), (3, 'baz'), (4, 'NEW')
+        ]
+
+    def test_bulk_upsert_empty(self, storage):
+        assert storage.bulk_upsert([]) == []
+
+    @pytest.mark.parametrize('native', [False, True])
+    def test_bulk_upsert_loads_rows_at_once(
+        self, instances, storage, session, native
+    ):
+        def build_native_upsert(dialect_name, table, records, pk_names):
+            return table.insert().prefix_with('OR REPLACE').values(records)
+
+        records = [{'id': id_, 'name': 'name'} for id_ in range(1, 21)]
+        with patch(
+            'nameko_autocrud.storage.build_native_upsert',
+            build_native_upsert if native else Mock(return_value=None)
+        ), count_statements() as statements:
+            results = storage.bulk_upsert(records)
+
+        assert [obj.id for obj in results] == list(range(1, 21))
+        selects = [
+            stmt for stmt in statements.statements
+            if stmt.statement.startswith('SELECT')
+        ]
+        # the resulting rows, and the existing rows for the fallback
+        assert len(selects) == (1 if native else 2)
+
+    def test_bulk_upsert_hidden_row(self, instances, example_model, session):
+        class FooStorage(DBStorage):
+            @property
+            def query(self):
+                return super(FooStorage, self).query.filter_by(name='foo')
+
+        storage = FooStorage(example_model, session=session)
+        with pytest.raises(NotFound):
+            storage.bulk_upsert([{'id': 1, 'name': 'bar'}])
+
+    def test_upsert_concurrently_inserted_row(
+        self, instances, session, example_model
+    ):
+        class RacingStorage(DBStorage):
+            """ Simulate the row being inserted by another transaction
+                after the initial lookup.
+            """
+            raced = False
+
+            def get_many(self, pks, use_primary=False):
+                if not self.raced:
+                    self.raced = True
+                    return {}
+                return super(RacingStorage, self).get_many(pks, use_primary)
+
+        storage = RacingStorage(example_model, session=session)
+        session.expunge_all()
+        result = storage.upsert({'id': 1, 'name': 'CHANGE'})
+
+        assert (result.id, result.name) == (1, 'CHANGE')
+        assert storage.count() == 3
+
+    def test_native_upsert(self, instances, storage, session):
+        def build_native_upsert(dialect_name, table, records, pk_names):
+            assert dialect_name == 'sqlite'
+            assert pk_names == ['id']
+            return table.insert().prefix_with('OR REPLACE').values(records)
+
+        # load the instance so it must be expired after the native upsert
+        assert storage.get(1).name == 'foo'
+
+        with patch(
+            'nameko_autocrud.storage.build_native_upsert', build_native_upsert
+        ):
+            results = storage.bulk_upsert([
+                {'id': 1, 'name': 'CHANGE'},
+                {'id': 4, 'name': 'NEW'},
+            ])
+
+        assert [(obj.id, obj.name) for obj in results] == [
+            (1, 'CHANGE'), (4, 'NEW')
+        ]
+        session.rollback()
+        assert storage.get(1).name == 'CHANGE'
+
+    def test_bulk_upsert_duplicate_keys(self, instances, storage, session):
+        results = storage.bulk_upsert([
+            {'id': 4, 'name': 'NEW'},
+            {'id': 1, 'name': 'CHANGE'},
+            {'id': 4, 'name': 'LAST'},
+        ])
+        assert [(obj.id, obj.name) for obj in results] == [
+            (4, 'LAST'), (1, 'CHANGE'), (4, 'LAST')
+        ]
+        assert storage.count() == 4
+
+    def test_native_upsert_duplicate_keys(self, instances, storage):
+        upserted = []
+
+        def build_native_upsert(dialect_name, table, records, pk_names):
+            upserted.extend(records)
+            return table.insert().prefix_with('OR REPLACE').values(records)
+
+        with patch(
+            'nameko_autocrud.storage.build_native_upsert', build_native_upsert
+        ):
+            results = storage.bulk_upsert([
+                {'id': 1, 'name': 'CHANGE'},
+                {'id': 1, 'name': 'LAST'},
+            ])
+
+        # each row is upserted once
+        assert upserted == [{'id': 1, 'name': 'LAST'}]
+        assert [(obj.id, obj.name) for obj in results] == [
+            (1, 'LAST'), (1, 'LAST')
+        ]
+
+
+class TestBuildNativeUpsert:
+
+    @pytest.fixture
+    def table(self, example_model):
+        return example_model.__table__
+
+    def compile(self, stmt, dialect):
+        return str(stmt.compile(dialect=dialect)).replace('\n', '')
+
+    def test_postgresql(self, table):
+        stmt = build_native_upsert(
+            'postgresql', table, [{'id': 1, 'name': 'foo'}], ['id'])
+        assert self.compile(stmt, postgresql.dialect()).endswith(
+            'ON CONFLICT (id) DO UPDATE SET name = excluded.name')
+
+    def test_postgresql_only_primary_key(self, table):
+        stmt = build_native_upsert('postgresql', table, [{'id': 1}], ['id'])
+        assert self.compile(stmt, postgresql.dialect()).endswith(
+            'ON CONFLICT (id) DO NOTHING')
+
+    def test_mysql(self, table):
+        stmt = build_native_upsert(
+            'mysql', table, [{'id': 1, 'name': 'foo'}], ['id'])
+        assert self.compile(stmt, mysql.dialect()).endswith(
+            'ON DUPLICATE KEY UPDATE name = VALUES(name)')
+
+    def test_mysql_only_primary_key(self, table):
+        stmt = build_native_upsert('mysql', table, [{'id': 1}], ['id'])
+        assert self.compile(stmt, mysql.dialect()).endswith(
+            'ON DUPLICATE KEY UPDATE id = VALUES(id)')
+
+    def test_unknown_dialect(self, table):
+        assert build_native_upsert(
+            'unknown', table, [{'id': 1}], ['id']) is None
+
+    def test_dialect_without_upsert(self, table):
+        assert build_native_upsert(
+            'oracle', table, [{'id': 1}], ['id']) is None
+
+    def test_insert_without_on_conflict(self, table):
+        with patch(
+            'nameko_autocrud.storage.get_native_insert',
+            return_value=lambda table: table.insert()
+        ):
+            assert build_native_upsert(
+                'other', table, [{'id': 1}], ['id']) is None
+
+
+class TestStorageChangesSince:
+
+    @pytest.fixture
+    def storage(self, multi_pk_model, session):
+        return DBStorage(multi_pk_model, session=session)
+
+    def test_changes_since(self, multi_pk_instances, storage):
+        def keys(objs):
+            return [(obj.value, obj.id, obj.name) for obj in objs]
+
+        multi_pk_instances[3].value = 2
+        multi_pk_instances[2].value = None
+        storage.session.commit()
+
+        assert keys(storage.changes_since('value')) == [
+            (1, 1, 'foo'), (2, 1, 'bar'), (2, 2, 'foo')]
+        assert keys(storage.changes_since('value', limit=2)) == [
+            (1, 1, 'foo'), (2, 1, 'bar')]
+        assert keys(storage.changes_since('value', (2, 1, 'bar'))) == [
+            (2, 2, 'foo')]
+        assert keys(storage.changes_since('value', (1, 1, 'zzz'))) == [
+            (2, 1, 'bar'), (2, 2, 'foo')]
+        assert storage.changes_since('value', (2, 2, 'foo')) == []
+
+
+class TestStorageSync:
+
+    def test_plan_sync(self, instances, storage):
+        plan = storage.plan_sync([
+            {'id': 1, 'name': 'foo'},
+            {'id': 2, 'name': 'BAR'},
+            {'id': 3},
+            {'id': 4, 'name': 'new'},
+        ])
+        assert plan.creates == [{'id': 4, 'name': 'new'}]
+        assert plan.updates == [(instances[1], {'name': 'BAR'})]
+        assert plan.deletes == []
+        assert plan.unchanged == 2
+
+    def test_rows_loaded_in_batches(self, instances, storage):
+        with patch.object(
+            storage, 'get_many', wraps=storage.get_many
+        ) as get_many:
+            plan = storage.plan_sync(
+                [{'id': id_} for id_ in range(1, 6)], batch_size=2)
+        assert [args[0] for args, _ in get_many.call_args_list] == [
+            [(1,), (2,)], [(3,), (4,)], [(5,)]]
+        assert plan.unchanged == 3
+        assert len(plan.creates) == 2
+
+    def test_delete_missing(self, instances, storage):
+        plan = storage.plan_sync([{'id': 1}])
+        assert plan.deletes == []
+
+        plan = storage.plan_sync([{'id': 1}], delete_missing=True)
+        assert sorted(obj.id for obj in plan.deletes) == [2, 3]
+
+        plan = storage.plan_sync([{'id': 1}], delete_missing=True, filters=[
+            {'field': 'name', 'op': '!=', 'value': 'baz'}])
+        assert [obj.id for obj in plan.deletes] == [2]
+
+    def test_primary_key_coerced(self, instances, storage):
+        plan = storage.plan_sync([
+            {'id': '1', 'name': 'foo'},
+            {'id': '4', 'name': 'new'},
+        ], delete_missing=True)
+        assert plan.creates == [{'id': 4, 'name': 'new'}]
+        assert plan.updates == []
+        assert plan.unchanged == 1
+        assert sorted(obj.id for obj in plan.deletes) == [2, 3]
+
+        with pytest.raises(ValueError) as exc:
+            storage.plan_sync([{'id': 'one'}])
+        assert str(exc.value) == "Invalid primary key ('one',) of ExampleModel"
+
+    def test_multi_pk_coerced(
+        self, multi_pk_instances, multi_pk_model, session
+    ):
+        storage = DBStorage(multi_pk_model, session=session)
+        plan = storage.plan_sync([
+            {'id': '1', 'name': 'foo', 'value': 1},
+            {'id': 2.0, 'name': 'foo', 'value': 5},
+        ])
+        assert plan.updates == [(multi_pk_instances[3], {'value': 5})]
+        assert plan.unchanged == 1
+
+    def test_primary_key_of_unknown_type(self):
+        class Point(UserDefinedType):
+            def get_col_spec(self):
+                return 'POINT'
+
+        class Place(declarative_base(name='placebase')):
+            __tablename__ = 'place'
+            location = Column(Point, primary_key=True)
+
+        storage = DBStorage(Place)
+        assert storage._coerce_pk_values(('1',)) == ('1',)
+
+    def test_missing_keys_streamed(self, instances, storage):
+        with patch.object(
+            Query, 'yield_per', autospec=True, side_effect=Query.yield_per
+        ) as yield_per:
+            plan = storage.plan_sync(
+                [{'id': 1}], delete_missing=True, batch_size=2)
+        (_, batch_size), _ = yield_per.call_args
+        assert batch_size == 2
+        assert sorted(obj.id for obj in plan.deletes) == [2, 3]
+
+    def test_duplicate_primary_key(self, storage):
+        with pytest.raises(ValueError) as exc:
+            storage.plan_sync([{'id': 1}, {'id': 1, 'name': 'foo'}])
+        assert str(exc.value) == (
+            'Duplicate primary key (1,) in records to sync')
+
+    def test_apply_sync(self, instances, storage, session):
+        plan = storage.plan_sync([
+            {'id': 1, 'name': 'FOO'},
+            {'id': 2, 'name': 'bar'},
+            {'id': 4, 'name': 'new'},
+        ], delete_missing=True)
+
+        created = storage.apply_sync(plan)
+        assert [obj.id for obj in created] == [4]
+
+        session.expire_all()
+        assert [(obj.id, obj.name) for obj in storage.list()] == [
+            (1, 'FOO'), (2, 'bar'), (4, 'new')]
+
+
+class TestStorageRecords:
+
+    def test_get_record(self, instances, storage, session):
+        session.expunge_all()
+        record = storage.get_record(2)
+        assert (record.id, record.name) == (2, 'bar')
+        assert type(record).__name__ == 'ExampleModelRecord'
+        # no instance is loaded into the session
+        assert len(session.identity_map) == 0
+
+        assert storage.get_record(2, fields=['name']) == ('bar',)
+
+        with pytest.raises(NotFound) as exc:
+            storage.get_record(4)
+        assert str(exc.value) == 'ExampleModel with ID 4 does not exist'
+
+    def test_get_record_multi_pk(
+        self, multi_pk_model, multi_pk_instances, session
+    ):
+        storage = DBStorage(multi_pk_model, session=session)
+        assert storage.get_record((1, 'bar')).value == 2
+        assert storage.get_record([2, 'foo'], fields=['value']) == (4,)
+
+    def test_list_records(self, instances, storage):
+        records = storage.list_records()
+        assert [(record.id, record.name) for record in records] == [
+            (1, 'foo'), (2, 'bar'), (3, 'baz')]
+
+        assert storage.list_records(
+            filters=[{'field': 'name', 'op': 'like', 'value': 'ba%'}],
+            order_by=[{'field': 'name', 'direction': 'asc'}],
+            limit=1, fields=['id']
+        ) == [(2,)]
+
+    def test_customized_query(self, example_model, instances, session):
+        class FooStorage(DBStorage):
+            @property
+            def query(self):
+                return super(FooStorage, self).query.filter_by(name='foo')
+
+        storage = FooStorage(example_model, session=session)
+        assert storage.list_records() == [(1, 'foo')]
+        with pytest.raises(NotFound):
+            storage.get_record(2)
+
+    def test_invalid_field_names(self):
+        class Lesson(declarative_base(name='lessonbase')):
+            __tablename__ = 'lesson'
+            id = Column(Integer, primary_key=True)
+            class_ = Column('class', String)
+            _room = Column('_room', Integer)
+
+        engine = create_engine('sqlite:///:memory:')
+        Lesson.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add(Lesson(id=1, class_='maths', _room=5))
+        session.commit()
+
+        storage = DBStorage(Lesson, session=session)
+        assert storage.list_records() == [(1, 'maths', 5)]
+        assert storage.get_record(1, fields=['class'])._0 == 'maths'
+
+
+class TestStorageDeferredColumns:
+
+    @pytest.fixture
+    def storage(self, document_model, session):
+        session.add_all([
+            document_model(id=1, title='foo', body='x' * 100),
+            document_model(id=2, title='bar', body='y' * 100),
+        ])
+        session.commit()
+        session.expunge_all()
+
+        storage = DBStorage(document_model, session=session)
+        storage.deferred_columns = ('body', 'attachment')
+        return storage
+
+    def test_get_large_column_names(self, document_model, example_model):
+        assert get_large_column_names(document_model) == [
+            'body', 'attachment']
+        assert get_large_column_names(example_model) == []
+
+    def test_get_excluded_columns(self, storage):
+        assert storage.get_excluded_columns() == ['body', 'attachment']
+        assert storage.get_excluded_columns(['body']) == ['attachment']
+
+    def test_list(self, storage):
+        [obj, _] = storage.list()
+        assert 'body' not in obj.__dict__
+        # loaded when accessed
+        assert obj.body == 'x' * 100
+
+        [obj, _] = storage.list(include_columns=['body'])
+        assert 'body' in obj.__dict__
+        assert 'attachment' not in obj.__dict__
+
+    def test_list_rows(self, storage):
+        assert storage.list_rows() == (
+            ['id', 'title'], [(1, 'foo'), (2, 'bar')])
+        columns, _ = storage.list_rows(include_columns=['body'])
+        assert columns == ['id', 'title', 'body']
+
+
+class TestStorageLimits:
+
+    def test_default_limit(self, instances, storage):
+        storage.default_limit = 2
+        assert len(storage.list()) == 2
+        assert len(storage.list(limit=3)) == 3
+
+    def test_max_limit(self, instances, storage):
+        storage.max_limit = 2
+        assert len(storage.list()) == 2
+        assert len(storage.list(limit=1)) == 1
+
+        with pytest.raises(ValueError) as exc:
+            storage.list(limit=3)
+        assert str(exc.value) == 'Invalid limit (3), the maximum is 2'
+
+        with pytest.raises(ValueError):
+            storage.list(limit=0)
+
+    def test_list_rows(self, instances, storage):
+        storage.max_limit = 2
+        columns, rows = storage.list_rows()
+        assert len(rows) == 2
+        with pytest.raises(ValueError):
+            storage.list_rows(limit=3)
+
+
+class TestStorageStatementTimeout:
+
+    slow_query = (
+        'WITH RECURSIVE cnt(x) AS '
+        '(SELECT 1 UNION ALL SELECT x + 1 FROM cnt WHERE x < 100000000) '
+        'SELECT count(*) FROM cnt'
+    )
+
+    def test_timeout(self, storage):
+        storage.statement_timeout = 0.01
+        with pytest.raises(QueryTimeout) as exc:
+            with storage._reading():
+                storage.query.session.execute(self.slow_query)
+        assert str(exc.value) == (
+            'ExampleModel query exceeded the 0.01s statement timeout')
+
+    def test_other_errors(self, storage):
+        storage.statement_timeout = 1
+        with pytest.raises(DBAPIError):
+            with storage._reading():
+                storage.query.session.execute('SELECT * FROM missing')
+
+    def test_fast_query(self, instances, storage):
+        storage.statement_timeout = 1
+        assert storage.count() == 3
+
+
+class TestStorageQueryUsage:
+
+    @pytest.fixture
+    def storage(self, storage):
+        storage.query_usage = QueryUsage()
+        return storage
+
+    def test_list(self, instances, storage):
+        storage.list(
+            filters=[{'field': 'name', 'op': '==', 'value': 'foo'}],
+            order_by=[{'field': 'id', 'direction': 'desc'}])
+        storage.list_rows(filters=[{'field': 'name', 'op': '==', 'value': 1}])
+        storage.count(filters=[{'field': 'id', 'op': '>', 'value': 1}])
+
+        usage = storage.query_usage
+        assert usage.filters[('ExampleModel', 'name', '==')].count == 2
+        assert usage.filters[('ExampleModel', 'id', '>')].count == 1
+        assert usage.sorts[('ExampleModel', 'id', 'desc')].count == 1
+
+    def test_failed_query_recorded(self, storage):
+        storage.statement_timeout = 0.01
+        with pytest.raises(QueryTimeout):
+            with storage._listing([{'field': 'name', 'op': '=='}], None):
+                with storage._reading():
+                    storage.query.session.execute(
+                        TestStorageStatementTimeout.slow_query)
+        assert storage.query_usage.filters[
+            ('ExampleModel', 'name', '==')].max_time >= 0.01
+
+    def test_reject_unindexed_filters(self, instances, storage):
+        storage.reject_unindexed_filters = True
+        assert len(storage.list(
+            filters=[{'field': 'id', 'op': '==', 'value': 1}])) == 1
+
+        with pytest.raises(UnindexedFilter):
+            storage.list(filters=[{'field': 'name', 'op': '==', 'value': 1}])
+        with pytest.raises(UnindexedFilter):
+            storage.count(filters=[{'field': 'name', 'op': '==', 'value': 1}])
+        assert ('ExampleModel', 'name', '==') not in (
+            storage.query_usage.filters)
+
+    @pytest.mark.parametrize('min_rows, rejected', [(3, True), (4, False)])
+    def test_reject_unindexed_filters_min_rows(
+        self, instances, storage, min_rows, rejected
+    ):
+        storage.reject_unindexed_filters = True
+        storage.unindexed_filter_min_rows = min_rows
+        assert storage.estimate_row_count() == 3
+
+        filters = [{'field': 'name', 'op': '==', 'value': 'foo'}]
+        if rejected:
+            with pytest.raises(UnindexedFilter):
+                storage.list(filters=filters)
+        else:
+            assert len(storage.list(filters=filters)) == 1
+
+    def test_row_count_cached(self, instances, storage):
+        storage.reject_unindexed_filters = True
+        storage.unindexed_filter_min_rows = 4
+        storage.row_count_cache = RowCountCache(ttl=60)
+
+        filters = [{'field': 'name', 'op': '==', 'value': 'foo'}]
+        with patch.object(
+            storage, 'estimate_row_count', wraps=storage.estimate_row_count
+        ) as estimate_row_count:
+            storage.list(filters=filters)
+            storage.count(filters=filters)
+        assert estimate_row_count.call_count == 1
+
+
+class TestStorageAtomic:
+
+    def test_commit_at_end(self, instances, storage, session):
+        callback = Mock()
+        with patch.object(
+            session, 'commit', wraps=session.commit
+        ) as commit:
+            with storage.atomic():
+                storage.update(1, {'name': 'CHANGE'})
+                storage.create({'id': 4, 'name': 'NEW'})
+                storage.on_commit(callback)
+                assert not callback.called
+
+        assert commit.call_count == 1
+        assert callback.called
+        assert not storage.unit_of_work
+
+        session.rollback()
+        assert get_name_via_query(session, 1) == 'CHANGE'
+        assert get_name_via_query(session, 4) == 'NEW'
+
+    def test_rollback_on_error(self, instances, storage, session):
+        callback = Mock()
+        with pytest.raises(ValueError):
+            with storage.atomic():
+                storage.update(1, {'name': 'CHANGE'})
+                storage.on_commit(callback)
+                raise ValueError('boom')
+
+        assert not callback.called
+        assert not storage.unit_of_work
+        assert get_name_via_query(session, 1) == 'foo'
+
+    def test_unit_of_work(self, example_model, instances, session):
+        storage = DBStorage(example_model, session=session, unit_of_work=True)
+        with storage.atomic():
+            storage.update(1, {'name': 'CHANGE'})
+
+        # still only committed at the end of the unit of work
+        assert storage.unit_of_work
+        session.rollback()
+        assert get_name_via_query(session, 1) == 'foo'
+
+    def test_add(self, example_model, storage, session):
+        with storage.atomic():
+            storage.add(example_model(id=1, name='NEW'))
+        assert storage.has_written
+
+        session.rollback()
+        assert get_name_via_query(session, 1) == 'NEW'
+
+
+class TestStorageReadSession:
+
+    @pytest.fixture
+    def read_session(self, connection):
+        db_session = sessionmaker(bind=connection)()
+        yield db_session
+        db_session.close()
+
+    @pytest.fixture
+    def storage(self, example_model, session, read_session):
+        return DBStorage(
+            example_model, session=session, read_session=read_session)
+
+    def test_reads_use_read_session(self, instances, storage, read_session):
+        assert object_session(storage.get(1)) is read_session
+        assert [
+            object_session(obj) for obj in storage.list()
+        ] == [read_session] * 3
+        assert storage.count() == 3
+
+        assert storage.stats == {'reads.replica': 3}
+
+    def test_use_primary(self, instances, storage, session):
+        assert object_session(storage.get(1, use_primary=True)) is session
+        assert object_session(
+            storage.list(use_primary=True)[0]) is session
+        assert storage.count(use_primary=True) == 3
+
+        assert storage.stats == {'reads.primary': 3}
+
+    def test_reads_after_write_use_primary(self, instances, storage, session):
+        storage.update(1, {'name': 'CHANGE'}, commit=False)
+
+        result = storage.get(1)
+        assert object_session(result) is session
+        assert result.name == 'CHANGE'
+        assert storage.count(
+            {'field': 'name', 'op': '==', 'value': 'CHANGE'}) == 1
+
+    def test_without_read_session(self, example_model, instances, session):
+        storage = DBStorage(example_model, session=session)
+        assert object_session(storage.get(1)) is session
+        assert storage.stats == {'reads.primary': 1}
+
+
+class TestStorageUnitOfWork:
+
+    @pytest.fixture
+    def storage(self, example_model, session):
+        return DBStorage(example_model, session=session, unit_of_work=True)
+
+    def test_writes_are_not_committed(self, instances, storage, session):
+        storage.create({'id': 4, 'name': 'NEW'})
+        storage.update(1, {'name': 'CHANGE'})
+        storage.delete(2)
+        assert get_name_via_query(session, 4) == 'NEW'
+
+        session.rollback()
+        assert get_name_via_query(session, 1) == 'foo'
+        assert get_name_via_query(session, 2) == 'bar'
+        assert get_name_via_query(session, 4) is None
+
+    def test_explicit_commit(self, instances, storage, session):
+        storage.update(1, {'name': 'CHANGE'}, commit=True)
+
+        session.rollback()
+        assert get_name_via_query(session, 1) == 'CHANGE'
+
+    def test_end_unit_of_work(self, instances, storage, session):
+        callback = Mock()
+        storage.create({'id': 4, 'name': 'NEW'})
+        storage.on_commit(callback)
+        assert not callback.called
+
+        storage.end_unit_of_work()
+        assert callback.called
+
+        session.rollback()
+        assert get_name_via_query(session, 4) == 'NEW'
+
+    def test_end_unit_of_work_failed(self, instances, storage, session):
+        callback = Mock()
+        storage.create({'id': 4, 'name': 'NEW'})
+        storage.on_commit(callback)
+
+        storage.end_unit_of_work(success=False)
+        assert not callback.called
+        assert get_name_via_query(session, 4) is None
+
+        # callbacks are discarded
+        storage.end_unit_of_work()
+        assert not callback.called
+
+    def test_end_unit_of_work_commit_error(self, instances, storage, session):
+        callback = Mock()
+        storage.create({'id': 4, 'name': 'NEW'})
+        storage.on_commit(callback)
+
+        with patch.object(session, 'commit', side_effect=ValueError('boom')):
+            with pytest.raises(ValueError):
+                storage.end_unit_of_work()
+
+        assert not callback.called
+        assert get_name_via_query(session, 4) is None
+
+    def test_end_unit_of_work_without_writes(self, storage, session):
+        callback = Mock()
+        storage.on_commit(callback)
+
+        with patch.object(session, 'commit') as commit:
+            storage.end_unit_of_work()
+
+        assert not commit.called
+        assert callback.called
+
+    def test_on_commit_without_unit_of_work(self, example_model, session):
+        storage = DBStorage(example_model, session=session)
+        callback = Mock()
+        storage.on_commit(callback)
+        assert callback.called
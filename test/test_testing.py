@@ -0,0 +1,36 @@
+import pytest
+
+from nameko_autocrud.testing import assert_statements, count_statements
+
+
+def test_count_statements(session):
+    with count_statements() as count:
+        session.execute('SELECT 1')
+    assert count.count == 1
+
+
+def test_assert_statements(session):
+    with assert_statements(count=2, max_count=2):
+        session.execute('SELECT 1')
+        session.execute('SELECT 2')
+
+    with assert_statements(count=1) as count:
+        session.execute('SELECT 1')
+    assert count.statements[0].statement == 'SELECT 1'
+
+
+def test_assert_statements_count(session):
+    with pytest.raises(AssertionError) as exc:
+        with assert_statements(count=2):
+            session.execute('SELECT 1')
+    assert 'Expected 2 statement(s), 1 were executed:\nSELECT 1' in str(
+        exc.value)
+
+
+def test_assert_statements_max_count(session):
+    with pytest.raises(AssertionError) as exc:
+        with assert_statements(max_count=1):
+            session.execute('SELECT 1')
+            session.execute('SELECT 2')
+    assert 'Expected at most 1 statement(s), 2 were executed' in str(
+        exc.value)
@@ -0,0 +1,134 @@
+import os
+
+import pytest
+from mock import Mock, call
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker
+
+from nameko_autocrud import DBStorage, QueryTimeout
+from nameko_autocrud.timeouts import is_timeout_error, statement_timeout
+
+# e.g. `postgresql://postgres@localhost/postgres`, to also test against a
+# PostgreSQL database
+POSTGRESQL_URI = os.environ.get('POSTGRESQL_URI')
+
+# counts to a large number, taking much longer than the test timeouts
+SLOW_QUERY = (
+    'WITH RECURSIVE cnt(x) AS '
+    '(SELECT 1 UNION ALL SELECT x + 1 FROM cnt WHERE x < 100000000) '
+    'SELECT count(*) FROM cnt'
+)
+
+
+def make_session(dialect_name):
+    session = Mock()
+    session.get_bind.return_value.dialect.name = dialect_name
+    return session
+
+
+class TestStatementTimeout:
+
+    def test_no_timeout(self):
+        session = make_session('postgresql')
+        with statement_timeout(session, None):
+            pass
+        assert not session.execute.called
+
+    def test_postgresql(self):
+        session = make_session('postgresql')
+        with statement_timeout(session, 1.5):
+            session.execute('SELECT 1')
+        assert session.execute.call_args_list == [
+            call('SET LOCAL statement_timeout = 1500'),
+            call('SELECT 1'),
+            call('SET LOCAL statement_timeout TO DEFAULT'),
+        ]
+
+    def test_postgresql_error(self):
+        session = make_session('postgresql')
+        with pytest.raises(ValueError):
+            with statement_timeout(session, 1.5):
+                raise ValueError('boom')
+        assert session.execute.call_args_list == [
+            call('SET LOCAL statement_timeout = 1500'),
+            call('SET LOCAL statement_timeout TO DEFAULT'),
+        ]
+
+    def test_postgresql_statement_error(self):
+        session = make_session('postgresql')
+        error = DBAPIError('SELECT 1', {}, Exception('canceled'))
+        with pytest.raises(DBAPIError) as exc:
+            with statement_timeout(session, 1.5):
+                raise error
+        assert exc.value is error
+        # the aborted transaction can't be reset
+        assert session.execute.call_args_list == [
+            call('SET LOCAL statement_timeout = 1500'),
+        ]
+
+    @pytest.mark.skipif(
+        not POSTGRESQL_URI, reason='POSTGRESQL_URI is not set')
+    def test_postgresql_database(self, example_model):
+        engine = create_engine(POSTGRESQL_URI)
+        session = sessionmaker(bind=engine)()
+        storage = DBStorage(example_model, session=session)
+        storage.statement_timeout = 0.01
+        try:
+            with pytest.raises(QueryTimeout):
+                with storage._reading():
+                    session.execute('SELECT pg_sleep(1)')
+
+            session.rollback()
+            # the timeout only applied to the rolled back transaction
+            assert session.execute(
+                'SHOW statement_timeout').scalar() == '0'
+        finally:
+            session.close()
+            engine.dispose()
+
+    def test_mysql(self):
+        session = make_session('mysql')
+        with statement_timeout(session, 2):
+            pass
+        assert session.execute.call_args_list == [
+            call('SET SESSION max_execution_time = 2000'),
+            call('SET SESSION max_execution_time = DEFAULT'),
+        ]
+
+    def test_unsupported_dialect(self):
+        session = make_session('other')
+        with statement_timeout(session, 1):
+            pass
+        assert not session.execute.called
+
+    def test_sqlite(self, session):
+        with pytest.raises(DBAPIError) as exc:
+            with statement_timeout(session, 0.01):
+                session.execute(SLOW_QUERY)
+        assert is_timeout_error(exc.value)
+
+        session.rollback()
+        # the progress handler is removed again
+        assert session.execute('SELECT 1').scalar() == 1
+
+
+class TestIsTimeoutError:
+
+    def make_error(self, orig):
+        return DBAPIError('SELECT 1', {}, orig)
+
+    def test_postgresql(self):
+        orig = Exception('canceling statement due to statement timeout')
+        orig.pgcode = '57014'
+        assert is_timeout_error(self.make_error(orig))
+
+    def test_mysql(self):
+        assert is_timeout_error(self.make_error(
+            Exception(3024, 'maximum statement execution time exceeded')))
+
+    def test_other_errors(self):
+        orig = Exception('other')
+        orig.pgcode = '42P01'
+        assert not is_timeout_error(self.make_error(orig))
+        assert not is_timeout_error(self.make_error(Exception()))